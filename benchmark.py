@@ -0,0 +1,321 @@
+"""
+Benchmark of the nc to C-factor pipeline on synthetic data. For every size, the module generates a land use nc file
+(global 0.05° longitude/latitude grid with PFT0 - PFTn bands, random shares around the target area), a matching C-factor
+.csv file, a snap raster and a catchment shape file (EPSG:32634) in a temporary folder. It then times the public
+functions of the pipeline and one end-to-end run (pipeline.process_file with the settings of config.py, without the
+C-factor cache). The end-to-end run stops the benchmark if a season fails.
+
+The results are compared with stored baselines (benchmark_baseline.json) and the script exits with code 1 if a function
+is slower than its baseline plus the tolerance. The baselines depend on the machine, so they are not part of the
+repository: the first run on a machine has to store them with --save-baseline. Without a baseline for every timed
+function the script exits with code 2, so that a missing baseline never passes as a regression check. Everything runs
+offline.
+
+Usage:
+    python benchmark.py                       (run all sizes and compare with the baseline)
+    python benchmark.py --sizes small --repeat 5
+    python benchmark.py --save-baseline       (store the results as new baseline, e.g. on the first run)
+"""
+from functions import *
+from config import *
+import argparse
+import shutil
+import tempfile
+from osgeo import osr
+import raster_calculations as rc
+import resample_snap as rs
+import pipeline as pl
+
+# Benchmark sizes: side length of the catchment (m) and cell size of the snap raster (m)
+BENCHMARK_SIZES = {
+    "small": {"extent": 20000, "cell_size": 100},
+    "medium": {"extent": 60000, "cell_size": 100},
+    "large": {"extent": 150000, "cell_size": 100},
+}
+
+# Center of the synthetic catchment in EPSG:32634 (southern Balkans)
+BENCHMARK_CENTER = (500000, 4600000)
+BENCHMARK_GRID = (7200, 3600)  # nc grid (longitude, latitude) with 0.05° cells
+
+
+def create_snap_raster(snap_path, extent, cell_size):
+    """
+    Creates a snap raster (EPSG:32634) with the given side length around the benchmark center.
+
+    :param snap_path: str, path of the snap raster (.tif)
+    :param extent: float, side length of the raster (m)
+    :param cell_size: float, cell size of the raster (m)
+    """
+    size = int(extent / cell_size)
+    gt = (BENCHMARK_CENTER[0] - extent / 2, cell_size, 0, BENCHMARK_CENTER[1] + extent / 2, 0, -cell_size)
+    proj = rio.crs.CRS.from_string("EPSG:32634").to_wkt()
+    rc.array_to_raster(snap_path, np.ones([size, size], dtype=np.float32), gt, proj, no_data=-9999)
+
+
+def create_catchment(shape_path, extent, corners=12):
+    """
+    Creates a catchment shape file (EPSG:32634) with one polygon (regular polygon inside the snap raster extent).
+
+    :param shape_path: str, path of the shape file (.shp)
+    :param extent: float, side length of the snap raster (m)
+    :param corners: int, number of polygon corners
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32634)
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    shape = driver.CreateDataSource(shape_path)
+    layer = shape.CreateLayer(get_file_str(shape_path), srs, ogr.wkbPolygon)
+
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    radius = extent * 0.45
+    for angle in np.linspace(0, 2 * np.pi, corners + 1):
+        ring.AddPoint_2D(BENCHMARK_CENTER[0] + radius * np.cos(angle), BENCHMARK_CENTER[1] + radius * np.sin(angle))
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    feature = None
+    shape = None
+
+
+def create_cfac_file(csv_path, pft_bands, seed=0):
+    """
+    Creates a C-factor .csv file with the columns [id, name, C-factor of each season] and one row per PFT band.
+
+    :param csv_path: str, path of the .csv file
+    :param pft_bands: int, number of PFT bands
+    :param seed: int, seed of the random C-factors
+    """
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame({"id": np.arange(pft_bands), "name": ["PFT" + str(nr) for nr in range(pft_bands)]})
+    for season_alias in season_aliases:
+        table[season_alias] = rng.uniform(0.001, 0.5, pft_bands).round(4)
+    table.to_csv(csv_path, index=False)
+
+
+def create_land_use_nc(nc_path, pft_bands, land_window, seed=0):
+    """
+    Creates a land use nc file on the global 0.05° grid. Inside the land window the PFT bands have random shares which
+    sum up to 100 %, outside all bands are 0 (fill value).
+
+    :param nc_path: str, path of the nc file
+    :param pft_bands: int, number of PFT bands
+    :param land_window: rasterio.windows.Window, lat/lon window with land use data
+    :param seed: int, seed of the random shares
+    """
+    ds = nc.Dataset(nc_path, 'w')
+    ds.createDimension('longitude', BENCHMARK_GRID[0])
+    ds.createDimension('latitude', BENCHMARK_GRID[1])
+    longitude = ds.createVariable('longitude', 'f4', ('longitude',))
+    longitude[:] = -180 + (np.arange(BENCHMARK_GRID[0]) + 0.5) * 0.05
+    latitude = ds.createVariable('latitude', 'f4', ('latitude',))
+    latitude[:] = 90 - (np.arange(BENCHMARK_GRID[1]) + 0.5) * 0.05
+
+    rng = np.random.default_rng(seed)
+    shares = rng.dirichlet(np.ones(pft_bands), size=(land_window.width, land_window.height)) * 100
+    lon_slice = slice(land_window.col_off, land_window.col_off + land_window.width)
+    lat_slice = slice(land_window.row_off, land_window.row_off + land_window.height)
+    for pft_nr in range(pft_bands):
+        band = ds.createVariable("PFT" + str(pft_nr), 'f4', ('longitude', 'latitude'), zlib=True, complevel=1,
+                                 chunksizes=(720, 360), fill_value=0.0)
+        band[lon_slice, lat_slice] = shares[:, :, pft_nr].astype(np.float32)
+    ds.close()
+
+
+def create_dataset(folder, size, pft_bands):
+    """
+    Creates the synthetic input files of one benchmark size.
+
+    :param folder: str, folder of the input files
+    :param size: dict, with the extent and cell size of the benchmark size
+    :param pft_bands: int, number of PFT bands
+    :return: dict, with the paths of the input, export and tmp folders/files
+    """
+    paths = {
+        "lu_path": folder + '/lu',
+        "c_fac_file": folder + '/land_cover.csv',
+        "shape_file": folder + '/catchment.shp',
+        "snapraster_file": folder + '/snap.tif',
+        "export_folder": folder + '/export',
+        "tmp_folder": folder + '/tmp',
+    }
+    for key in ["lu_path", "export_folder", "tmp_folder"]:
+        os.makedirs(paths[key])
+    paths["nc_file"] = paths["lu_path"] + '/synthetic_2030.nc'
+
+    create_snap_raster(paths["snapraster_file"], size["extent"], size["cell_size"])
+    create_catchment(paths["shape_file"], size["extent"])
+    create_cfac_file(paths["c_fac_file"], pft_bands)
+
+    # Land use data in the region of interest plus a margin of 10 cells
+    gt, proj, snap_data, cell_resolution = rc.get_snap_raster_data(paths["snapraster_file"])
+    window = get_roi_window(BENCHMARK_GRID[0], BENCHMARK_GRID[1], snap_data, proj, paths["shape_file"],
+                            interpolation_radius)
+    land_window = wnd.Window(max(window.col_off - 10, 0), max(window.row_off - 10, 0), window.width + 20,
+                             window.height + 20)
+    create_land_use_nc(paths["nc_file"], pft_bands, land_window)
+    return paths
+
+
+def time_call(function, *args, repeat=3, **kwargs):
+    """
+    Calls a function several times and returns the fastest time and the result of the last call.
+
+    :param function: function, which is timed
+    :param args: positional arguments of the function
+    :param repeat: int, number of calls
+    :param kwargs: keyword arguments of the function
+    :return: float, with the fastest time (s); result of the function
+    """
+    best_time = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start_time
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return best_time, result
+
+
+def run_size(size_name, pft_bands, repeat):
+    """
+    Creates the synthetic data of one size and times the pipeline functions and an end-to-end run.
+
+    :param size_name: str, name of the benchmark size (see BENCHMARK_SIZES)
+    :param pft_bands: int, number of PFT bands
+    :param repeat: int, number of calls per function (the fastest is reported)
+    :return: dict, with the time (s) of each function
+    """
+    folder = tempfile.mkdtemp(prefix='lu_nc_to_c_benchmark_')
+    try:
+        paths = create_dataset(folder, BENCHMARK_SIZES[size_name], pft_bands)
+        context = pl.load_context(paths["c_fac_file"], paths["snapraster_file"], paths["shape_file"],
+                                  paths["export_folder"], paths["tmp_folder"])
+        timings = {}
+
+        ds, ds_lon, ds_lat = extract_nc_data_to_array(paths["nc_file"])
+        window = get_roi_window(ds_lon, ds_lat, context["snap_data"], context["snap_proj"], paths["shape_file"],
+                                interpolation_radius)
+        timings["apply_cfac_to_array"], season_arrays = time_call(apply_cfac_to_array, ds, ds_lon, ds_lat,
+                                                                  context["c_factor"], window, repeat=repeat)
+        files = pl.get_season_files("synthetic_2030", season_aliases[0], context)
+        timings["export_cfac_blocks"], _ = time_call(export_cfac_blocks, ds, ds_lon, ds_lat, context["c_factor"],
+                                                     [files["epsg4326"]], window, cfac_memory_limit, repeat=repeat)
+        ds.close()
+
+        timings["export_to_tif"], _ = time_call(export_to_tif, ds_lon, ds_lat, season_arrays[0], files["epsg4326"],
+                                                window, repeat=repeat)
+        timings["transform_to_target_crs"], _ = time_call(transform_to_target_crs, files["epsg4326"],
+                                                          files["epsg32634"], "EPSG:32634", repeat=repeat)
+
+        target_array = np.ma.filled(rc.raster_to_array(files["epsg32634"], mask=True), np.nan)
+        gt_target, proj_target = rc.get_raster_data(files["epsg32634"])
+        timings["get_raster_points"], points = time_call(rs.get_raster_points, target_array, gt_target,
+                                                         repeat=repeat)
+
+        rs.save_csv(points, files["csv"])
+        vrt_file = rs.generate_vrt_file(files["csv"])
+        timings["interpolate_points"], _ = time_call(rs.interpolate_points, vrt_file, files["interpolation"],
+                                                     context["snap_data"], context["cell_resolution"], repeat=repeat)
+        timings["idw_interpolate"], interpolated_array = time_call(rs.idw_interpolate, points, context["snap_data"],
+                                                                   context["cell_resolution"], repeat=repeat)
+        timings["clip"], _ = time_call(rc.clip, paths["shape_file"], files["finalized"], files["interpolation"],
+                                       repeat=repeat)
+        timings["export_clipped_array"], _ = time_call(pl.export_clipped_array, interpolated_array,
+                                                       files["finalized"], context, repeat=repeat)
+
+        # Every end-to-end call computes the C-factor arrays again (no C-factor cache); process_file does not use the
+        # manifest, so no output is skipped as up to date
+        use_cfac_cache, pl.USECFACCACHE = pl.USECFACCACHE, False
+        try:
+            timings["end_to_end"], _ = time_call(process_file_checked, paths["nc_file"], context, repeat=repeat)
+        finally:
+            pl.USECFACCACHE = use_cfac_cache
+        return timings
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def process_file_checked(nc_file, context):
+    """
+    Processes one nc file (see pipeline.process_file) and checks that the clipped raster of every season was created,
+    so that a failing pipeline is not timed as a fast one.
+
+    :param nc_file: str, path of the nc file
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :return: list of dicts, with the result of each season (see pipeline.get_task_result)
+    """
+    results, _ = pl.process_file(nc_file, context)
+    failed = [result["season"] + ": " + str(result["error"]) for result in results if result["status"] != "done"]
+    if failed or len(results) != len(season_aliases):
+        raise RuntimeError("The end-to-end run failed (" + (", ".join(failed) or "missing seasons") + ")")
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Prints the results next to the baseline and returns the functions which are slower than the baseline plus the
+    tolerance.
+
+    :param results: dict, with the time (s) of each function per size
+    :param baseline: dict, with the baseline time (s) of each function per size
+    :param tolerance: float, allowed slowdown (e.g. 0.2 for 20 %)
+    :return: list, with [size, function, time, baseline time] of each regression
+    """
+    regressions = []
+    print("{:<8} {:<26} {:>10} {:>10} {:>8}".format("Size", "Function", "Time [s]", "Base [s]", "Ratio"))
+    for size_name, timings in results.items():
+        for function_name, seconds in timings.items():
+            base_seconds = baseline.get(size_name, {}).get(function_name)
+            if base_seconds is None:
+                print("{:<8} {:<26} {:>10.4f} {:>10} {:>8}".format(size_name, function_name, seconds, "-", "-"))
+                continue
+            ratio = seconds / base_seconds if base_seconds > 0 else float('inf')
+            print("{:<8} {:<26} {:>10.4f} {:>10.4f} {:>8.2f}".format(size_name, function_name, seconds, base_seconds,
+                                                                      ratio))
+            if seconds > base_seconds * (1 + tolerance):
+                regressions.append([size_name, function_name, seconds, base_seconds])
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the nc to C-factor pipeline on synthetic data")
+    parser.add_argument("--sizes", nargs="+", choices=list(BENCHMARK_SIZES), default=list(BENCHMARK_SIZES))
+    parser.add_argument("--pft-bands", type=int, default=32, help="number of PFT bands of the synthetic nc files")
+    parser.add_argument("--repeat", type=int, default=3, help="number of calls per function (fastest is reported)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="path of the baseline .json file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = {}
+    for size_name in args.sizes:
+        print("Benchmark size: " + size_name)
+        results[size_name] = run_size(size_name, args.pft_bands, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    missing = [[size_name, function_name] for size_name, timings in results.items() for function_name in timings
+               if baseline.get(size_name, {}).get(function_name) is None]
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+        print("Baseline saved: " + args.baseline)
+    elif missing:
+        print("No baseline in " + args.baseline + " for: " + ", ".join(size_name + " " + function_name
+                                                                     for size_name, function_name in missing))
+        print("Store the baseline of this machine first: python benchmark.py --save-baseline")
+        sys.exit(2)
+    elif regressions:
+        print("Regressions (slower than baseline + " + str(int(args.tolerance * 100)) + " %):")
+        for size_name, function_name, seconds, base_seconds in regressions:
+            print(" - " + size_name + ", " + function_name + ": " + str(round(seconds, 4)) + " s (baseline "
+                  + str(round(base_seconds, 4)) + " s)")
+        sys.exit(1)
@@ -0,0 +1,152 @@
+"""
+Module contains the on-disk cache of the C-factor arrays (USECFACCACHE). The C-factor arrays of an nc file only depend
+on the nc file and the C-factor table, so they are kept when the shape file, snap raster or interpolation settings
+change. The arrays are stored as .npy files in a folder per content key (state of the nc file and the C-factor
+weights) and are loaded memory-mapped (zero copy). A cached window which contains the requested lat/lon window is
+sliced, so that a smaller region of interest is also a cache hit. The cache is limited to cfac_cache_size MB: the least
+recently used arrays are removed first.
+"""
+from config import *
+from functions import get_cfac_matrix, get_file_str
+from manifest import get_file_signature
+
+
+def get_cache_key(nc_file, c_fac_arr):
+    """
+    Returns the content key of the C-factor arrays of an nc file.
+
+    :param nc_file: str, path of the nc file
+    :param c_fac_arr: pd.DataFrame, with the C-factor table (see functions.apply_cfac_to_array)
+    :return: str, with the key (hex digest)
+    """
+    key_data = {
+        # The path is not part of the key: copied or moved nc files with the same content are found
+        "nc_file": [signature[1:] for signature in get_file_signature(nc_file, manifest_hash_content)],
+        "cfac_matrix": hashlib.sha1(get_cfac_matrix(c_fac_arr).tobytes()).hexdigest(),
+        "season_aliases": list(season_aliases),
+        "nodata": "nan",
+    }
+    if not manifest_hash_content:  # size and modification time only identify the file together with its name
+        key_data["nc_name"] = os.path.basename(nc_file)
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def get_array_file(cache_folder, key, season_nr, window):
+    """
+    Returns the path of a cached C-factor array.
+
+    :param cache_folder: str, folder of the cache
+    :param key: str, content key (see get_cache_key)
+    :param season_nr: int, number of the C-factor set
+    :param window: rasterio.windows.Window, lat/lon window of the array
+    :return: str, with the path of the .npy file
+    """
+    return (cache_folder + '/' + key + '/' + str(season_nr) + '_' + str(window.col_off) + '_' + str(window.row_off)
+            + '_' + str(window.width) + '_' + str(window.height) + '.npy')
+
+
+def get_cached_windows(cache_folder, key):
+    """
+    Returns the lat/lon windows of the arrays which are cached for a content key (all seasons present).
+
+    :param cache_folder: str, folder of the cache
+    :param key: str, content key (see get_cache_key)
+    :return: list of rasterio.windows.Window
+    """
+    windows = {}
+    for array_file in glob.glob(cache_folder + '/' + key + '/*.npy'):
+        try:
+            season_nr, col_off, row_off, width, height = (int(value) for value in
+                                                          get_file_str(array_file).split('_'))
+        except ValueError:
+            continue
+        windows.setdefault((col_off, row_off, width, height), set()).add(season_nr)
+    return [wnd.Window(*window) for window, season_nrs in windows.items() if len(season_nrs) == len(season_aliases)]
+
+
+def load_cfac_arrays(nc_file, c_fac_arr, window, cache_folder):
+    """
+    Loads the cached C-factor arrays of an nc file (memory-mapped, read only). The loaded files are marked as recently
+    used.
+
+    :param nc_file: str, path of the nc file
+    :param c_fac_arr: pd.DataFrame, with the C-factor table
+    :param window: rasterio.windows.Window, lat/lon window of the requested arrays
+    :param cache_folder: str, folder of the cache
+    :return: tuple of np.memmap (float32), one array per C-factor set, or None if the arrays are not cached
+    """
+    key = get_cache_key(nc_file, c_fac_arr)
+    for cached in get_cached_windows(cache_folder, key):
+        if not (cached.col_off <= window.col_off and window.col_off + window.width <= cached.col_off + cached.width
+                and cached.row_off <= window.row_off and window.row_off + window.height <= cached.row_off +
+                cached.height):
+            continue
+        rows = slice(window.row_off - cached.row_off, window.row_off - cached.row_off + window.height)
+        columns = slice(window.col_off - cached.col_off, window.col_off - cached.col_off + window.width)
+        season_arrays = []
+        try:
+            for season_nr in range(len(season_aliases)):
+                array_file = get_array_file(cache_folder, key, season_nr, cached)
+                season_arrays.append(np.load(array_file, mmap_mode='r')[rows, columns])
+                os.utime(array_file)  # LRU: the modification time is the last use
+        except (OSError, ValueError):  # removed by another process in the meantime
+            continue
+        return tuple(season_arrays)
+    return None
+
+
+def save_cfac_arrays(season_arrays, nc_file, c_fac_arr, window, cache_folder):
+    """
+    Saves the C-factor arrays of an nc file to the cache and removes the least recently used other arrays, if the cache
+    is larger than cfac_cache_size. Arrays which are larger than cfac_cache_size on their own are not cached, since
+    they would be removed again at once. The files are written under a temporary name first, so that parallel
+    processes never read an incomplete file.
+
+    :param season_arrays: tuple of np.arrays, with the C-factor array of each season
+    :param nc_file: str, path of the nc file
+    :param c_fac_arr: pd.DataFrame, with the C-factor table
+    :param window: rasterio.windows.Window, lat/lon window of the arrays
+    :param cache_folder: str, folder of the cache
+    """
+    if sum(np.asarray(season_array).size * 4 for season_array in season_arrays) > cfac_cache_size * 1048576:
+        return
+    key = get_cache_key(nc_file, c_fac_arr)
+    os.makedirs(cache_folder + '/' + key, exist_ok=True)
+    array_files = []
+    for season_nr, season_array in enumerate(season_arrays):
+        array_file = get_array_file(cache_folder, key, season_nr, window)
+        array_files.append(array_file)
+        tmp_file = array_file + "." + uuid.uuid4().hex + ".tmp"
+        with open(tmp_file, 'wb') as npy_file:
+            np.save(npy_file, np.ascontiguousarray(season_array, dtype=np.float32))
+        os.replace(tmp_file, array_file)
+    evict(cache_folder, cfac_cache_size, array_files)
+
+
+def evict(cache_folder, max_size, keep=()):
+    """
+    Removes the least recently used arrays until the cache is smaller than max_size.
+
+    :param cache_folder: str, folder of the cache
+    :param max_size: float, maximum size of the cache in MB
+    :param keep: list, (optional) paths of the arrays which are not removed (e.g. the arrays which were just saved)
+    """
+    cached_files = []
+    for array_file in glob.glob(cache_folder + '/*/*.npy'):
+        try:
+            stat = os.stat(array_file)
+        except OSError:
+            continue
+        cached_files.append((stat.st_mtime, stat.st_size, array_file))
+
+    cache_size = sum(size for mtime, size, array_file in cached_files)
+    for mtime, size, array_file in sorted(cached_files):
+        if cache_size <= max_size * 1048576:
+            break
+        if array_file in keep:
+            continue
+        try:
+            os.remove(array_file)
+        except OSError:
+            pass
+        cache_size -= size
@@ -7,48 +7,238 @@ try:
     import sys
     import time
     import datetime
+    import uuid
+    import traceback
+    import hashlib
+    import json
+    import re
+    import queue
+    import threading
+    import importlib
+    import ast
+    import random
+    from concurrent import futures
 except ModuleNotFoundError as b:
-    print('ModuleNotFoundError: Missing basic libraries (required: glob, os, sys, time, datetime, re, shutil, calendar')
+    print('ModuleNotFoundError: Missing basic libraries (required: glob, os, sys, time, datetime, uuid, traceback, '
+          'hashlib, json, re, queue, threading, importlib, ast, random, concurrent')
     print(b)
 
-# import additional python libraries
+# import additional python libraries: numpy is imported directly, the raster and table libraries are imported at
+# their first use (see LazyImport), so that importing the modules (e.g. main.py --plan) does not load them
 try:
     import numpy as np
-    import pandas as pd
-    import rasterio as rio
-    from rasterio import warp as wrp
-    from rasterio.enums import Resampling
-    #from rasterio.transform import Affine
-    #from rasterio.warp import reproject, Resampling, calculate_default_transform
-
-    import matplotlib as math
-    from osgeo import gdal
-    from osgeo import ogr
-    import netCDF4 as nc
 except ModuleNotFoundError as b:
-    print('ModuleNotFoundError: Missing fundamental packages (required: gdal, numpy, pandas, rasterio, netCDF4, mathplot')
+    print('ModuleNotFoundError: Missing fundamental packages (required: gdal, numpy, pandas, rasterio, netCDF4, scipy')
     print(b)
 
+
+class LazyImport:
+    """
+    Placeholder of a module (or of an attribute of a module), which imports the module at the first attribute access
+    or call. A missing package raises ModuleNotFoundError at its first use.
+    """
+    def __init__(self, module_name, attribute=None):
+        """
+        :param module_name: str, name of the module (e.g. 'rasterio.warp')
+        :param attribute: str, (optional) name of the attribute of the module which is represented (e.g. a class)
+        """
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        if name in ('_module_name', '_attribute', '_target'):  # not initialized (e.g. copy)
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        return "<lazy import of '" + self._module_name + ("." + self._attribute if self._attribute else "") + "'>"
+
+
+pd = LazyImport('pandas')
+rio = LazyImport('rasterio')
+wrp = LazyImport('rasterio.warp')
+wnd = LazyImport('rasterio.windows')
+Resampling = LazyImport('rasterio.enums', 'Resampling')
+gdal = LazyImport('osgeo.gdal')
+ogr = LazyImport('osgeo.ogr')
+nc = LazyImport('netCDF4')
+cKDTree = LazyImport('scipy.spatial', 'cKDTree')
+
 """Input variable description: 
+With the default settings, a run processes the whole nc grid with on-disk stages, gdal_grid and striped GeoTIFF
+outputs, without prefetching threads. The following changes of the original scripts remain active by default: the GDAL
+stages run in-process with gdal_num_threads threads (all cores), and the interpolated intermediate raster
+(gdal.Grid) is written north up. Neither changes the values of the clipped outputs. Two changes do affect the values:
+- the C-factors are calculated in float32 (see functions.get_cfac_matrix) instead of with the pandas float64 values,
+  so the clipped values differ from the original ones by the float32 rounding (about 1e-7 relative)
+- the epsg4326 and epsg32634 intermediates have np.nan as no data value (originally none and -9999). The original
+  main.py only masked the nc fill value (9.96921e+36), so the -9999 cells at the edge of the reprojected raster were
+  interpolated as points; they are left out now, which changes the clipped cells near the edge of the nc grid (if any)
+
 * Decision variables 
 - USELOG: boolean, which determine whether the temporary files are erased after the clipped file is finalized
+- INMEMORY: boolean, if True the arrays and transforms are passed between the stages in memory and only the clipped
+            files are written (intermediate files are only written to tmp_folder for debugging if USELOG=True). If
+            False, every stage writes and reads its intermediate GeoTIFF/CSV/VRT file
+- USEOPERATOR: boolean, if True the reprojection, interpolation and clip are replaced by a regridding operator, which
+               stores for every clipped target cell the interpolation points within interpolation_radius (their lat/lon
+               source cell and inverse distance weight). Per season, the nearest valid points are weighted directly
+               from the lat/lon cells. The operator is calculated once per grid, snap raster, shape file and
+               interpolation settings and cached in tmp_folder/operators (INMEMORY and interpolation_engine are not
+               used in this mode)
+- INCREMENTAL: boolean, if True a manifest (manifest.json) with the state of the inputs is kept in export_folder and
+               only the outputs of new or changed nc files (or after a change of the inputs/settings) are processed.
+               Since the manifest is updated after every nc file, an interrupted batch resumes where it stopped
+- PROFILE: boolean, if True every stage is timed per nc file and season (with peak memory and bytes read/written)
+           and a run report (run_report.json/.csv) is written to export_folder. The bytes and the traced peak memory
+           are process-wide, so they are left out for stages which overlap with the prefetching threads (see
+           profiling.py, prefetch_files=0 records them for every stage)
+- USEMASKCLIP: boolean, if True the shape file is rasterized once onto the snap raster grid (cached in
+               tmp_folder/masks) and the clip is done in memory with the mask. If False, gdalwarp -cutline is used
+- USEFEATURES: boolean, if True every feature (polygon) of shape_file is additionally exported as its own clipped
+               raster (<nc file>_<season>_<feature>_clip.tif) and the zonal statistics (count, mean, min, max) of all
+               features are saved to zonal_statistics.csv in export_folder. The features are rasterized once to a
+               label raster (cached in tmp_folder/masks), the interpolation is done only once for all features
+- USEBLOCKS: boolean, if True the C-factors are computed block by block (aligned to the chunks of the nc files) and
+             written directly to the epsg:4326 tifs, so that grids larger than the memory can be processed. The
+             blocks stay below cfac_memory_limit. The following steps are done on disk (INMEMORY and USEOPERATOR are
+             not used)
+- USECFACCACHE: boolean, if True the C-factor arrays of every nc file are cached in tmp_folder/cfac_cache (memory
+                mapped .npy files, keyed by the nc file and the C-factor table) and loaded instead of recomputed, e.g.
+                after a change of the shape file, snap raster or interpolation settings (not used if USEBLOCKS=True)
+- USECELLS: boolean, if True the cells with values (land cells) of the nc grid are indexed once per grid (cached in
+            tmp_folder/masks) and the C-factors are only computed for these cells (the PFT bands are still read for
+            the whole window). Ocean and no data cells are recognized from the no data metadata of the nc files and
+            are np.nan in the C-factor arrays
+- USETARGETGRID: boolean, if True the EPSG:32634 grid is fixed once (snap raster and shape file extent plus
+                 interpolation_radius) and the nc cells are mapped onto it with a pixel mapping (nearest neighbor),
+                 which is cached in tmp_folder/operators. Otherwise the lat/lon array is reprojected per nc file and
+                 season onto a grid covering the whole array
+- USEROI: boolean, if True only the lat/lon window covering the snap raster and shape file (plus the interpolation
+          radius) is read from the nc files, otherwise the whole global grid is processed
+- TEMPORAL: boolean, if True the clipped rasters of the years between the projection years (nc files with a year in
+            their name) are interpolated linearly, every temporal_step years (see temporal.py)
+- STACKOUTPUT: boolean, if True the clipped rasters of all nc files in lu_path are additionally stacked per season into
+               one multi-band file (one band per year, see stack_format), e.g. for time series analyses of a scenario
 
 * Input files:
 - c_fac_file: string, path for the land cover factor correlation (.csv format)
-- xyz_csv_file: string, path for the temporary csv file (.csv format)
-- shape_file: string, path for the shape file (.tif format)
+- shape_file: string, path for the shape file (.shp format)
+- feature_name_field: string, attribute of shape_file with the feature names (used if USEFEATURES=True). If None, the
+                      feature IDs are used
 - snapraster_file: string, path for a sample snap file with the geoinformation (.tif format)
 - lu_path: string, folder where the land use projection raster files in .nc format are
 - export_folder: string, path where the export files are stored
-- tmp_folder: string, path where the temporary files are stored (These will be erased if USELOG=False)
+- tmp_folder: string, path where the temporary files are stored (These will be erased if USELOG=False). Every nc
+              file and season gets its own temporary file names (including the point .csv/.vrt files)
+
+* Execution settings:
+- manifest_hash_content: boolean, if True the manifest compares the content (sha256) of the input files, otherwise only
+                         their size and modification time
+- n_workers: int, number of processes which process the nc files in parallel (1: sequential in the main process). Each
+             process can additionally use several threads (see interpolation_threads)
+- prefetch_files: int, number of nc files which are read ahead by a reader thread, while the main process transforms,
+                  interpolates and clips the current file and a writer thread writes the clipped rasters (only if
+                  n_workers=1, 0: no prefetching). Each prefetched file holds its C-factor arrays in memory
+- writer_queue_size: int, number of clipped rasters which can wait for the writer thread (bounds the memory, if the
+                     writing is slower than the processing)
+
+- profile_memory: boolean, if True the peak memory of every stage is traced (tracemalloc; slows down allocations).
+                  Otherwise only the peak resident memory of the process is recorded
+- profile_console: boolean, if True a summary per stage is printed at the end of the run
+- statistics_histogram_bins: int, number of histogram bins of the statistics (valid cells, min, max, mean, std), which
+                             are embedded in the metadata of every clipped raster and collected in
+                             run_statistics.csv in export_folder (0: no histogram)
+
+* C-factor settings:
+- c_fac_columns: list, column numbers read from c_fac_file. The first one is the name/index column, all following
+                 columns are C-factor sets (e.g. summer and winter), which are computed in one pass over the nc data
+- season_aliases: list, names of the C-factor sets (one per C-factor column), used in the output file names
+- cfac_batch_size: int, number of PFT bands that are stacked and multiplied with the C-factor matrix at once (higher
+                   values are faster, but need more memory)
+- cfac_cache_size: float, maximum size (MB) of the C-factor cache. The least recently used arrays are removed first
+- cfac_memory_limit: float, memory limit (MB) of one block of the C-factor computation and of the reprojection to
+                     the target CRS (used if USEBLOCKS=True)
+
+* GDAL settings (used by all GDAL calls, see gdal_options.py):
+- gdal_num_threads: int, number of threads of the GDAL calls (warping, gridding, compression)
+- gdal_cache_max: int, size of the GDAL block cache in MB
+- gdal_warp_memory: int, working memory of the warp operations (clip, reprojection) in MB
+- gdal_creation_options: list, creation options of the GeoTIFFs written with GDAL (e.g. 'COMPRESS=DEFLATE',
+                         'TILED=YES')
+- output_profile: string, format of the clipped outputs: 'plain' (striped, uncompressed GeoTIFF), 'tiled' (tiled and
+                  compressed GeoTIFF with internal overviews) or 'cog' (Cloud-Optimized GeoTIFF)
+- output_compression: string, compression of the 'tiled' and 'cog' outputs (e.g. 'DEFLATE', 'ZSTD', 'LZW')
+- output_compression_level: int, compression level of DEFLATE/ZSTD (None: GDAL default)
+- output_block_size: int, size of the tiles of the 'tiled' and 'cog' outputs and of the netCDF stack chunks in cells
+- output_overviews: boolean, if True the 'tiled' and 'cog' outputs get internal overviews (average)
+- stack_format: string, format of the scenario stacks (STACKOUTPUT): 'GTiff' (multi-band GeoTIFF with the output
+                profile) or 'netCDF' (compressed cube with the dimensions time, y and x)
+
+* Interpolation settings (inverse distance to a power with nearest neighbor search, same as gdal_grid invdistnn):
+- interpolation_engine: string, 'kdtree' for the in-process interpolation (spatial index, batched, multithreaded) or
+                        'gdal' for gdal_grid
+- interpolation_power: float, weighting power of the inverse distance
+- interpolation_smoothing: float, smoothing parameter (added to the distance)
+- interpolation_max_points: int, maximum number of points used to interpolate a cell
+- interpolation_radius: float, search radius (in target CRS units, m) of the interpolation. Also used as buffer around
+                        the target area for the region of interest
+- interpolation_nodata: float, value of cells without points in the search radius (gdal_grid default: 0)
+- interpolation_threads: int, number of threads for the neighbor search of the 'kdtree' engine (-1: all cores)
+- interpolation_block_rows: int, number of snap raster rows which are interpolated at once by the 'kdtree' engine
+
+* Temporal interpolation settings (TEMPORAL):
+- temporal_step: int, number of years between two interpolated rasters (1: annual rasters)
+
+* Sharding settings (several nodes which share lu_path and export_folder, see sharding.py):
+- shard_mode: string, None (no sharding), 'static' (fixed share of the tasks per node, see shard_index and
+              shard_count) or 'dynamic' (the nodes claim the tasks with lock files in export_folder/.locks, needs
+              INCREMENTAL=True)
+- shard_index: int, index of this node in the 'static' mode (0 ... shard_count - 1)
+- shard_count: int, number of nodes in the 'static' mode
+- shard_node: string, name of this node in the reports and lock files of the 'dynamic' mode (None: host name and
+              process id)
+- lock_timeout: float, seconds after which the lock of a task which was not refreshed is reclaimed (dead node)
+- lock_heartbeat: float, seconds between two refreshes of the locks held by a node (must be smaller than lock_timeout)
+
+* Worker settings (long-running worker, see worker.py):
+- worker_mode: string, 'watch' to process the nc files which arrive in lu_path or 'queue' to process the job files
+               (.job, one nc file path per line) which are put into job_folder
+- job_folder: string, folder of the job files of the 'queue' mode (None: tmp_folder/jobs)
+- worker_poll_interval: float, seconds between two scans of lu_path or job_folder. A new nc file is processed when its
+                        size and modification time did not change between two scans (completely copied)
+- worker_retries: int, number of times an nc file whose processing failed is processed again in the 'watch' mode (on
+                  the following scans, the count starts again when the nc file changes)
 """
 
 USELOG = True
+INMEMORY = False
+USEOPERATOR = False
+INCREMENTAL = False
+PROFILE = False
+USEMASKCLIP = False
+USEFEATURES = False
+USEBLOCKS = False
+USECFACCACHE = False
+USECELLS = False
+USEROI = False
+USETARGETGRID = False
+TEMPORAL = False
+STACKOUTPUT = False
 
 c_fac_file = r'/home/yendras/hiwi/Daten/c-factor/land_cover.csv'
-# Don't change the csv file
-xyz_csv_file = r'file.csv'
 shape_file = r'/home/yendras/hiwi/Daten/Shape_Catchments/totalboundary.shp'
+feature_name_field = None
 
 snapraster_file = r'/home/yendras/hiwi/Daten/Rasters/Cp_Mean_snap.tif'
 
@@ -56,3 +246,117 @@ lu_path = r'/home/yendras/hiwi/Daten/Projected_Land_Use'
 #lu_path = r'/home/yendras/hiwi/Daten/szenario/SSP1_RCP2_6'
 export_folder = r'/home/yendras/Downloads/LU_nc_to_C-main/export'
 tmp_folder = r'/home/yendras/Downloads/LU_nc_to_C-main/tmp'
+
+n_workers = 1
+prefetch_files = 0
+writer_queue_size = 8
+manifest_hash_content = False
+profile_memory = False
+profile_console = True
+statistics_histogram_bins = 0
+
+c_fac_columns = [1, 2, 3]
+season_aliases = ["summer", "winter"]
+cfac_batch_size = 8
+cfac_memory_limit = 1024
+cfac_cache_size = 4096
+
+gdal_num_threads = os.cpu_count() or 1
+gdal_cache_max = 512
+gdal_warp_memory = 512
+gdal_creation_options = ['BIGTIFF=IF_SAFER']
+output_profile = 'plain'
+output_compression = 'DEFLATE'
+output_compression_level = None
+output_block_size = 512
+output_overviews = True
+stack_format = 'GTiff'
+
+interpolation_engine = 'gdal'
+interpolation_power = 2.0
+interpolation_smoothing = 0.0
+interpolation_max_points = 12
+interpolation_radius = 5000
+interpolation_nodata = 0.0
+interpolation_threads = -1
+interpolation_block_rows = 256
+
+temporal_step = 1
+
+shard_mode = None
+shard_index = 0
+shard_count = 1
+shard_node = None
+lock_timeout = 600.0
+lock_heartbeat = 30.0
+
+worker_mode = 'watch'
+job_folder = None
+worker_poll_interval = 5.0
+worker_retries = 3
+
+
+# The settings can be overridden on the command line (see main.py --set). The overrides are passed in the environment,
+# so that worker processes and other modules which import this module later get the same settings.
+OVERRIDES_ENV = 'LU_NC_TO_C_SETTINGS'
+# Settings which are None by default, but take a text (their overrides are not parsed as python literals, e.g. a node
+# named 7)
+TEXT_SETTINGS = ['feature_name_field', 'shard_mode', 'shard_node', 'job_folder']
+
+
+def get_setting_value(name, text):
+    """
+    Converts the text of a setting override to the type of the setting.
+
+    :param name: str, name of the setting (module variable of config.py)
+    :param text: str, value of the setting (lists, dicts and None as python literals, e.g. "[1, 2, 3]"). The text
+    settings which are None by default (see TEXT_SETTINGS) take the text as it is, or None
+    :return: value of the setting
+    """
+    settings = globals()
+    if name.startswith('_') or name not in settings or callable(settings[name]) or \
+            type(settings[name]).__name__ == 'module':
+        raise ValueError("Unknown setting '" + name + "'")
+    current = settings[name]
+    if isinstance(current, bool):
+        if text.strip().lower() in ('1', 'true', 'yes', 'on'):
+            return True
+        if text.strip().lower() in ('0', 'false', 'no', 'off'):
+            return False
+        raise ValueError("The setting '" + name + "' is a boolean (true or false), not '" + text + "'")
+    if isinstance(current, (int, float)):
+        try:
+            value = ast.literal_eval(text.strip())
+        except (ValueError, SyntaxError):
+            value = None
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("The setting '" + name + "' is a number, not '" + text + "'")
+        # Float settings also take ints (e.g. 600), int settings also take floats (e.g. a radius of 2500.5 m)
+        if isinstance(current, float) or (isinstance(value, float) and not value.is_integer()):
+            return float(value)
+        return int(value)
+    if isinstance(current, str):
+        return text
+    if name in TEXT_SETTINGS:
+        return None if text.strip() == 'None' else text
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):  # e.g. a string for a setting which is None by default
+        return text
+
+
+def apply_overrides(overrides):
+    """
+    Overrides settings of this module. Modules which imported the settings with 'from config import *' before keep
+    the previous values, so the overrides have to be applied before the processing modules are imported.
+
+    :param overrides: dict, with the setting names and their values as text
+    """
+    for name, text in overrides.items():
+        globals()[name] = get_setting_value(name, text)
+    all_overrides = json.loads(os.environ.get(OVERRIDES_ENV, '{}'))
+    all_overrides.update(overrides)
+    os.environ[OVERRIDES_ENV] = json.dumps(all_overrides)
+
+
+apply_overrides(json.loads(os.environ.get(OVERRIDES_ENV, '{}')))
@@ -1,4 +1,5 @@
 from config import *
+import gdal_options as go
 
 
 def extract_nc_data_to_array(nc_path):
@@ -15,33 +16,371 @@ def extract_nc_data_to_array(nc_path):
     return ds, ds_lon, ds_lat
 
 
-def apply_cfac_to_array(ds, ds_lon, ds_lat, c_fac_arr):
+def get_nc_transform(window=None):
     """
-    Applys a c factor value for summer and winter based on a nc dataset that contains 32 PFT bands. Each band contains
-    percent share of the land cover for each pixel. Based on the share the percentual C-factor is applied.
+    Returns the transform of the nc grid in lat/long projection (0.05° cells, upper left corner at -180°, 90°)
+
+    :param window: rasterio.windows.Window, (optional) if given, the transform of the window is returned
+    :return: rasterio.transform.Affine, with the transform of the grid or window
+    """
+    transform = rio.transform.Affine.translation(-180, 90) * rio.transform.Affine.scale(0.05000000120000000492,
+                                                                                        -0.05000000119999999798)
+    if window is not None:
+        transform = wnd.transform(window, transform)
+    return transform
+
+
+def get_target_extent(snap_data, shape_file):
+    """
+    Returns the extent of the target area: the snap raster extent merged with the shape file extent.
+
+    :param snap_data: list, with snap raster extension [ulX ulY lrX lrY]
+    :param shape_file: str, with the path to the shape file (None to only use the snap raster extent)
+    :return: tuple, with the extent (left, top, right, bottom) in the snap raster crs system
+    """
+    left, top, right, bottom = snap_data
+    if shape_file is not None:
+        shape = ogr.Open(shape_file)
+        shape_left, shape_right, shape_bottom, shape_top = shape.GetLayer().GetExtent()
+        left, right = min(left, shape_left), max(right, shape_right)
+        bottom, top = min(bottom, shape_bottom), max(top, shape_top)
+        shape = None
+    return left, top, right, bottom
+
+
+def get_roi_window(ds_lon, ds_lat, snap_data, snap_proj, shape_file, buffer):
+    """
+    Calculates the lat/lon window of the nc grid that covers the target area (snap raster and shape file extent) plus a
+    buffer. The buffer has to be at least the interpolation radius, so that all points needed to interpolate the target
+    area are read.
+
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param snap_data: list, with snap raster extension [ulX ulY lrX lrY]
+    :param snap_proj: str, with the projection of the snap raster (and shape file)
+    :param shape_file: str, with the path to the shape file (None to only use the snap raster extent)
+    :param buffer: float, with the buffer around the target area in target CRS units (m)
+    :return: rasterio.windows.Window, with the lat/lon window (rows = latitude, columns = longitude)
+    """
+    left, top, right, bottom = get_target_extent(snap_data, shape_file)
+
+    # Transform the buffered extent to lat/lon (densified, since the edges are curved in lat/lon)
+    lon_min, lat_min, lon_max, lat_max = wrp.transform_bounds(snap_proj, '+proj=latlong', left - buffer,
+                                                              bottom - buffer, right + buffer, top + buffer,
+                                                              densify_pts=21)
 
-    :param ds: nc.Dataset, that contains land use classes (32 PFT bands)
+    # Convert to grid cells, round outwards and add one cell margin for the nearest neighbor reprojection
+    inverse_transform = ~get_nc_transform()
+    col_min, row_min = inverse_transform * (lon_min, lat_max)
+    col_max, row_max = inverse_transform * (lon_max, lat_min)
+    col_off = max(int(np.floor(col_min)) - 1, 0)
+    row_off = max(int(np.floor(row_min)) - 1, 0)
+    col_stop = min(int(np.ceil(col_max)) + 1, ds_lon)
+    row_stop = min(int(np.ceil(row_max)) + 1, ds_lat)
+
+    return wnd.Window(col_off, row_off, col_stop - col_off, row_stop - row_off)
+
+
+class CellIndexError(ValueError):
+    """
+    Raised if an nc file has values outside of the valid cell index of its grid (see apply_cfac_to_cells)
+    """
+
+
+def get_valid_cells(ds, ds_lon, ds_lat, window=None):
+    """
+    Calculates the valid cell index of a grid: the cells which have a value in at least one PFT band. Cells without a
+    value (ocean, no data) are recognized from the no data metadata of the nc file (_FillValue, missing_value,
+    valid_range), which the netCDF4 library applies as mask.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
     :param ds_lon: int, with the width in longitude degrees
     :param ds_lat: int, with the height in latitude degrees
-    :param c_fac_arr: np.array, with 32 rows and 3 columns. The rows have to align to the 32 PFT bands. The columns have to have [Name/index, C-factor summer value, C-factor winter value, ...]
-    :return: np.array, with c-factors (summer) accroding to lat and lon; np.array, with c-factors (winter) accroding to lat and lon
+    :param window: rasterio.windows.Window, (optional) lat/lon window of the index. If None, the whole grid
+    :return: np.array (int64), flat indices of the valid cells in the [lat, lon] array of the window (row major)
     """
-    merged_raster_summer = np.zeros([ds_lat, ds_lon], dtype=float, order='C')
-    merged_raster_winter = np.zeros([ds_lat, ds_lon], dtype=float, order='C')
+    if window is None:
+        window = wnd.Window(0, 0, ds_lon, ds_lat)
+    lon_slice = slice(window.col_off, window.col_off + window.width)
+    lat_slice = slice(window.row_off, window.row_off + window.height)
 
+    valid = np.zeros([window.width, window.height], dtype=bool)
     for pft_nr in range(len(ds.variables) - 2):
-        # Apply each C-Factors share to every pixel
-        r_fac_summer = ds.variables["PFT" + str(pft_nr)][:] / 100 * c_fac_arr.loc[pft_nr][1]
-        r_fac_winter = ds.variables["PFT" + str(pft_nr)][:] / 100 * c_fac_arr.loc[pft_nr][2]
+        valid |= ~np.ma.getmaskarray(ds.variables["PFT" + str(pft_nr)][lon_slice, lat_slice])
+    return np.flatnonzero(valid.T)
+
+
+def get_cfac_matrix(c_fac_arr):
+    """
+    Converts the C-factor table to a weight matrix. Each row aligns to a PFT band and each column to one C-factor set
+    (e.g. summer, winter). The division of the percent share by 100 is already included in the weights.
+
+    :param c_fac_arr: pd.DataFrame, with one row per PFT band and the columns [Name/index, C-factor 1, C-factor 2, ...]
+    :return: np.array, float32 with shape (number of PFT bands, number of C-factor sets)
+    """
+    return c_fac_arr.iloc[:, 1:].to_numpy(dtype=np.float32) / np.float32(100)
+
+
+def apply_cfac_to_block(ds, cfac_matrix, lon_slice, lat_slice, batch_size=cfac_batch_size):
+    """
+    Applys the C-factor matrix to one lat/lon block of the PFT bands (see apply_cfac_to_array).
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param cfac_matrix: np.array, with the C-factor weights (see get_cfac_matrix)
+    :param lon_slice: slice, longitude cells of the block
+    :param lat_slice: slice, latitude cells of the block
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    :return: tuple of np.arrays (float32), one array with c-factors according to lat and lon (of the block) for
+    each C-factor set (np.nan for cells without a value in all PFT bands)
+    """
+    pft_count = len(ds.variables) - 2
+    if cfac_matrix.shape[0] < pft_count:
+        raise ValueError("The C-factor table has " + str(cfac_matrix.shape[0]) + " rows, but the nc dataset contains "
+                         + str(pft_count) + " PFT bands")
+
+    block_lon = lon_slice.stop - lon_slice.start
+    block_lat = lat_slice.stop - lat_slice.start
+    batch_size = max(1, min(batch_size, pft_count))
+    merged_rasters = np.zeros([cfac_matrix.shape[1], block_lon, block_lat], dtype=np.float32, order='C')
+    pft_stack = np.empty([batch_size, block_lon, block_lat], dtype=np.float32, order='C')
+    valid = np.zeros([block_lon, block_lat], dtype=bool)
+
+    for batch_start in range(0, pft_count, batch_size):
+        batch_stop = min(batch_start + batch_size, pft_count)
+
+        # Read each PFT band once into the stack (no data cells have no share)
+        for stack_nr, pft_nr in enumerate(range(batch_start, batch_stop)):
+            pft_band = ds.variables["PFT" + str(pft_nr)][lon_slice, lat_slice]
+            pft_stack[stack_nr] = np.ma.filled(pft_band, 0)
+            valid |= ~np.ma.getmaskarray(pft_band)
+
+        # Weighted sum of the stacked bands for all C-factor sets: (sets x bands) . (bands x lon x lat)
+        merged_rasters += np.tensordot(cfac_matrix[batch_start:batch_stop].T, pft_stack[:batch_stop - batch_start],
+                                       axes=1)
+    merged_rasters[:, ~valid] = np.nan
+
+    # Data is fipped by 90° therefore rotate it (once per C-factor set)
+    return tuple(np.ascontiguousarray(merged_raster.T) for merged_raster in merged_rasters)
+
+
+def apply_cfac_to_cells(ds, cfac_matrix, lon_slice, lat_slice, cells, batch_size=cfac_batch_size):
+    """
+    Applys the C-factor matrix to the valid cells of one lat/lon block of the PFT bands (see get_valid_cells). Only the
+    values of the valid cells are stacked and weighted. The PFT bands are still read for the whole block, since the
+    cells outside of the index are checked for values (changed grid), so the saving is in the computation, not in the
+    reads.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param cfac_matrix: np.array, with the C-factor weights (see get_cfac_matrix)
+    :param lon_slice: slice, longitude cells of the block
+    :param lat_slice: slice, latitude cells of the block
+    :param cells: np.array (int64), flat indices of the valid cells in the [lat, lon] array of the block
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    :return: np.array (float32), with the C-factors of the valid cells (C-factor sets x cells, np.nan for cells without
+    a value in all PFT bands); boolean, True if a PFT band has values outside of the valid cells
+    """
+    pft_count = len(ds.variables) - 2
+    if cfac_matrix.shape[0] < pft_count:
+        raise ValueError("The C-factor table has " + str(cfac_matrix.shape[0]) + " rows, but the nc dataset contains "
+                         + str(pft_count) + " PFT bands")
+
+    block_lon = lon_slice.stop - lon_slice.start
+    block_lat = lat_slice.stop - lat_slice.start
+    # The PFT bands are stored as [lon, lat]: index of the valid cells in the flattened bands
+    rows, columns = np.divmod(cells, block_lon)
+    band_cells = columns * block_lat + rows
+    outside = np.ones(block_lon * block_lat, dtype=bool)
+    outside[band_cells] = False
+
+    batch_size = max(1, min(batch_size, pft_count))
+    values = np.zeros([cfac_matrix.shape[1], len(cells)], dtype=np.float32)
+    pft_stack = np.empty([batch_size, len(cells)], dtype=np.float32)
+    valid = np.zeros(len(cells), dtype=bool)
+    has_outside_values = False
+
+    for batch_start in range(0, pft_count, batch_size):
+        batch_stop = min(batch_start + batch_size, pft_count)
+
+        # Read each PFT band once and keep only the valid cells (no data cells have no share)
+        for stack_nr, pft_nr in enumerate(range(batch_start, batch_stop)):
+            pft_band = ds.variables["PFT" + str(pft_nr)][lon_slice, lat_slice]
+            band_valid = ~np.ma.getmaskarray(pft_band).ravel()
+            pft_stack[stack_nr] = np.ma.filled(pft_band, 0).ravel()[band_cells]
+            valid |= band_valid[band_cells]
+            has_outside_values = has_outside_values or bool(np.any(band_valid & outside))
+
+        # Weighted sum of the stacked cells for all C-factor sets: (sets x bands) . (bands x cells)
+        values += cfac_matrix[batch_start:batch_stop].T @ pft_stack[:batch_stop - batch_start]
+    values[:, ~valid] = np.nan
+    return values, has_outside_values
+
+
+def apply_cfac_to_array(ds, ds_lon, ds_lat, c_fac_arr, window=None, batch_size=cfac_batch_size, cells=None):
+    """
+    Applys the C-factor sets (e.g. summer and winter) based on a nc dataset that contains PFT bands. Each band contains
+    percent share of the land cover for each pixel. Based on the share the percentual C-factor is applied.
+
+    Every PFT band is read exactly once. The bands are stacked in batches of batch_size and multiplied with the
+    C-factor matrix, so all C-factor sets are produced in the same pass over the data.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param c_fac_arr: pd.DataFrame, with one row per PFT band. The rows have to align to the PFT bands. The columns
+    have to have [Name/index, C-factor set 1 (summer), C-factor set 2 (winter), ...]
+    :param window: rasterio.windows.Window, (optional) lat/lon window (rows = latitude, columns = longitude) which is
+    read from the PFT bands. If None, the whole grid is read
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    :param cells: np.array (int64), (optional) valid cell index of the window (see get_valid_cells). If given, only
+    the valid cells are computed
+    :return: tuple of np.arrays (float32), one array with c-factors according to lat and lon (of the window) for
+    each C-factor set (np.nan for cells without a value)
+    """
+    # The PFT bands are stored as [lon, lat], therefore the window columns slice the first dimension
+    if window is None:
+        window = wnd.Window(0, 0, ds_lon, ds_lat)
+    lon_slice = slice(window.col_off, window.col_off + window.width)
+    lat_slice = slice(window.row_off, window.row_off + window.height)
+
+    if cells is None:
+        return apply_cfac_to_block(ds, get_cfac_matrix(c_fac_arr), lon_slice, lat_slice, batch_size)
+
+    values, has_outside_values = apply_cfac_to_cells(ds, get_cfac_matrix(c_fac_arr), lon_slice, lat_slice, cells,
+                                                     batch_size)
+    if has_outside_values:
+        raise CellIndexError("The nc file has values outside of the valid cell index of the grid")
+    merged_rasters = np.full([values.shape[0], window.height, window.width], np.nan, dtype=np.float32)
+    merged_rasters.reshape(values.shape[0], -1)[:, cells] = values
+    return tuple(merged_rasters)
+
+
+def get_nc_chunk_shape(ds):
+    """
+    Returns the chunk size of the PFT bands in the nc file. Contiguous (not chunked) bands are read most efficiently
+    along the latitude (last) dimension, so a chunk of one longitude and all latitudes is returned for them.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :return: tuple, with the chunk size in longitude and latitude cells
+    """
+    variable = ds.variables["PFT0"]
+    chunking = variable.chunking()
+    if chunking == 'contiguous' or chunking is None:
+        return 1, variable.shape[1]
+    return int(chunking[0]), int(chunking[1])
+
 
-        # Data is fipped by 90° therefore rotate it
-        merged_raster_summer += np.transpose(r_fac_summer)
-        merged_raster_winter += np.transpose(r_fac_winter)
+def get_block_shape(ds, window, set_count, memory_limit=cfac_memory_limit, batch_size=cfac_batch_size):
+    """
+    Calculates the size of the blocks in which the C-factors of a window are computed, so that the arrays of one block
+    stay below a memory limit. The blocks are multiples of the nc chunks: first the latitude size is increased (up to
+    the window height), then the longitude size.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param window: rasterio.windows.Window, lat/lon window (rows = latitude, columns = longitude)
+    :param set_count: int, number of C-factor sets
+    :param memory_limit: float, memory limit of one block in MB
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    :return: tuple, with the block size in longitude and latitude cells
+    """
+    pft_count = len(ds.variables) - 2
+    # float32 cells of the PFT stack, the nc read buffer and per C-factor set the sum, the product and the rotated array
+    bytes_per_cell = 4 * (max(1, min(batch_size, pft_count)) + 2 + 3 * set_count)
+    max_cells = max(1, int(memory_limit * 1048576 / bytes_per_cell))
+
+    chunk_lon, chunk_lat = get_nc_chunk_shape(ds)
+    chunk_lon, chunk_lat = min(chunk_lon, window.width), min(chunk_lat, window.height)
+    if chunk_lon * chunk_lat > max_cells:
+        # Even a single chunk is above the limit: read parts of the chunks
+        chunk_lat = max(1, min(chunk_lat, max_cells))
+        return max(1, min(chunk_lon, max_cells // chunk_lat)), chunk_lat
+
+    block_lat = min(window.height, chunk_lat * max(1, max_cells // (chunk_lon * chunk_lat)))
+    block_lon = min(window.width, chunk_lon * max(1, max_cells // (chunk_lon * block_lat)))
+    return block_lon, block_lat
+
+
+def iter_cfac_blocks(ds, ds_lon, ds_lat, c_fac_arr, window=None, memory_limit=cfac_memory_limit,
+                     batch_size=cfac_batch_size):
+    """
+    Applys the C-factor sets block by block (see apply_cfac_to_array), so that the memory use does not depend on the
+    grid size. The block boundaries are aligned to the chunks of the nc file, so that every chunk is read only once.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param c_fac_arr: pd.DataFrame, with one row per PFT band (see apply_cfac_to_array)
+    :param window: rasterio.windows.Window, (optional) lat/lon window which is processed. If None, the whole grid
+    :param memory_limit: float, memory limit of one block in MB
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    :return: generator of (rasterio.windows.Window, tuple of np.arrays), with the block window relative to the window
+    and the C-factors of the block (lat/lon, float32) for each C-factor set
+    """
+    if window is None:
+        window = wnd.Window(0, 0, ds_lon, ds_lat)
+    cfac_matrix = get_cfac_matrix(c_fac_arr)
+    block_lon, block_lat = get_block_shape(ds, window, cfac_matrix.shape[1], memory_limit, batch_size)
+    chunk_lon, chunk_lat = get_nc_chunk_shape(ds)
+
+    # Block boundaries on the global grid: multiples of the block size, starting at the chunk before the window
+    col_start = window.col_off - window.col_off % min(chunk_lon, block_lon)
+    row_start = window.row_off - window.row_off % min(chunk_lat, block_lat)
+    col_stop = window.col_off + window.width
+    row_stop = window.row_off + window.height
+    for col in range(col_start, col_stop, block_lon):
+        lon_slice = slice(max(col, window.col_off), min(col + block_lon, col_stop))
+        for row in range(row_start, row_stop, block_lat):
+            lat_slice = slice(max(row, window.row_off), min(row + block_lat, row_stop))
+            block_window = wnd.Window(lon_slice.start - window.col_off, lat_slice.start - window.row_off,
+                                      lon_slice.stop - lon_slice.start, lat_slice.stop - lat_slice.start)
+            yield block_window, apply_cfac_to_block(ds, cfac_matrix, lon_slice, lat_slice, batch_size)
+
+
+def export_cfac_blocks(ds, ds_lon, ds_lat, c_fac_arr, export_files, window=None, memory_limit=cfac_memory_limit,
+                       batch_size=cfac_batch_size):
+    """
+    Applys the C-factor sets block by block (see iter_cfac_blocks) and writes each block directly to the GEOTIFF of its
+    C-factor set (proj=latlong, as export_to_tif). The full C-factor arrays are never held in memory.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param c_fac_arr: pd.DataFrame, with one row per PFT band (see apply_cfac_to_array)
+    :param export_files: list, with the paths of the GEOTIFFs (one per C-factor set, None if a set is not exported)
+    :param window: rasterio.windows.Window, (optional) lat/lon window which is processed. If None, the whole grid
+    :param memory_limit: float, memory limit of one block in MB
+    :param batch_size: int, number of PFT bands which are stacked and weighted at once
+    """
+    if window is None:
+        window = wnd.Window(0, 0, ds_lon, ds_lat)
+    profile = {
+        'driver': 'GTiff',
+        'height': window.height,
+        'width': window.width,
+        'count': 1,
+        'dtype': 'float32',
+        'transform': get_nc_transform(window),
+        'crs': '+proj=latlong',
+        'nodata': np.nan,
+    }
+    profile.update(go.get_rasterio_profile())  # compression
+    profile.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256})  # blocks only touch the tiles they cover
 
-    return merged_raster_summer, merged_raster_winter
+    destinations = []
+    try:
+        for export_file in export_files:
+            destinations.append(None if export_file is None else rio.open(export_file, 'w', **profile))
+        for block_window, merged_blocks in iter_cfac_blocks(ds, ds_lon, ds_lat, c_fac_arr, window, memory_limit,
+                                                            batch_size):
+            for destination, merged_block in zip(destinations, merged_blocks):
+                if destination is not None:
+                    destination.write(merged_block, 1, window=block_window)
+    finally:
+        for destination in destinations:
+            if destination is not None:
+                destination.close()
 
 
-def export_to_tif(ds_lon, ds_lat, merged_raster, export_file):
+def export_to_tif(ds_lon, ds_lat, merged_raster, export_file, window=None):
     """
     Converts a raster array to a GEOTIFF file and exports it to the given location. The export is safed as proj=latlong
     in the cordinate system epsg:4326
@@ -50,10 +389,12 @@ def export_to_tif(ds_lon, ds_lat, merged_raster, export_file):
     :param ds_lat: int, with the height in latitude degrees
     :param merged_raster: np.array, with the C-factors for each pixel
     :param export_file: str, with the new path to the GEOTIFF
+    :param window: rasterio.windows.Window, (optional) lat/lon window which the merged raster covers
     """
-    # create the transform for the base matrix in lat/long projection
-    transform = rio.transform.Affine.translation(-180, 90) * rio.transform.Affine.scale(0.05000000120000000492,
-                                                                          -0.05000000119999999798)
+    # create the transform for the base matrix (or window) in lat/long projection
+    transform = get_nc_transform(window)
+    if window is not None:
+        ds_lon, ds_lat = window.width, window.height
 
     dst_crs = '+proj=latlong'
     #dst_crs = "EPSG:32634"
@@ -64,33 +405,43 @@ def export_to_tif(ds_lon, ds_lat, merged_raster, export_file):
         'width': ds_lon,
         'count': 1,
         'dtype': str(merged_raster.dtype),
-        'transform': transform
+        'transform': transform,
+        'nodata': np.nan,
     }
+    profile.update(go.get_rasterio_profile())  # tiling and compression
 
     with rio.open(export_file, 'w', crs=dst_crs, **profile) as dst:
         dst.write(merged_raster, 1)
 
 
-def transform_to_target_crs(src_file, dst_file, dst_crs):
+def transform_to_target_crs(src_file, dst_file, dst_crs, warp_mem_limit=0, num_threads=1, dst_grid=None):
     """
     Transformes a GEOTIFF file to the target crs system.
 
     :param src_file: str, with the path to the original GEOTIFF
     :param dst_file: str, with the path to the new GEOTIFF
     :param dst_crs: str, with the new crs system
+    :param warp_mem_limit: int, (optional) working memory of the reprojection in MB (0: gdal default). The reprojection
+    is done in chunks of this size, so the raster does not have to fit into memory
+    :param num_threads: int, (optional) number of threads of the reprojection
+    :param dst_grid: tuple, (optional) fixed target grid (transform, width, height, see calculate_target_grid). If
+    None, the target grid covers the whole source raster
     """
     with rio.open(src_file) as src:
         # transform for input raster
         src_transform = src.transform
 
-        # calculate the transform matrix for the output
-        dst_transform, width, height = wrp.calculate_default_transform(
-            src.crs,  # source CRS
-            dst_crs,  # destination CRS
-            src.width,  # column count
-            src.height,  # row count
-            *src.bounds,  # unpacks outer boundaries (left, bottom, right, top)
-        )
+        if dst_grid is not None:
+            dst_transform, width, height = dst_grid
+        else:
+            # calculate the transform matrix for the output
+            dst_transform, width, height = wrp.calculate_default_transform(
+                src.crs,  # source CRS
+                dst_crs,  # destination CRS
+                src.width,  # column count
+                src.height,  # row count
+                *src.bounds,  # unpacks outer boundaries (left, bottom, right, top)
+            )
 
         if USELOG:
             print("Source Transform:\n", src_transform, '\n')
@@ -104,9 +455,10 @@ def transform_to_target_crs(src_file, dst_file, dst_crs):
                 "transform": dst_transform,
                 "width": width,
                 "height": height,
-                "nodata": -9999,  # replace 0 with np.nan
+                "nodata": np.nan,
             }
         )
+        dst_kwargs.update(go.get_rasterio_profile())  # tiling and compression
 
         with rio.open(dst_file, "w", **dst_kwargs) as dst:
             for i in range(1, src.count + 1):
@@ -118,9 +470,182 @@ def transform_to_target_crs(src_file, dst_file, dst_crs):
                     dst_transform=dst_transform,
                     dst_crs=dst_crs,
                     resampling=Resampling.nearest,
+                    warp_mem_limit=warp_mem_limit,
+                    num_threads=num_threads,
                 )
 
 
+def get_target_transform(src_shape, src_transform, src_crs, dst_crs):
+    """
+    Calculates the transform and size of the grid in the target crs system, which covers a source grid.
+
+    :param src_shape: tuple, with the number of rows and columns of the source grid
+    :param src_transform: rasterio.transform.Affine, with the transform of the source grid
+    :param src_crs: str, with the source crs system
+    :param dst_crs: str, with the new crs system
+    :return: rasterio.transform.Affine, with the transform of the target grid; int, with the width; int, with the height
+    """
+    src_height, src_width = src_shape
+
+    # calculate the transform matrix for the output
+    return wrp.calculate_default_transform(
+        src_crs,  # source CRS
+        dst_crs,  # destination CRS
+        src_width,  # column count
+        src_height,  # row count
+        *rio.transform.array_bounds(src_height, src_width, src_transform),  # (left, bottom, right, top)
+    )
+
+
+def reproject_array(src_array, src_transform, src_crs, dst_crs):
+    """
+    Transformes a raster array (in memory) to the target crs system. Cells of the target grid which are not covered by
+    the source array are set to np.nan.
+
+    :param src_array: np.array, with the raster data in the source crs system
+    :param src_transform: rasterio.transform.Affine, with the transform of the source array
+    :param src_crs: str, with the source crs system
+    :param dst_crs: str, with the new crs system
+    :return: np.array (float32), with the raster data in the new crs system; rasterio.transform.Affine, with the
+    transform of the new array
+    """
+    dst_transform, width, height = get_target_transform(src_array.shape, src_transform, src_crs, dst_crs)
+
+    if USELOG:
+        print("Source Transform:\n", src_transform, '\n')
+        print("Destination Transform:\n", dst_transform)
+
+    dst_array = np.full([height, width], np.nan, dtype=np.float32)
+    wrp.reproject(
+        source=src_array,
+        destination=dst_array,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        src_nodata=np.nan,
+        dst_nodata=np.nan,
+        resampling=Resampling.nearest,
+    )
+
+    return dst_array, dst_transform
+
+
+def calculate_target_grid(snap_data, snap_proj, shape_file, buffer, dst_crs):
+    """
+    Calculates the fixed grid in the target crs system, which covers the target area (snap raster and shape file
+    extent) plus a buffer. The cell size is the size of an nc cell in the target crs system (as calculated by
+    get_target_transform for the target area), so the grid does not depend on the nc files.
+
+    :param snap_data: list, with snap raster extension [ulX ulY lrX lrY]
+    :param snap_proj: str, with the projection of the snap raster (and shape file)
+    :param shape_file: str, with the path to the shape file (None to only use the snap raster extent)
+    :param buffer: float, with the buffer around the target area in target CRS units (m)
+    :param dst_crs: str, with the target crs system
+    :return: rasterio.transform.Affine, with the transform of the target grid; int, with the width; int, with the height
+    """
+    left, top, right, bottom = get_target_extent(snap_data, shape_file)
+    left, bottom, right, top = wrp.transform_bounds(snap_proj, dst_crs, left - buffer, bottom - buffer,
+                                                    right + buffer, top + buffer, densify_pts=21)
+
+    # Cell size of the nc grid in the target crs system
+    nc_transform = get_nc_transform()
+    lon_min, lat_min, lon_max, lat_max = wrp.transform_bounds(dst_crs, '+proj=latlong', left, bottom, right, top,
+                                                              densify_pts=21)
+    src_width = max(int(np.ceil((lon_max - lon_min) / nc_transform.a)), 1)
+    src_height = max(int(np.ceil((lat_max - lat_min) / -nc_transform.e)), 1)
+    default_transform, _, _ = wrp.calculate_default_transform('+proj=latlong', dst_crs, src_width, src_height,
+                                                              lon_min, lat_min, lon_max, lat_max)
+    cell_size = default_transform.a
+
+    width = int(np.ceil((right - left) / cell_size))
+    height = int(np.ceil((top - bottom) / cell_size))
+    return rio.transform.from_origin(left, top, cell_size, cell_size), width, height
+
+
+def calculate_pixel_mapping(dst_grid, dst_crs, block_rows=256):
+    """
+    Calculates the nearest neighbor mapping of a target grid onto the nc grid: for every target cell, the nc cell which
+    contains its center (same as the nearest resampling of wrp.reproject). The cell centers are transformed in blocks
+    of rows.
+
+    :param dst_grid: tuple, with the target grid (transform, width, height, see calculate_target_grid)
+    :param dst_crs: str, with the target crs system
+    :param block_rows: int, (optional) number of target rows which are transformed at once
+    :return: np.array (int32), with the nc row of every target cell; np.array (int32), with the nc column of every
+    target cell (both [height, width], -1 outside of the nc grid)
+    """
+    dst_transform, width, height = dst_grid
+    inverse_nc_transform = ~get_nc_transform()
+    nc_rows = np.full([height, width], -1, dtype=np.int32)
+    nc_columns = np.full([height, width], -1, dtype=np.int32)
+
+    x_centers = dst_transform.c + (np.arange(width) + 0.5) * dst_transform.a
+    for row_start in range(0, height, block_rows):
+        row_stop = min(row_start + block_rows, height)
+        y_centers = dst_transform.f + (np.arange(row_start, row_stop) + 0.5) * dst_transform.e
+        xs, ys = np.meshgrid(x_centers, y_centers)
+        lons, lats = wrp.transform(dst_crs, '+proj=latlong', xs.ravel(), ys.ravel())
+        columns, rows = inverse_nc_transform * (np.asarray(lons), np.asarray(lats))
+        columns = np.floor(columns).reshape(xs.shape)
+        rows = np.floor(rows).reshape(xs.shape)
+        inside = np.isfinite(columns) & np.isfinite(rows)
+        nc_columns[row_start:row_stop][inside] = columns[inside]
+        nc_rows[row_start:row_stop][inside] = rows[inside]
+    return nc_rows, nc_columns
+
+
+def get_window_index(nc_rows, nc_columns, window, window_shape):
+    """
+    Converts a pixel mapping (see calculate_pixel_mapping) to flat indices into the array of a lat/lon window.
+
+    :param nc_rows: np.array (int32), with the nc row of every target cell
+    :param nc_columns: np.array (int32), with the nc column of every target cell
+    :param window: rasterio.windows.Window, lat/lon window of the array (None for the whole grid)
+    :param window_shape: tuple, with the number of rows and columns of the array
+    :return: np.array (int64), with the flat index of every target cell into the array (0 if not covered); np.array
+    (bool), True for the target cells covered by the array
+    """
+    rows = nc_rows.astype(np.int64) - (window.row_off if window is not None else 0)
+    columns = nc_columns.astype(np.int64) - (window.col_off if window is not None else 0)
+    covered = (nc_rows >= 0) & (rows >= 0) & (rows < window_shape[0]) & (columns >= 0) & (columns < window_shape[1])
+    flat_index = np.where(covered, rows * window_shape[1] + columns, 0)
+    return flat_index, covered
+
+
+def reproject_to_grid(src_array, flat_index, covered, num_threads=1, block_size=1048576):
+    """
+    Transformes a raster array (in memory) to a fixed target grid with a precalculated pixel mapping (see
+    get_window_index). The cells are gathered in blocks by a pool of threads (np.take releases the GIL). Cells of the
+    target grid which are not covered by the source array are set to np.nan.
+
+    :param src_array: np.array, with the raster data of the lat/lon window
+    :param flat_index: np.array (int64), with the flat index of every target cell into src_array
+    :param covered: np.array (bool), True for the target cells covered by src_array
+    :param num_threads: int, (optional) number of threads
+    :param block_size: int, (optional) number of target cells which are gathered at once by a thread
+    :return: np.array (float32), with the raster data on the target grid
+    """
+    src_flat = np.ascontiguousarray(src_array, dtype=np.float32).ravel()
+    index = flat_index.ravel()
+    dst_flat = np.empty(index.size, dtype=np.float32)
+
+    def gather(start):
+        np.take(src_flat, index[start:start + block_size], out=dst_flat[start:start + block_size])
+
+    starts = range(0, index.size, block_size)
+    if num_threads > 1 and len(starts) > 1:
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(gather, starts))
+    else:
+        for start in starts:
+            gather(start)
+
+    dst_array = dst_flat.reshape(flat_index.shape)
+    dst_array[~covered] = np.nan
+    return dst_array
+
+
 def get_file_str(file_path):
     """
     Returns the file name of an entire file path.
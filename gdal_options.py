@@ -0,0 +1,135 @@
+"""
+Module contains the shared options of the GDAL calls (gdal.Grid, gdal.Warp, gdal.Translate, raster creation). All
+stages use the in-process GDAL bindings with these options instead of the command line tools, so that the number of
+threads, the warp memory, the block cache and the creation options are set in one place (see the GDAL settings in
+config.py). GDAL errors raise exceptions (RuntimeError) instead of returning None.
+
+The clipped outputs are written with the output profile (output_profile):
+- 'plain': striped, uncompressed GeoTIFF
+- 'tiled': tiled GeoTIFF with compression, floating point predictor and internal overviews
+- 'cog': Cloud-Optimized GeoTIFF (tiled, compressed, with predictor and internal overviews)
+"""
+from config import *
+
+_configured = False
+
+# Overview levels of the tiled GeoTIFF outputs (the COG driver chooses them itself)
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
+
+def configure_gdal():
+    """
+    Sets the process wide GDAL configuration (exceptions, threads, block cache). The configuration is only set once
+    per process.
+    """
+    global _configured
+    if _configured:
+        return
+    gdal.UseExceptions()
+    ogr.UseExceptions()
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(gdal_num_threads))
+    gdal.SetCacheMax(int(gdal_cache_max) * 1048576)
+    _configured = True
+
+
+def get_creation_options():
+    """
+    Returns the creation options of the GeoTIFFs written by GDAL.
+
+    :return: list, with the creation options (KEY=VALUE)
+    """
+    configure_gdal()
+    return list(gdal_creation_options) + ['NUM_THREADS=' + str(gdal_num_threads)]
+
+
+def get_output_options():
+    """
+    Returns the driver and the creation options of the clipped outputs (see output_profile).
+
+    :return: str, with the GDAL driver name; list, with the creation options (KEY=VALUE)
+    """
+    if output_profile not in ('plain', 'tiled', 'cog'):
+        raise ValueError("Unknown output_profile '" + str(output_profile) + "' (plain, tiled or cog)")
+    if output_profile == 'plain':
+        return "GTiff", get_creation_options()
+
+    options = ['COMPRESS=' + output_compression, 'NUM_THREADS=' + str(gdal_num_threads), 'BIGTIFF=IF_SAFER']
+    if output_compression.upper() in ('DEFLATE', 'ZSTD', 'LZW', 'LZMA'):
+        options.append('PREDICTOR=' + ('YES' if output_profile == 'cog' else '3'))  # floating point predictor
+    if output_compression.upper() in ('DEFLATE', 'ZSTD') and output_compression_level is not None:
+        # LEVEL is only a COG option, the GTiff driver has one level option per compression
+        if output_profile == 'cog':
+            level_option = 'LEVEL='
+        else:
+            level_option = 'ZLEVEL=' if output_compression.upper() == 'DEFLATE' else 'ZSTD_LEVEL='
+        options.append(level_option + str(output_compression_level))
+    if output_profile == 'cog':
+        return "COG", options + ['BLOCKSIZE=' + str(output_block_size),
+                                 'OVERVIEWS=' + ('AUTO' if output_overviews else 'NONE'),
+                                 'OVERVIEW_RESAMPLING=AVERAGE']
+    return "GTiff", options + ['TILED=YES', 'BLOCKXSIZE=' + str(output_block_size),
+                               'BLOCKYSIZE=' + str(output_block_size)]
+
+
+def get_output_kwargs():
+    """
+    Returns the keyword arguments of raster_calculations.array_to_raster for the clipped outputs (driver, creation
+    options and overview levels of the output profile).
+
+    :return: dict, with keyword arguments of raster_calculations.array_to_raster
+    """
+    driver_name, options = get_output_options()
+    return {
+        "driver_name": driver_name,
+        "options": options,
+        # The COG driver builds its overviews itself
+        "overview_levels": OVERVIEW_LEVELS if output_profile == 'tiled' and output_overviews else None,
+    }
+
+
+def get_rasterio_profile():
+    """
+    Returns the compression and tiling of the intermediate GeoTIFFs written with rasterio (same compression as the
+    outputs, tiled unless output_profile='plain').
+
+    :return: dict, with rasterio profile items
+    """
+    if output_profile == 'plain':
+        return {}
+    profile = {'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': output_compression.lower()}
+    if output_compression.upper() in ('DEFLATE', 'ZSTD', 'LZW', 'LZMA'):
+        profile['predictor'] = 3
+    return profile
+
+
+def get_warp_kwargs(output=False):
+    """
+    Returns the options of gdal.Warp: multithreaded warping with the warp memory limit and the creation options.
+
+    :param output: boolean, if True the driver and creation options of the output profile are used (clipped outputs)
+    :return: dict, with keyword arguments of gdal.Warp (gdal.WarpOptions)
+    """
+    configure_gdal()
+    warp_kwargs = {
+        "multithread": True,
+        "warpMemoryLimit": gdal_warp_memory,  # MB
+        "warpOptions": ['NUM_THREADS=' + str(gdal_num_threads)],
+        "creationOptions": get_creation_options(),
+    }
+    if output:
+        warp_kwargs["format"], warp_kwargs["creationOptions"] = get_output_options()
+    return warp_kwargs
+
+
+def get_grid_kwargs(raster_format='GTiff'):
+    """
+    Returns the options of gdal.Grid (the grid algorithms use the threads of GDAL_NUM_THREADS).
+
+    :param raster_format: str, GDAL driver of the interpolated raster ('GTiff' gets the creation options)
+    :return: dict, with keyword arguments of gdal.Grid (gdal.GridOptions)
+    """
+    configure_gdal()
+    grid_kwargs = {"format": raster_format, "outputType": gdal.GDT_Float32}
+    if raster_format == 'GTiff':
+        grid_kwargs["creationOptions"] = get_creation_options()
+    return grid_kwargs
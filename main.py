@@ -4,117 +4,230 @@ a percentual share for the land use class (PFT0 - PFT32). The land use bands are
 the given csv file (c_fac_file) and are merged to one band which contains the sum of C-Factors based on their share.
 The Raster is saved to a latitude-longitude-projection and later transferred to the target CRS (EPSG:32634). Based on the
 snap file (snapraster_file) the area is interpolated (gdal_grid; invdistnn) and clipped along the given shape file. The
-final file is exported in the export folder.
+final file is exported in the export folder. The processing steps are found in pipeline.py (in memory or with
+intermediate files on disk, see INMEMORY).
 
 Needed information:
-- See config.py file
+- See config.py file. The paths and all other settings of config.py can be overridden on the command line, e.g.:
+  python main.py --lu-path /data/SSP1_RCP2_6 --export-folder /data/export --set n_workers=4 --set USELOG=false
+- python main.py --plan lists the nc files and outputs which would be processed, without loading the raster libraries
 """
 # Import files
-from functions import *
-from config import *
-import raster_calculations as rc
-import resample_snap as rs
-
-start_time = time.time()
-
-if not (os.path.exists(lu_path)):
-    raise Exception("The folder '" + lu_path + "' does not exist")
-
-if not (os.path.exists(export_folder)):
-    os.makedirs(export_folder)
-if not (os.path.exists(tmp_folder)):
-    os.makedirs(tmp_folder)
-
-# Get C-factor values correlating to land use
-c_factor = pd.read_csv(c_fac_file, header=0, delimiter=',', usecols=[1, 2, 3], )
-
-# Get projection and geotransform from the snap raster:
-gt, proj, snap_data, cell_resolution = rc.get_snap_raster_data(snapraster_file)
-
-
-# Iterate over all available NC-files
-filenames = glob.glob(lu_path + "/*.nc")
-for i, nc_file in enumerate(filenames):
-    print("File: " + nc_file)
-
-    # Extract current file name
-    nc_alias = get_file_str(nc_file)
-
-    # Extract NC-data
-    print("Importing NC file ...")
-    ds, ds_lon, ds_lat = extract_nc_data_to_array(nc_file)
-
-    # Apply the C-factors based on the pixels share and season
-    print("Applying C Factors ...")
-    summer_array, winter_array = apply_cfac_to_array(ds, ds_lon, ds_lat, c_factor)
-
-    for season_array, season_alias in zip([summer_array, winter_array], ["summer", "winter"]):
-
-        # Define files
-        interpolation_file = tmp_folder + '/' + nc_alias + "_" + season_alias + '_interpolation.tif'
-        season_file_epsg4326 = tmp_folder + '/' + nc_alias + "_" + season_alias + "_epsg4326.tif"
-        season_file_epsg32634 = tmp_folder + '/' + nc_alias + "_" + season_alias + "_epsg32634.tif"
-
-        season_file_finalized = export_folder + '/' + nc_alias + "_" + season_alias + "_clip.tif"
-
-        # Export the finalized tif
-        print(season_alias + ", Exporting epsg:4326 ...")
-        export_to_tif(ds_lon, ds_lat, season_array, season_file_epsg4326)
-
-        # Change to the target CRS 32634 (18°E - 24°E)
-        print(season_alias + ", Exporting epsg:32634 ...")
-        transform_to_target_crs(season_file_epsg4326, season_file_epsg32634, "EPSG:32634")
-
-        # Save raster data to an array
-        print(season_alias + ", Importing Raster ...")
-        original_array = rc.raster_to_array(season_file_epsg32634, mask=False)
-
-        # Convert all -9999 No data cells into numpy nan values
-        original_array = np.where(original_array == 9.96921e+36, np.nan, original_array)
-
-        # Get the gt (geotransform) information from the original raster file
-        gt_original, proj_original = rc.get_raster_data(season_file_epsg32634)  # Get gt information from the ASCII file
-
-        # Get the coordinates of the center of all the cells WITH VALUES and save data the XYZ coordinates for each point to an array
-        print(season_alias + ", Preparing CSV ...")
-        xyz_array = rs.get_raster_points(original_array, gt_original)  # Path with the .csv file with coordinates
-
-        # Save the XYZ coordinate data to a .csv file
-        print(season_alias + ", Exporting CSV ...")
-        rs.save_csv(xyz_array, xyz_csv_file)  # Save array to .csv file
-
-        # Create a .vrt file from the .csv in order to be read by the gdal grid command
-        print(season_alias + ", Generating VRT ...")
-        xyz_vrt_file = rs.generate_vrt_file(xyz_csv_file)
-
-        # Interpolate and resample points using GDAL_Grid - for interpolation a brush is used to merge the pixels
-        print(season_alias + ", Interpolating target area...")
-        rs.interpolate_points(xyz_vrt_file, interpolation_file, snap_data, cell_resolution)
-
-        # Clip the resampled raster to the extent of the shape file
-        print(season_alias + ", Clipping target area...")
-        rc.clip(shape_file, season_file_finalized, interpolation_file)
-
-        print(season_alias + ", Erasing tmp ...")
-        # Erase .csv file with points
-        if os.path.exists(xyz_csv_file):
-            os.remove(xyz_csv_file)
-
-        # Erase the vrt file
-        if os.path.exists(xyz_vrt_file):
-            os.remove(xyz_vrt_file)
-
-        if not (USELOG):
-            # Erase the interpolation file
-            if os.path.exists(interpolation_file):
-                os.remove(interpolation_file)
-
-            # Erase the epsg:4326 tif
-            if os.path.exists(season_file_epsg4326):
-                os.remove(season_file_epsg4326)
-
-            # Erase the epsg:32634 tif
-            if os.path.exists(season_file_epsg32634):
-                os.remove(season_file_epsg32634)
-
-print('Total time: ', time.time() - start_time)
+import argparse
+import config
+
+# Command line options of the paths (option: setting of config.py)
+PATH_OPTIONS = {
+    "--lu-path": "lu_path",
+    "--export-folder": "export_folder",
+    "--tmp-folder": "tmp_folder",
+    "--c-fac-file": "c_fac_file",
+    "--shape-file": "shape_file",
+    "--snapraster-file": "snapraster_file",
+}
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+
+    :param argv: list, (optional) with the arguments (default: sys.argv)
+    :return: argparse.Namespace, with the arguments
+    """
+    parser = argparse.ArgumentParser(description="Creates clipped C-factor rasters from land use projections (.nc)")
+    parser.add_argument("--plan", "--dry-run", action="store_true", dest="plan",
+                        help="list the nc files and outputs to process without processing them")
+    for option, setting in PATH_OPTIONS.items():
+        parser.add_argument(option, dest=setting, help="overrides " + setting + " of config.py")
+    parser.add_argument("--workers", type=int, dest="n_workers", help="overrides n_workers of config.py")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="overrides any setting of config.py (can be repeated), e.g. --set USEBLOCKS=true")
+    return parser.parse_args(argv)
+
+
+def get_overrides(args):
+    """
+    Returns the setting overrides of the command line arguments (see config.apply_overrides).
+
+    :param args: argparse.Namespace, with the arguments (see parse_args)
+    :return: dict, with the setting names and their values as text
+    """
+    overrides = {}
+    for assignment in args.set:
+        name, separator, value = assignment.partition("=")
+        if not separator:
+            raise ValueError("Expected NAME=VALUE, not '" + assignment + "'")
+        overrides[name.strip()] = value
+    for setting in list(PATH_OPTIONS.values()) + ["n_workers"]:
+        if getattr(args, setting) is not None:
+            overrides[setting] = str(getattr(args, setting))
+    return overrides
+
+
+def get_work(context):
+    """
+    Returns the nc files of lu_path and the seasons to process for each of them (in incremental mode only the outputs
+    which are not up to date).
+
+    :param context: dict, with the processing context (at least the export and tmp folder, see pipeline.load_context)
+    :return: list, with the paths of all nc files; dict, with the names of the seasons to process for each nc file;
+    tuple, (manifest, manifest path, config hash) or None if INCREMENTAL=False
+    """
+    import pipeline as pl
+    import manifest as mf
+    import sharding as sh
+
+    filenames = sorted(config.glob.glob(config.lu_path + "/*.nc"))
+    incremental_state = None
+    if config.INCREMENTAL:
+        manifest_path = mf.get_manifest_path(config.export_folder)
+        manifest = mf.load_manifest(manifest_path)
+        config_hash = mf.get_config_hash(config.c_fac_file, config.shape_file, config.snapraster_file)
+        seasons = pl.get_stale_seasons(filenames, manifest, config_hash, context)
+        incremental_state = (manifest, manifest_path, config_hash)
+    else:
+        seasons = {nc_file: list(config.season_aliases) for nc_file in filenames}
+    if config.shard_mode == 'static':
+        seasons = sh.filter_static_tasks(seasons)
+    return filenames, seasons, incremental_state
+
+
+def plan():
+    """
+    Prints the work of a run (nc files, outputs to process and up to date outputs) without reading any nc file or
+    raster.
+    """
+    import pipeline as pl
+    import sharding as sh
+
+    sh.check_settings()
+    if not (config.os.path.exists(config.lu_path)):
+        raise Exception("The folder '" + config.lu_path + "' does not exist")
+    # Only the folders of the context are needed to derive the output paths
+    context = {"export_folder": config.export_folder, "tmp_folder": config.tmp_folder}
+    try:
+        filenames, seasons, incremental_state = get_work(context)
+    except FileNotFoundError as e:  # inputs of the config hash (INCREMENTAL)
+        raise Exception("The input '" + str(e.filename) + "' does not exist (c_fac_file, shape_file and "
+                        "snapraster_file are needed to check which outputs are up to date)") from e
+    n_tasks = sum(len(file_seasons) for file_seasons in seasons.values())
+    print("nc files in " + config.lu_path + ": " + str(len(filenames)))
+    for nc_file in filenames:
+        nc_alias = pl.get_file_str(nc_file)
+        for season_alias in config.season_aliases:
+            if season_alias in seasons[nc_file]:
+                state = "process"
+            elif config.shard_mode == 'static' and not sh.is_own_task(nc_file, season_alias):
+                state = "other shard"
+            else:
+                state = "up to date"
+            print(" - " + nc_alias + ", " + season_alias + ": " + state + " -> " +
+                  pl.get_season_files(nc_alias, season_alias, context)["finalized"])
+    print("Outputs to process: " + str(n_tasks) + ", up to date: " +
+          str(len(filenames) * len(config.season_aliases) - n_tasks))
+    if config.shard_mode == 'dynamic':
+        print("Dynamic sharding: the outputs to process are claimed at run time by the nodes")
+    elif config.shard_mode == 'static':
+        print("Static sharding: shard " + str(config.shard_index) + " of " + str(config.shard_count))
+    print("Modes: INMEMORY=" + str(config.INMEMORY) + ", USEOPERATOR=" + str(config.USEOPERATOR) + ", USEBLOCKS=" +
+          str(config.USEBLOCKS) + ", INCREMENTAL=" + str(config.INCREMENTAL) + ", workers=" + str(config.n_workers))
+
+
+def write_run_outputs(results, scenarios, context):
+    """
+    Writes the outputs of a run which follow the processing of the nc files: the statistics of the clipped rasters
+    (run_statistics and, with USEFEATURES=True, zonal_statistics in export_folder), the interpolated years (TEMPORAL)
+    and the scenario stacks (STACKOUTPUT). Used by run and by the worker after every batch (see worker.process_files).
+
+    :param results: list of dicts, with the task results (see pipeline.get_task_result)
+    :param scenarios: list, with the paths of all nc files of each scenario folder (also the up to date ones)
+    :param context: dict, with the processing context (see pipeline.load_context)
+    """
+    import pipeline as pl
+    import stacking as st
+    import sharding as sh
+    import temporal as tp
+
+    pl.print_statistics_table(results)
+    pl.write_run_statistics(results, sh.get_report_path(config.export_folder + '/run_statistics', '.csv'))
+    if config.USEFEATURES:
+        pl.write_zonal_statistics(results, sh.get_report_path(config.export_folder + '/zonal_statistics', '.csv'))
+    if (config.TEMPORAL or config.STACKOUTPUT) and config.shard_mode is not None:
+        print("The interpolated years and scenario stacks are not built by sharded runs (other nodes may still be "
+              "processing)")
+        return
+    for all_filenames in scenarios:
+        if config.TEMPORAL:
+            # From the clipped rasters of all projection years (also the up to date ones)
+            tp.interpolate_scenario(all_filenames, context, config.temporal_step)
+        if config.STACKOUTPUT:
+            # All nc files of the scenario: in incremental mode the up to date outputs are part of the stacks as well
+            st.stack_scenario(all_filenames, context)
+
+
+def run():
+    """
+    Processes the nc files of lu_path (see the module description).
+    """
+    import pipeline as pl
+    import profiling as prof
+    import sharding as sh
+
+    sh.check_settings()
+    start_time = config.time.time()
+
+    if not (config.os.path.exists(config.lu_path)):
+        raise Exception("The folder '" + config.lu_path + "' does not exist")
+
+    if not (config.os.path.exists(config.export_folder)):
+        config.os.makedirs(config.export_folder)
+    if not (config.os.path.exists(config.tmp_folder)):
+        config.os.makedirs(config.tmp_folder)
+
+    # Get C-factor values and the projection and geotransform from the snap raster
+    context = pl.load_context(config.c_fac_file, config.snapraster_file, config.shape_file, config.export_folder,
+                              config.tmp_folder)
+
+    # Incremental mode: only process the seasons of the nc files which are not up to date (static sharding: of this
+    # shard)
+    all_filenames, seasons, incremental_state = get_work(context)
+    filenames = [nc_file for nc_file in all_filenames if seasons[nc_file]]
+    on_results = None
+    if incremental_state is not None:
+        print("Up to date: " + str(sum(len(config.season_aliases) - len(stale) for stale in seasons.values())) +
+              " outputs, to process: " + str(sum(len(stale) for stale in seasons.values())) + " outputs")
+        # The manifest is saved after every nc file
+        on_results = pl.get_manifest_callback(*incremental_state)
+
+    # Process the NC-files (in parallel if n_workers > 1, otherwise with prefetching if prefetch_files > 0)
+    results, stage_records = pl.run_files(filenames, context, config.n_workers, seasons, on_results)
+    pl.print_task_summary(results)
+    write_run_outputs(results, [all_filenames], context)
+
+    total_time = config.time.time() - start_time
+    if config.PROFILE:
+        prof.write_report(stage_records, sh.get_report_path(config.export_folder + '/run_report'), total_time)
+        if config.profile_console:
+            prof.print_summary(stage_records)
+
+    print('Total time: ', total_time)
+
+
+def main(argv=None):
+    """
+    Command line entry point: applies the setting overrides and plans or runs the processing. The processing modules
+    are imported after the overrides are applied, so that they import the overridden settings.
+
+    :param argv: list, (optional) with the arguments (default: sys.argv)
+    """
+    args = parse_args(argv)
+    config.apply_overrides(get_overrides(args))
+    if args.plan:
+        plan()
+    else:
+        run()
+
+
+if __name__ == "__main__":
+    # The guard is needed by the worker processes (n_workers > 1), which import this module
+    main()
@@ -0,0 +1,153 @@
+"""
+Module contains the manifest of the incremental mode (INCREMENTAL). The manifest is a .json file in the export folder,
+which records for every clipped output the state (size and modification time, or content hash) of its nc file and the
+state of the shared inputs and settings (c_fac_file, shape_file, snapraster_file, C-factor and interpolation settings).
+Outputs whose recorded state matches the current state (and whose feature outputs exist, USEFEATURES) are up to date
+and are not processed again.
+"""
+from config import *
+
+
+def get_file_hash(file_path, block_size=1048576):
+    """
+    Returns the sha256 hash of the content of a file.
+
+    :param file_path: str, with the file path
+    :param block_size: int, number of bytes which are read at once
+    :return: str, with the hash (hex digest)
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_signature(file_path, hash_content=False):
+    """
+    Returns the size and modification time (or content hash) of a file. For shape files, the files with the same name
+    and another extension (.dbf, .shx, .prj, ...) are included.
+
+    :param file_path: str, with the file path
+    :param hash_content: boolean, if True the content hash is used instead of the modification time
+    :return: list, with [file path, size, modification time in ns or sha256 hash] of each file
+    """
+    if os.path.splitext(file_path)[1].lower() == ".shp":
+        file_paths = sorted(glob.glob(glob.escape(os.path.splitext(file_path)[0]) + ".*"))
+    else:
+        file_paths = [file_path]
+
+    signature = []
+    for path in file_paths:
+        stat = os.stat(path)
+        state = get_file_hash(path) if hash_content else stat.st_mtime_ns
+        signature.append([os.path.abspath(path), stat.st_size, state])
+    return signature
+
+
+def get_config_hash(c_fac_file, shape_file, snapraster_file):
+    """
+    Returns a hash of the shared inputs and the settings that change the outputs.
+
+    :param c_fac_file: str, path of the land cover factor correlation (.csv format)
+    :param shape_file: str, path of the shape file (.shp format)
+    :param snapraster_file: str, path of the snap raster (.tif format)
+    :return: str, with the hash (hex digest)
+    """
+    config_state = {
+        "c_fac_file": get_file_signature(c_fac_file, manifest_hash_content),
+        "shape_file": get_file_signature(shape_file, manifest_hash_content),
+        "snapraster_file": get_file_signature(snapraster_file, manifest_hash_content),
+        "c_fac_columns": list(c_fac_columns),
+        "season_aliases": list(season_aliases),
+        "modes": [USEROI, INMEMORY, USEOPERATOR, USEFEATURES, feature_name_field, USEMASKCLIP, USEBLOCKS, USECELLS,
+                  USETARGETGRID],
+        "cfac_memory_limit": cfac_memory_limit,
+        "output": [output_profile, output_compression, output_compression_level, output_block_size, output_overviews,
+                   list(gdal_creation_options)],
+        "statistics_histogram_bins": statistics_histogram_bins,
+        "interpolation": [interpolation_engine, interpolation_power, interpolation_smoothing, interpolation_max_points,
+                          interpolation_radius, interpolation_nodata],
+    }
+    return hashlib.sha256(json.dumps(config_state, sort_keys=True).encode()).hexdigest()
+
+
+def get_manifest_path(export_folder):
+    """
+    Returns the path of the manifest in the export folder.
+
+    :param export_folder: str, folder where the clipped files are stored
+    :return: str, with the manifest path
+    """
+    return export_folder + '/manifest.json'
+
+
+def load_manifest(manifest_path):
+    """
+    Loads the manifest. If it does not exist (first run), an empty manifest is returned.
+
+    :param manifest_path: str, with the manifest path
+    :return: dict, with the manifest
+    """
+    if not (os.path.exists(manifest_path)):
+        return {"outputs": {}}
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Saves the manifest. The file is written under a temporary name and then replaced, so that an interrupted run never
+    leaves a broken manifest.
+
+    :param manifest: dict, with the manifest
+    :param manifest_path: str, with the manifest path
+    """
+    tmp_path = manifest_path + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_up_to_date(manifest, output_file, nc_file, config_hash):
+    """
+    Checks whether an output and its feature outputs (USEFEATURES) exist and were created from the current state of
+    its nc file and the shared inputs.
+
+    :param manifest: dict, with the manifest
+    :param output_file: str, path of the clipped file
+    :param nc_file: str, path of the nc file
+    :param config_hash: str, with the hash of the shared inputs and settings (see get_config_hash)
+    :return: boolean, True if the output does not need to be processed again
+    """
+    entry = manifest["outputs"].get(os.path.abspath(output_file))
+    if entry is None or not (os.path.exists(output_file)):
+        return False
+    if not all(os.path.exists(feature_file) for feature_file in entry.get("feature_outputs", [])):
+        return False
+    return entry["config_hash"] == config_hash and \
+        entry["nc_signature"] == get_file_signature(nc_file, manifest_hash_content)
+
+
+def record_outputs(manifest, results, config_hash):
+    """
+    Records the finished outputs of a list of task results in the manifest, with the feature outputs of each output
+    (USEFEATURES, see pipeline.export_features).
+
+    :param manifest: dict, with the manifest
+    :param results: list of dicts, with the task results (see pipeline.get_task_result)
+    :param config_hash: str, with the hash of the shared inputs and settings (see get_config_hash)
+    """
+    for result in results:
+        if result["status"] != "done":
+            continue
+        manifest["outputs"][os.path.abspath(result["output"])] = {
+            "nc_file": os.path.abspath(result["nc_file"]),
+            "season": result["season"],
+            "nc_signature": get_file_signature(result["nc_file"], manifest_hash_content),
+            "config_hash": config_hash,
+            "feature_outputs": [os.path.abspath(feature_statistics["output"])
+                                for feature_statistics in result.get("zonal_statistics", [])
+                                if feature_statistics["output"] is not None],
+            "time": datetime.datetime.now().isoformat(timespec='seconds'),
+        }
@@ -0,0 +1,1082 @@
+"""
+Module contains the processing steps for one nc file: import of the nc data, application of the C-factors and, for each
+season, the transformation to the target CRS, interpolation to the snap raster and clip to the shape file.
+
+The season steps are available in two modes:
+- on disk: every stage writes its intermediate file (GeoTIFF/CSV/VRT) to the tmp folder, which is read by the next stage
+- in memory (INMEMORY=True): arrays, transforms and gdal datasets are passed directly between the stages. Only the
+  clipped file is written (plus the intermediate files in the tmp folder for debugging, if USELOG=True)
+- blocked (USEBLOCKS=True): the C-factors are computed in blocks aligned to the nc chunks and streamed to the
+  epsg:4326 tif, which is then processed on disk. The season arrays of the whole grid are never held in memory
+
+With one process (n_workers=1) the nc files run through a prefetching pipeline (prefetch_files > 0): a reader thread
+reads the next nc files, while the main thread processes the seasons and a writer thread writes the clipped rasters.
+"""
+from functions import *
+from config import *
+import raster_calculations as rc
+import resample_snap as rs
+import regridding as rg
+import profiling as prof
+import cfac_cache as cc
+import gdal_options as go
+import manifest as mf
+import sharding as sh
+
+
+def load_context(c_fac_file, snapraster_file, shape_file, export_folder, tmp_folder):
+    """
+    Loads the input data which is shared by all nc files (C-factors and snap raster information) and collects the
+    paths needed by the processing steps.
+
+    :param c_fac_file: str, path of the land cover factor correlation (.csv format)
+    :param snapraster_file: str, path of the snap raster (.tif format)
+    :param shape_file: str, path of the shape file (.shp format)
+    :param export_folder: str, folder where the clipped files are stored
+    :param tmp_folder: str, folder where the temporary files are stored
+    :return: dict, with the processing context
+    """
+    go.configure_gdal()
+
+    # Get C-factor values correlating to land use
+    c_factor = pd.read_csv(c_fac_file, header=0, delimiter=',', usecols=c_fac_columns, )
+    if len(c_factor.columns) - 1 != len(season_aliases):
+        raise Exception("The number of C-factor columns in '" + c_fac_file + "' does not match the season aliases "
+                        + str(season_aliases))
+
+    # Get projection and geotransform from the snap raster:
+    gt, proj, snap_data, cell_resolution = rc.get_snap_raster_data(snapraster_file)
+
+    return {
+        "c_factor": c_factor,
+        "snap_gt": gt,
+        "snap_proj": proj,
+        "snap_data": snap_data,
+        "cell_resolution": cell_resolution,
+        "shape_file": shape_file,
+        "export_folder": export_folder,
+        "tmp_folder": tmp_folder,
+        "operator_folder": tmp_folder + '/operators',
+        "mask_folder": tmp_folder + '/masks',
+        "cfac_cache_folder": tmp_folder + '/cfac_cache',
+    }
+
+
+def get_season_files(nc_alias, season_alias, context):
+    """
+    Returns the paths of the temporary and the finalized files of one nc file and season.
+
+    :param nc_alias: str, name of the nc file (without extension)
+    :param season_alias: str, name of the season (C-factor set)
+    :param context: dict, with the processing context (see load_context)
+    :return: dict, with the file paths
+    """
+    tmp_name = context["tmp_folder"] + '/' + nc_alias + "_" + season_alias
+    return {
+        "csv": tmp_name + "_points.csv",
+        "interpolation": tmp_name + '_interpolation.tif',
+        "epsg4326": tmp_name + "_epsg4326.tif",
+        "epsg32634": tmp_name + "_epsg32634.tif",
+        "finalized": context["export_folder"] + '/' + nc_alias + "_" + season_alias + "_clip.tif",
+    }
+
+
+def get_stale_seasons(filenames, manifest, config_hash, context):
+    """
+    Returns the seasons of the nc files whose clipped outputs are not up to date (incremental mode, see manifest.py).
+
+    :param filenames: list, with the paths of the nc files
+    :param manifest: dict, with the manifest (see manifest.load_manifest)
+    :param config_hash: str, with the state of the shared inputs and settings (see manifest.get_config_hash)
+    :param context: dict, with the processing context (see load_context)
+    :return: dict, with the names of the seasons to process for each nc file (empty list if all are up to date)
+    """
+    seasons = {}
+    for nc_file in filenames:
+        nc_alias = get_file_str(nc_file)
+        seasons[nc_file] = [season_alias for season_alias in season_aliases if not mf.is_up_to_date(
+            manifest, get_season_files(nc_alias, season_alias, context)["finalized"], nc_file, config_hash)]
+    return seasons
+
+
+def get_manifest_callback(manifest, manifest_path, config_hash):
+    """
+    Returns a results callback for run_files, which records the finished outputs in the manifest and saves it after
+    every nc file, so that an interrupted batch can be resumed (merged with the manifest of the other nodes if sharded).
+
+    :param manifest: dict, with the manifest (see manifest.load_manifest)
+    :param manifest_path: str, with the manifest path
+    :param config_hash: str, with the state of the shared inputs and settings (see manifest.get_config_hash)
+    :return: function, which is called with the results of each nc file
+    """
+    def record_manifest(file_results):
+        mf.record_outputs(manifest, file_results, config_hash)
+        if shard_mode is not None:
+            sh.save_manifest(manifest, manifest_path)
+        else:
+            mf.save_manifest(manifest, manifest_path)
+    return record_manifest
+
+
+def get_clip_mask(context):
+    """
+    Returns the (cached) cutline mask of the shape file on the snap raster grid. The mask is kept in the context, so
+    that it is only loaded once per process.
+
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (bool) with the mask, cropped to the window; tuple with the window of the mask (row offset,
+    column offset, rows, columns) on the snap raster
+    """
+    if "clip_mask" not in context:
+        x_size, y_size = rs.get_grid_size(context["snap_data"], context["cell_resolution"])
+        context["clip_mask"], context["clip_window"] = rc.get_cached_cutline_mask(
+            context["shape_file"], context["snap_gt"], context["snap_proj"], x_size, y_size, context["mask_folder"])
+    return context["clip_mask"], context["clip_window"]
+
+
+def get_target_grid(context):
+    """
+    Returns the fixed EPSG:32634 grid of the reprojection (target area plus interpolation_radius, see
+    functions.calculate_target_grid). The grid is kept in the context, so that it is only calculated once per
+    process.
+
+    :param context: dict, with the processing context (see load_context)
+    :return: tuple, with the transform, width and height of the target grid
+    """
+    if "target_grid" not in context:
+        context["target_grid"] = calculate_target_grid(context["snap_data"], context["snap_proj"],
+                                                         context["shape_file"], interpolation_radius, "EPSG:32634")
+    return context["target_grid"]
+
+
+def get_pixel_mapping(context):
+    """
+    Returns the pixel mapping of the fixed target grid onto the nc grid (see functions.calculate_pixel_mapping). The
+    mapping is kept in the context and saved in the operator folder, so that it is calculated once for all runs with
+    the same snap raster, shape file and interpolation radius.
+
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (int32), with the nc row of every target cell; np.array (int32), with the nc column of every
+    target cell
+    """
+    if "pixel_mapping" in context:
+        return context["pixel_mapping"]
+
+    dst_transform, width, height = get_target_grid(context)
+    key = hashlib.sha1(json.dumps({
+        "snap_data": list(context["snap_data"]),
+        "snap_proj": context["snap_proj"],
+        "shape_file": mf.get_file_signature(context["shape_file"]),
+        "target_grid": list(dst_transform)[:6] + [width, height],
+        "nc_transform": list(get_nc_transform())[:6],
+    }, sort_keys=True).encode()).hexdigest()
+    mapping_file = context["operator_folder"] + '/mapping_' + key + '.npz'
+
+    if os.path.exists(mapping_file):
+        with np.load(mapping_file) as mapping:
+            context["pixel_mapping"] = mapping["nc_rows"], mapping["nc_columns"]
+        return context["pixel_mapping"]
+
+    print("Calculating the pixel mapping of the target grid ...")
+    nc_rows, nc_columns = calculate_pixel_mapping((dst_transform, width, height), "EPSG:32634")
+    os.makedirs(context["operator_folder"], exist_ok=True)
+    tmp_file = mapping_file + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_file, 'wb') as npz_file:
+        np.savez(npz_file, nc_rows=nc_rows, nc_columns=nc_columns)
+    os.replace(tmp_file, mapping_file)
+    context["pixel_mapping"] = nc_rows, nc_columns
+    return context["pixel_mapping"]
+
+
+def get_target_index(roi_window, window_shape, context):
+    """
+    Returns the flat index into the lat/lon window of every cell of the fixed target grid (see
+    functions.get_window_index). The indices are kept in the context per window.
+
+    :param roi_window: rasterio.windows.Window, lat/lon window of the season arrays (None for the whole grid)
+    :param window_shape: tuple, with the number of rows and columns of the season arrays
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (int64), with the flat index of every target cell; np.array (bool), True for the target cells
+    covered by the window
+    """
+    key = (tuple(roi_window.flatten()) if roi_window is not None else None, window_shape)
+    window_indices = context.setdefault("window_indices", {})
+    if key not in window_indices:
+        nc_rows, nc_columns = get_pixel_mapping(context)
+        window_indices[key] = get_window_index(nc_rows, nc_columns, roi_window, window_shape)
+    return window_indices[key]
+
+
+def reproject_season_array(season_array, roi_window, context):
+    """
+    Transforms a season array to EPSG:32634. With USETARGETGRID, the array is mapped onto the fixed target grid with
+    the cached pixel mapping (the flat indices of the lat/lon window are kept in the context), otherwise the whole
+    array is reprojected (see functions.reproject_array).
+
+    :param season_array: np.array, with the C-factors of the season in lat/lon
+    :param roi_window: rasterio.windows.Window, lat/lon window of the season array (None for the whole grid)
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (float32), with the C-factors in EPSG:32634 (np.nan for cells without value);
+    rasterio.transform.Affine, with the transform of the array
+    """
+    if not USETARGETGRID:
+        return reproject_array(season_array, get_nc_transform(roi_window), '+proj=latlong', "EPSG:32634")
+
+    flat_index, covered = get_target_index(roi_window, season_array.shape, context)
+    return reproject_to_grid(season_array, flat_index, covered, gdal_num_threads), get_target_grid(context)[0]
+
+
+def write_output(save_path, clipped_array, clipped_gt, statistics, context):
+    """
+    Saves a clipped raster (-9999 no data). If the prefetching pipeline runs (see run_files_prefetched), the raster is
+    passed to its writer thread, otherwise it is written directly. A raster whose task lock was lost is not written
+    (see sharding.check_task_lock).
+
+    :param save_path: str, path of the clipped file
+    :param clipped_array: np.array (float32), with the clipped raster
+    :param clipped_gt: tuple, with the GEOTransform of the clipped raster
+    :param statistics: dict, with the statistics of the clipped raster (see raster_calculations.get_array_statistics)
+    :param context: dict, with the processing context (see load_context)
+    """
+    writer_queue = context.get("writer_queue")
+    if writer_queue is None:
+        sh.check_task_lock(save_path)
+        rc.array_to_raster(save_path, clipped_array, clipped_gt, context["snap_proj"], no_data=-9999,
+                           statistics=statistics, **go.get_output_kwargs())
+    else:
+        writer_queue.put(("raster", dict(save_path=save_path, array=clipped_array, gt=clipped_gt,
+                                         proj=context["snap_proj"], no_data=-9999, statistics=statistics,
+                                         **go.get_output_kwargs())))
+
+
+def export_clipped_array(interpolated_array, save_path, context):
+    """
+    Clips an interpolated array (snap raster grid) with the cached cutline mask and saves it.
+
+    :param interpolated_array: np.array, with the interpolated raster on the snap raster grid (north up)
+    :param save_path: str, path of the clipped file
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (float32), with the clipped raster; tuple, with the GEOTransform of the clipped raster; dict,
+    with the statistics of the clipped raster (see raster_calculations.get_array_statistics)
+    """
+    clip_mask, window = get_clip_mask(context)
+    clipped_array = rc.clip_array(interpolated_array, clip_mask, window, no_data=-9999)
+    clipped_gt = rc.get_window_geotransform(context["snap_gt"], window)
+    statistics = rc.get_array_statistics(clipped_array, -9999, statistics_histogram_bins)
+    write_output(save_path, clipped_array, clipped_gt, statistics, context)
+    return clipped_array, clipped_gt, statistics
+
+
+def get_feature_labels(context):
+    """
+    Returns the (cached) label raster of the shape file features on the snap raster grid and the feature names. The
+    label raster is kept in the context, so that it is only loaded once per process.
+
+    :param context: dict, with the processing context (see load_context)
+    :return: np.array (int32) with the label raster; list with the feature names
+    """
+    if "feature_labels" not in context:
+        x_size, y_size = rs.get_grid_size(context["snap_data"], context["cell_resolution"])
+        context["feature_labels"], context["feature_names"] = rc.get_cached_feature_labels(
+            context["shape_file"], context["snap_gt"], context["snap_proj"], x_size, y_size, context["mask_folder"],
+            feature_name_field)
+    return context["feature_labels"], context["feature_names"]
+
+
+def export_features(clipped_array, clipped_gt, nc_file, season_alias, season_files, context):
+    """
+    Exports a clipped raster of every shape file feature and calculates the zonal statistics of all features from the
+    clipped raster of the whole shape file.
+
+    :param clipped_array: np.array, with the clipped raster of the whole shape file (-9999 outside)
+    :param clipped_gt: tuple, with the GEOTransform of the clipped raster
+    :param nc_file: str, path of the nc file
+    :param season_alias: str, name of the season
+    :param season_files: dict, with the file paths (see get_season_files)
+    :param context: dict, with the processing context (see load_context)
+    :return: list of dicts, with the zonal statistics and the output file of each feature
+    """
+    labels, feature_names = get_feature_labels(context)
+    labels = rc.crop_to_grid(labels, context["snap_gt"], clipped_gt, clipped_array.shape)
+
+    statistics = rc.get_zonal_statistics(clipped_array, labels, len(feature_names), no_data=-9999)
+    for feature_statistics, feature_name in zip(statistics, feature_names):
+        feature_file = season_files["finalized"].replace("_clip.tif", "_" + re.sub(r'[^\w\-]+', '_', feature_name)
+                                                         + "_clip.tif")
+        feature_statistics.update({"nc_file": nc_file, "season": season_alias, "feature": feature_name,
+                                   "output": feature_file})
+
+        # Crop to the cells of the feature
+        rows, columns = np.nonzero(labels == feature_statistics["label"])
+        if len(rows) == 0:
+            feature_statistics["output"] = None
+            continue
+        window = (int(rows.min()), int(columns.min()), int(rows.max() - rows.min() + 1),
+                  int(columns.max() - columns.min() + 1))
+        feature_mask = labels[window[0]:window[0] + window[2], window[1]:window[1] + window[3]] == \
+            feature_statistics["label"]
+        feature_array = rc.clip_array(clipped_array, feature_mask, window, no_data=-9999)
+        write_output(feature_file, feature_array, rc.get_window_geotransform(clipped_gt, window),
+                     rc.get_array_statistics(feature_array, -9999, statistics_histogram_bins), context)
+    return statistics
+
+
+def write_statistics_csv(rows, columns, key_columns, csv_path):
+    """
+    Saves statistics rows to a .csv file. The rows of an existing file are kept, except for the rows with the same key
+    as one of the new rows (e.g. nc file and season which were processed again, INCREMENTAL), which are replaced.
+
+    :param rows: list of dicts, with the statistics rows
+    :param columns: list, with the columns of the .csv file
+    :param key_columns: list, with the columns which identify the rows of one task (e.g. ["nc_file", "season"])
+    :param csv_path: str, path of the .csv file
+    """
+    statistics = pd.DataFrame(rows, columns=columns)
+    if os.path.exists(csv_path):
+        processed = set(zip(*[statistics[column] for column in key_columns]))
+        previous = pd.read_csv(csv_path)
+        previous = previous[[key not in processed for key in zip(*[previous[column] for column in key_columns])]]
+        statistics = pd.concat([previous, statistics], ignore_index=True)
+    statistics.to_csv(csv_path, index=False)
+
+
+def write_zonal_statistics(results, csv_path):
+    """
+    Saves the zonal statistics of all nc files, seasons and features to a .csv file. The rows of an existing file whose
+    nc file and season were not processed again (INCREMENTAL) are kept.
+
+    :param results: list of dicts, with the task results (see get_task_result)
+    :param csv_path: str, path of the .csv file
+    """
+    statistics = [feature_statistics for result in results for feature_statistics in result.get("zonal_statistics", [])]
+    columns = ["nc_file", "season", "feature", "label", "count", "mean", "min", "max", "output"]
+    write_statistics_csv(statistics, columns, ["nc_file", "season"], csv_path)
+
+
+def write_run_statistics(results, csv_path):
+    """
+    Saves the statistics of the clipped rasters of all nc files and seasons to a .csv file (one row per output). The
+    rows of an existing file whose nc file and season were not processed again (INCREMENTAL) are kept.
+
+    :param results: list of dicts, with the task results (see get_task_result)
+    :param csv_path: str, path of the .csv file
+    """
+    columns = ["nc_file", "season", "output", "valid_count", "min", "max", "mean", "std", "histogram"]
+    statistics = [dict(result["statistics"], nc_file=result["nc_file"], season=result["season"],
+                       output=result["output"]) for result in results if result.get("statistics") is not None]
+    write_statistics_csv(statistics, columns, ["nc_file", "season"], csv_path)
+
+
+def print_statistics_table(results):
+    """
+    Prints the statistics of the clipped rasters of all processed nc files and seasons.
+
+    :param results: list of dicts, with the task results (see get_task_result)
+    """
+    print("{:<40} {:<8} {:>10} {:>10} {:>10} {:>10} {:>10}".format("File", "Season", "Cells", "Min", "Max", "Mean",
+                                                                   "Std"))
+    for result in results:
+        statistics = result.get("statistics")
+        if statistics is None:
+            continue
+        values = [statistics[key] if statistics[key] is not None else np.nan for key in ["min", "max", "mean", "std"]]
+        print("{:<40} {:<8} {:>10} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+            get_file_str(result["nc_file"])[-40:], result["season"], statistics["valid_count"], *values))
+
+
+def get_task_result(nc_file, season_alias, output_file, error=None):
+    """
+    Returns the result record of one nc file and season task.
+
+    :param nc_file: str, path of the nc file
+    :param season_alias: str, name of the season
+    :param output_file: str, path of the clipped file
+    :param error: Exception, (optional) error which made the task fail
+    :return: dict, with the task result
+    """
+    return {
+        "nc_file": nc_file,
+        "season": season_alias,
+        "output": output_file,
+        "status": "failed" if error is not None else "done",
+        "error": None if error is None else type(error).__name__ + ": " + str(error),
+        "statistics": None,
+        "cfac_cache": None,
+    }
+
+
+def get_grid_cells(ds, ds_lon, ds_lat, window, context, extend=False):
+    """
+    Returns the valid cell index of an nc grid window (see functions.get_valid_cells). The index is calculated once per
+    grid and window and reused for all nc files: it is kept in the context and saved in the mask folder.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param window: rasterio.windows.Window, lat/lon window (None for the whole grid)
+    :param context: dict, with the processing context (see load_context)
+    :param extend: boolean, if True the valid cells of ds are added to the index (if ds has values outside of it)
+    :return: np.array (int64), flat indices of the valid cells in the [lat, lon] array of the window
+    """
+    if window is None:
+        window = wnd.Window(0, 0, ds_lon, ds_lat)
+    key = hashlib.sha1(json.dumps([ds_lon, ds_lat, len(ds.variables) - 2, list(window.flatten())]).encode()).hexdigest()
+    cell_indices = context.setdefault("cell_indices", {})
+    cells_file = context["mask_folder"] + '/cells_' + key + '.npy'
+
+    if not extend:
+        if key in cell_indices:
+            return cell_indices[key]
+        if os.path.exists(cells_file):
+            cell_indices[key] = np.load(cells_file)
+            return cell_indices[key]
+
+    print("Calculating the valid cell index ...")
+    cells = get_valid_cells(ds, ds_lon, ds_lat, window)
+    if extend and key in cell_indices:
+        cells = np.union1d(cell_indices[key], cells)
+    os.makedirs(context["mask_folder"], exist_ok=True)
+    tmp_file = cells_file + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_file, 'wb') as npy_file:
+        np.save(npy_file, cells)
+    os.replace(tmp_file, cells_file)
+    cell_indices[key] = cells
+    return cells
+
+
+def compute_cfac_arrays(ds, ds_lon, ds_lat, roi_window, context):
+    """
+    Applies the C-factors to an nc file. If USECELLS=True, only the cells of the valid cell index of the grid are
+    computed. If the nc file has values outside of the index, the index is extended and the file is computed again.
+
+    :param ds: nc.Dataset, that contains land use classes (PFT0 - PFTn bands)
+    :param ds_lon: int, with the width in longitude degrees
+    :param ds_lat: int, with the height in latitude degrees
+    :param roi_window: rasterio.windows.Window, lat/lon window (None for the whole grid)
+    :param context: dict, with the processing context (see load_context)
+    :return: tuple of np.arrays (float32), with the C-factor array of each season (np.nan for cells without a value)
+    """
+    if not USECELLS:
+        return apply_cfac_to_array(ds, ds_lon, ds_lat, context["c_factor"], roi_window)
+
+    cells = get_grid_cells(ds, ds_lon, ds_lat, roi_window, context)
+    try:
+        return apply_cfac_to_array(ds, ds_lon, ds_lat, context["c_factor"], roi_window, cells=cells)
+    except CellIndexError:
+        print("The nc file has values outside of the valid cell index, extending the index ...")
+        cells = get_grid_cells(ds, ds_lon, ds_lat, roi_window, context, extend=True)
+        return apply_cfac_to_array(ds, ds_lon, ds_lat, context["c_factor"], roi_window, cells=cells)
+
+
+def read_file(nc_file, context, seasons=None, timer=prof.null_timer):
+    """
+    Reads one nc file and applies the C-factors (all nc file access of a task is done here).
+
+    :param nc_file: str, path of the nc file
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: list, (optional) names of the seasons which are processed. If None, all seasons are processed
+    :param timer: function, stage timer (see profiling.get_stage_timer)
+    :return: list, with the C-factor array of each season (None if the array was written block by block to the
+    epsg:4326 tif, USEBLOCKS); rasterio.windows.Window, lat/lon window of the arrays (None for the whole grid); str,
+    with the state of the C-factor cache ('hit', 'miss' or None if the cache is not used)
+    """
+    if seasons is None:
+        seasons = season_aliases
+
+    # Extract NC-data
+    print("Importing NC file ...")
+    with timer("nc import"):
+        ds, ds_lon, ds_lat = extract_nc_data_to_array(nc_file)
+
+    # Apply the C-factors based on the pixels share and season
+    print("Applying C Factors ...")
+    try:
+        with timer("cfac"):
+            roi_window = None
+            if USEROI:
+                roi_window = get_roi_window(ds_lon, ds_lat, context["snap_data"], context["snap_proj"],
+                                            context["shape_file"], interpolation_radius)
+            if USEBLOCKS:
+                # Stream the blocks to the epsg:4326 tifs, the season arrays are not held in memory
+                nc_alias = get_file_str(nc_file)
+                export_cfac_blocks(ds, ds_lon, ds_lat, context["c_factor"],
+                                   [get_season_files(nc_alias, season_alias, context)["epsg4326"]
+                                    if season_alias in seasons else None for season_alias in season_aliases],
+                                   roi_window, cfac_memory_limit)
+                season_arrays = [None] * len(season_aliases)
+                cache_state = None
+            elif USECFACCACHE:
+                cache_window = roi_window if roi_window is not None else wnd.Window(0, 0, ds_lon, ds_lat)
+                season_arrays = cc.load_cfac_arrays(nc_file, context["c_factor"], cache_window,
+                                                    context["cfac_cache_folder"])
+                cache_state = "hit" if season_arrays is not None else "miss"
+                print("C-factor cache " + cache_state)
+                if season_arrays is None:
+                    season_arrays = compute_cfac_arrays(ds, ds_lon, ds_lat, roi_window, context)
+                    cc.save_cfac_arrays(season_arrays, nc_file, context["c_factor"], cache_window,
+                                        context["cfac_cache_folder"])
+            else:
+                season_arrays = compute_cfac_arrays(ds, ds_lon, ds_lat, roi_window, context)
+                cache_state = None
+    finally:
+        ds.close()
+    return season_arrays, roi_window, cache_state
+
+
+def get_failed_results(nc_file, error, context, seasons=None):
+    """
+    Returns the result records of all seasons of an nc file which could not be read.
+
+    :param nc_file: str, path of the nc file
+    :param error: Exception, error which made the tasks fail
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: list, (optional) names of the processed seasons. If None, all seasons are processed
+    :return: list of dicts, with the task results (see get_task_result)
+    """
+    print("Error in file " + nc_file + ": " + str(error))
+    nc_alias = get_file_str(nc_file)
+    return [get_task_result(nc_file, season_alias, get_season_files(nc_alias, season_alias, context)["finalized"],
+                            error)
+            for season_alias in season_aliases if seasons is None or season_alias in seasons]
+
+
+def process_seasons(nc_file, season_arrays, roi_window, context, seasons=None, timer=prof.null_timer):
+    """
+    Creates the clipped raster of every season of one nc file. Errors are caught and reported per season, so that one
+    failing task does not abort the whole batch.
+
+    :param nc_file: str, path of the nc file
+    :param season_arrays: list, with the C-factor array of each season (see read_file)
+    :param roi_window: rasterio.windows.Window, lat/lon window of the arrays (None for the whole grid)
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: list, (optional) names of the seasons which are processed. If None, all seasons are processed
+    :param timer: function, stage timer (see profiling.get_stage_timer)
+    :return: list of dicts, with the result of each processed season (see get_task_result)
+    """
+    nc_alias = get_file_str(nc_file)
+    if seasons is None:
+        seasons = season_aliases
+
+    results = []
+    for season_array, season_alias in zip(season_arrays, season_aliases):
+        if season_alias not in seasons:
+            continue
+        season_files = get_season_files(nc_alias, season_alias, context)
+        try:
+            if USEBLOCKS:
+                clipped_array, clipped_gt, statistics = process_season_on_disk(
+                    season_array, season_alias, roi_window, season_files, context, timer)
+            elif USEOPERATOR:
+                clipped_array, clipped_gt, statistics = process_season_with_operator(
+                    season_array, season_alias, roi_window, season_files, context, timer)
+            elif INMEMORY:
+                clipped_array, clipped_gt, statistics = process_season_in_memory(
+                    season_array, season_alias, roi_window, season_files, context, timer)
+            else:
+                clipped_array, clipped_gt, statistics = process_season_on_disk(
+                    season_array, season_alias, roi_window, season_files, context, timer)
+            results.append(get_task_result(nc_file, season_alias, season_files["finalized"]))
+            results[-1]["statistics"] = statistics
+
+            if USEFEATURES:
+                print(season_alias + ", Exporting features ...")
+                with timer("features", season=season_alias):
+                    if clipped_array is None:  # clipped with gdalwarp
+                        clipped_array = rc.raster_to_array(season_files["finalized"], mask=False)
+                        clipped_gt, clipped_proj = rc.get_raster_data(season_files["finalized"])
+                    results[-1]["zonal_statistics"] = export_features(clipped_array, clipped_gt, nc_file,
+                                                                      season_alias, season_files, context)
+        except Exception as e:
+            print("Error in file " + nc_file + ", " + season_alias + ": " + str(e))
+            if USELOG:
+                traceback.print_exc()
+            results.append(get_task_result(nc_file, season_alias, season_files["finalized"], e))
+    return results
+
+
+def process_file(nc_file, context, seasons=None, task_locks=None):
+    """
+    Processes one nc file: applies the C-factors and creates the clipped raster of every season. Errors are caught and
+    reported per season, so that one failing task does not abort the whole batch.
+
+    :param nc_file: str, path of the nc file
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: list, (optional) names of the seasons which are processed. If None, all seasons are processed
+    :param task_locks: dict, (optional) locks of the claimed outputs in a worker process (shard_mode='dynamic', see
+    sharding.get_task_locks)
+    :return: list of dicts, with the result of each processed season (see get_task_result); list of dicts, with the
+    stage records (empty if PROFILE=False, see profiling.stage_timer)
+    """
+    go.configure_gdal()  # worker processes
+    if task_locks is not None:
+        sh.set_task_locks(task_locks)
+    stage_records = []
+    timer = prof.get_stage_timer(stage_records if PROFILE else None, nc_file=nc_file)
+
+    try:
+        season_arrays, roi_window, cache_state = read_file(nc_file, context, seasons, timer)
+    except Exception as e:
+        if USELOG:
+            traceback.print_exc()
+        return get_failed_results(nc_file, e, context, seasons), stage_records
+
+    results = process_seasons(nc_file, season_arrays, roi_window, context, seasons, timer)
+    for result in results:
+        result["cfac_cache"] = cache_state
+    return results, stage_records
+
+
+def claim_seasons(nc_file, seasons, context):
+    """
+    Claims the tasks of an nc file before it is read (shard_mode='dynamic', see sharding.claim_tasks). The claimed
+    seasons are stored in seasons. Without dynamic sharding, all seasons are processed.
+
+    :param nc_file: str, path of the nc file
+    :param seasons: dict, with the names of the seasons which are processed for each nc file (updated)
+    :param context: dict, with the processing context (see load_context)
+    :return: boolean, True if the nc file has tasks to process
+    """
+    if shard_mode != 'dynamic':
+        return True
+    nc_alias = get_file_str(nc_file)
+    season_outputs = {season_alias: get_season_files(nc_alias, season_alias, context)["finalized"]
+                      for season_alias in seasons.get(nc_file, season_aliases)}
+    seasons[nc_file] = sh.claim_tasks(nc_file, season_outputs, context["export_folder"])
+    return len(seasons[nc_file]) > 0
+
+
+def read_files(filenames, context, seasons, file_queue):
+    """
+    Reader thread of the prefetching pipeline: reads the nc files one after the other and puts the C-factor arrays into
+    a bounded queue. The thread blocks while the queue is full, so that at most prefetch_files files are held in
+    memory. A file whose tasks cannot be claimed or which cannot be read is put with its error. The end of the files is
+    always marked with None (also if the thread fails), so that the main thread never waits forever.
+
+    :param filenames: list, with the paths of the nc files
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: dict, with the names of the seasons which are processed for each nc file
+    :param file_queue: queue.Queue, to which (nc file, season arrays, window, cache state, error, stage records) are
+    put
+    """
+    try:
+        for nc_file in filenames:
+            stage_records = []
+            timer = prof.get_stage_timer(stage_records if PROFILE else None, nc_file=nc_file)
+            try:
+                if not claim_seasons(nc_file, seasons, context):
+                    continue
+                season_arrays, roi_window, cache_state = read_file(nc_file, context, seasons.get(nc_file), timer)
+                file_queue.put((nc_file, season_arrays, roi_window, cache_state, None, stage_records))
+            except Exception as e:
+                if USELOG:
+                    traceback.print_exc()
+                file_queue.put((nc_file, None, None, None, e, stage_records))
+    finally:
+        file_queue.put(None)
+
+
+def write_outputs(writer_queue, on_results=None):
+    """
+    Writer thread of the prefetching pipeline: writes the clipped rasters of the queue (see write_output). The results
+    of an nc file are put into the queue after its rasters, so that they are only passed to on_results (e.g. the
+    manifest) when all rasters are written. Tasks whose raster could not be written are marked as failed. The end of
+    the queue is marked with None.
+
+    :param writer_queue: queue.Queue, with ("raster", keyword arguments of array_to_raster) and ("results", list of
+    results)
+    :param on_results: function, (optional) which is called with the results of each nc file
+    """
+    write_errors = {}
+    while True:
+        item = writer_queue.get()
+        if item is None:
+            break
+        kind, payload = item
+        if kind == "raster":
+            try:
+                sh.check_task_lock(payload["save_path"])
+                rc.array_to_raster(**payload)
+            except Exception as e:
+                print("Error writing " + payload["save_path"] + ": " + str(e))
+                write_errors[payload["save_path"]] = e
+            continue
+
+        for result in payload:
+            outputs = [result["output"]] + [feature_statistics["output"]
+                                            for feature_statistics in result.get("zonal_statistics", [])]
+            errors = [write_errors.pop(output) for output in outputs if output in write_errors]
+            if errors and result["status"] == "done":
+                result.update(get_task_result(result["nc_file"], result["season"], result["output"], errors[0]))
+        if on_results is not None:
+            try:
+                on_results(payload)
+            except Exception as e:  # the writer has to keep draining the queue
+                print("Error in the results callback: " + str(e))
+
+
+def run_files_prefetched(filenames, context, seasons, on_results=None):
+    """
+    Processes a list of nc files in a pipeline of three threads: a reader thread prefetches the next nc files (see
+    read_files), the main thread transforms, interpolates and clips the seasons and a writer thread writes the clipped
+    rasters (see write_outputs). The queues between the threads are bounded (prefetch_files, writer_queue_size), so
+    that the memory use stays bounded when one stage is slower than the others.
+
+    :param filenames: list, with the paths of the nc files
+    :param context: dict, with the processing context (see load_context)
+    :param seasons: dict, with the names of the seasons which are processed for each nc file
+    :param on_results: function, (optional) which is called with the results of each nc file when they are written
+    :return: list of dicts, with the result of each nc file and season task (see get_task_result); list of dicts, with
+    the stage records of all nc files
+    """
+    file_queue = queue.Queue(maxsize=prefetch_files)
+    writer_queue = queue.Queue(maxsize=writer_queue_size)
+    # Daemon threads: an aborted run (e.g. KeyboardInterrupt) does not wait for blocked threads
+    reader = threading.Thread(target=read_files, args=(filenames, context, seasons, file_queue), daemon=True)
+    writer = threading.Thread(target=write_outputs, args=(writer_queue, on_results), daemon=True)
+    reader.start()
+    writer.start()
+
+    results = []
+    stage_records = []
+    context["writer_queue"] = writer_queue
+    try:
+        while True:
+            item = file_queue.get()
+            if item is None:
+                break
+            nc_file, season_arrays, roi_window, cache_state, error, file_stage_records = item
+            print("File: " + nc_file)
+            if error is not None:
+                file_results = get_failed_results(nc_file, error, context, seasons.get(nc_file))
+            else:
+                timer = prof.get_stage_timer(file_stage_records if PROFILE else None, nc_file=nc_file)
+                file_results = process_seasons(nc_file, season_arrays, roi_window, context, seasons.get(nc_file),
+                                               timer)
+                for result in file_results:
+                    result["cfac_cache"] = cache_state
+            writer_queue.put(("results", file_results))
+            results.extend(file_results)
+            stage_records.extend(file_stage_records)
+    finally:
+        context.pop("writer_queue", None)
+        writer_queue.put(None)
+        writer.join()
+    return results, stage_records
+
+
+def run_files(filenames, context, workers=n_workers, seasons=None, on_results=None):
+    """
+    Processes a list of nc files, sequentially (workers=1, with prefetching if prefetch_files > 0) or in a pool of
+    worker processes.
+
+    :param filenames: list, with the paths of the nc files
+    :param context: dict, with the processing context (see load_context)
+    :param workers: int, number of worker processes
+    :param seasons: dict, (optional) with the names of the seasons which are processed for each nc file. If None, all
+    seasons are processed
+    :param on_results: function, (optional) which is called with the results of each nc file as soon as it is finished
+    :return: list of dicts, with the result of each nc file and season task (see get_task_result); list of dicts, with
+    the stage records of all nc files
+    """
+    if seasons is None:
+        seasons = {}
+    if shard_mode == 'dynamic':
+        # The tasks are claimed when an nc file is read and released when its results are recorded
+        on_results = sh.get_release_callback(on_results, context["export_folder"])
+
+    if workers <= 1 and prefetch_files > 0:
+        return run_files_prefetched(filenames, context, seasons, on_results)
+
+    results = []
+    stage_records = []
+    if workers <= 1:
+        for nc_file in filenames:
+            if not claim_seasons(nc_file, seasons, context):
+                continue
+            print("File: " + nc_file)
+            file_results, file_stage_records = process_file(nc_file, context, seasons.get(nc_file))
+            if on_results is not None:
+                on_results(file_results)
+            results.extend(file_results)
+            stage_records.extend(file_stage_records)
+        return results, stage_records
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # At most two nc files per worker are submitted at once, so that the tasks are claimed (shard_mode='dynamic')
+        # when a worker is about to process them
+        pending_files = iter(filenames)
+        tasks = {}
+        while True:
+            for nc_file in pending_files:
+                if claim_seasons(nc_file, seasons, context):
+                    task_locks = sh.get_task_locks() if shard_mode == 'dynamic' else None
+                    tasks[executor.submit(process_file, nc_file, context, seasons.get(nc_file), task_locks)] = nc_file
+                if len(tasks) >= 2 * workers:
+                    break
+            if not tasks:
+                break
+            done, not_done = futures.wait(tasks, return_when=futures.FIRST_COMPLETED)
+            for task in done:
+                nc_file = tasks.pop(task)
+                try:
+                    file_results, file_stage_records = task.result()
+                    print("File done: " + nc_file)
+                except Exception as e:  # e.g. a crashed worker process
+                    # Same records as a file which could not be read: expected output path and error with its type
+                    file_results = get_failed_results(nc_file, e, context, seasons.get(nc_file))
+                    file_stage_records = []
+                if on_results is not None:
+                    on_results(file_results)
+                results.extend(file_results)
+                stage_records.extend(file_stage_records)
+    return results, stage_records
+
+
+def print_task_summary(results):
+    """
+    Prints the number of finished and failed tasks, the errors of the failed tasks and the hits and misses of the
+    C-factor cache.
+
+    :param results: list of dicts, with the task results (see get_task_result)
+    """
+    failed = [result for result in results if result["status"] == "failed"]
+    cache_states = [result.get("cfac_cache") for result in results]
+    if USECFACCACHE:
+        print("C-factor cache hits: " + str(cache_states.count("hit")) + ", misses: " + str(cache_states.count("miss")))
+    print("Tasks done: " + str(len(results) - len(failed)) + ", failed: " + str(len(failed)))
+    for result in failed:
+        print(" - " + result["nc_file"] + ", " + result["season"] + ": " + result["error"])
+
+
+def process_season_with_operator(season_array, season_alias, roi_window, season_files, context,
+                                 timer=prof.null_timer):
+    """
+    Creates the clipped raster of one season with the (cached) regridding operator, which replaces the
+    reprojection, interpolation and clip.
+
+    :param season_array: np.array, with the C-factors of the season in lat/lon
+    :param season_alias: str, name of the season
+    :param roi_window: rasterio.windows.Window, lat/lon window of the season array (None for the whole grid)
+    :param season_files: dict, with the file paths (see get_season_files)
+    :param context: dict, with the processing context (see load_context)
+    :param timer: function, stage timer (see profiling.get_stage_timer)
+    :return: np.array (float32), with the clipped raster; tuple, with its GEOTransform (None, None if the clipped
+    raster is only written to disk by gdalwarp); dict, with the statistics of the clipped raster
+    """
+    print(season_alias + ", Applying regridding operator ...")
+    with timer("operator", season=season_alias):
+        # With USETARGETGRID, the operator is built on the fixed target grid (same reprojection as the other paths)
+        target_grid = None
+        if USETARGETGRID:
+            flat_index, covered = get_target_index(roi_window, season_array.shape, context)
+            target_grid = (get_target_grid(context)[0], np.where(covered, flat_index, -1))
+        operator = rg.get_operator(season_array.shape, get_nc_transform(roi_window), context, target_grid)
+        clipped_array = rg.apply_operator(operator, season_array, rg.get_valid_source_mask(season_array))
+
+    print(season_alias + ", Exporting clipped target area...")
+    clipped_gt = rc.get_window_geotransform(context["snap_gt"], operator["window"])
+    with timer("statistics", season=season_alias):
+        statistics = rc.get_array_statistics(clipped_array, -9999, statistics_histogram_bins)
+    with timer("clip export", season=season_alias):
+        write_output(season_files["finalized"], clipped_array, clipped_gt, statistics, context)
+    return clipped_array, clipped_gt, statistics
+
+
+def process_season_in_memory(season_array, season_alias, roi_window, season_files, context,
+                             timer=prof.null_timer):
+    """
+    Transforms, interpolates and clips the C-factor array of one season without intermediate files.
+
+    :param season_array: np.array, with the C-factors of the season in lat/lon
+    :param season_alias: str, name of the season
+    :param roi_window: rasterio.windows.Window, lat/lon window of the season array (None for the whole grid)
+    :param season_files: dict, with the file paths (see get_season_files)
+    :param context: dict, with the processing context (see load_context)
+    :param timer: function, stage timer (see profiling.get_stage_timer)
+    :return: np.array (float32), with the clipped raster; tuple, with its GEOTransform (None, None if the clipped
+    raster is only written to disk by gdalwarp); dict, with the statistics of the clipped raster
+    """
+    if USELOG:
+        print(season_alias + ", Exporting epsg:4326 (debug) ...")
+        with timer("export 4326", season=season_alias):
+            export_to_tif(season_array.shape[1], season_array.shape[0], season_array, season_files["epsg4326"],
+                          roi_window)
+
+    # Change to the target CRS 32634 (18°E - 24°E)
+    print(season_alias + ", Reprojecting to epsg:32634 ...")
+    with timer("reprojection", season=season_alias):
+        target_array, target_transform = reproject_season_array(season_array, roi_window, context)
+        gt_target = target_transform.to_gdal()
+
+    if USELOG:
+        print(season_alias + ", Exporting epsg:32634 (debug) ...")
+        with timer("export 32634", season=season_alias):
+            rc.array_to_raster(season_files["epsg32634"], target_array, gt_target,
+                               rio.crs.CRS.from_string("EPSG:32634").to_wkt(), no_data=np.nan)
+
+    # Get the coordinates of the center of all the cells WITH VALUES
+    print(season_alias + ", Preparing points ...")
+    with timer("points", season=season_alias):
+        xyz_array = rs.get_raster_points(target_array, gt_target)
+
+    # Interpolate and resample points with the KD-tree engine or gdal.Grid on in-memory files
+    print(season_alias + ", Interpolating target area...")
+    with timer("interpolation", season=season_alias):
+        if interpolation_engine == 'kdtree':
+            interpolated_array = rs.idw_interpolate(xyz_array, context["snap_data"], context["cell_resolution"])
+            interpolation = None
+        else:
+            interpolation = rs.interpolate_points_in_memory(xyz_array, context["snap_data"],
+                                                            context["cell_resolution"])
+            interpolated_array = None
+
+    if USELOG:
+        print(season_alias + ", Exporting interpolation (debug) ...")
+        with timer("export interpolation", season=season_alias):
+            if interpolation is None:
+                rc.array_to_raster(season_files["interpolation"], interpolated_array, context["snap_gt"],
+                                   context["snap_proj"])
+            else:
+                gdal.Translate(season_files["interpolation"], interpolation,
+                               creationOptions=go.get_creation_options())
+
+    # Clip the resampled raster to the extent of the shape file
+    print(season_alias + ", Clipping target area...")
+    clipped_array, clipped_gt, statistics = None, None, None
+    with timer("clip", season=season_alias):
+        if USEMASKCLIP:
+            if interpolated_array is None:
+                interpolated_array = interpolation.GetRasterBand(1).ReadAsArray()
+            clipped_array, clipped_gt, statistics = export_clipped_array(interpolated_array, season_files["finalized"],
+                                                                         context)
+        else:
+            if interpolation is None:
+                interpolation = rc.array_to_dataset(interpolated_array, context["snap_gt"], context["snap_proj"])
+            sh.check_task_lock(season_files["finalized"])
+            statistics = rc.clip_dataset(context["shape_file"], season_files["finalized"], interpolation,
+                                         statistics_histogram_bins, go.get_output_kwargs()["overview_levels"],
+                                         **go.get_warp_kwargs(output=True))
+    interpolation = None
+    return clipped_array, clipped_gt, statistics
+
+
+def process_season_on_disk(season_array, season_alias, roi_window, season_files, context,
+                           timer=prof.null_timer):
+    """
+    Transforms, interpolates and clips the C-factor array of one season. Every stage writes its intermediate file to
+    the tmp folder.
+
+    :param season_array: np.array, with the C-factors of the season in lat/lon (None if the epsg:4326 tif was already
+    written block by block, USEBLOCKS)
+    :param season_alias: str, name of the season
+    :param roi_window: rasterio.windows.Window, lat/lon window of the season array (None for the whole grid)
+    :param season_files: dict, with the file paths (see get_season_files)
+    :param context: dict, with the processing context (see load_context)
+    :param timer: function, stage timer (see profiling.get_stage_timer)
+    :return: np.array (float32), with the clipped raster; tuple, with its GEOTransform (None, None if the clipped
+    raster is only written to disk by gdalwarp); dict, with the statistics of the clipped raster
+    """
+    interpolation_file = season_files["interpolation"]
+    xyz_csv_file = season_files["csv"]
+    season_file_epsg4326 = season_files["epsg4326"]
+    season_file_epsg32634 = season_files["epsg32634"]
+
+    # Export the finalized tif
+    if season_array is not None:
+        print(season_alias + ", Exporting epsg:4326 ...")
+        with timer("export 4326", season=season_alias):
+            export_to_tif(season_array.shape[1], season_array.shape[0], season_array, season_file_epsg4326,
+                          roi_window)
+
+    # Change to the target CRS 32634 (18°E - 24°E)
+    print(season_alias + ", Exporting epsg:32634 ...")
+    with timer("reprojection", season=season_alias):
+        if USETARGETGRID and season_array is not None:
+            target_array, target_transform = reproject_season_array(season_array, roi_window, context)
+            rc.array_to_raster(season_file_epsg32634, target_array, target_transform.to_gdal(),
+                               rio.crs.CRS.from_string("EPSG:32634").to_wkt(), no_data=np.nan)
+        else:
+            # Blocked C-factors (USEBLOCKS): the epsg:4326 raster is warped in chunks, onto the fixed target grid
+            transform_to_target_crs(season_file_epsg4326, season_file_epsg32634, "EPSG:32634",
+                                    cfac_memory_limit if USEBLOCKS else gdal_warp_memory, gdal_num_threads,
+                                    get_target_grid(context) if USETARGETGRID else None)
+
+    # Save raster data to an array
+    print(season_alias + ", Importing Raster ...")
+    with timer("import 32634", season=season_alias):
+        original_array = rc.raster_to_array(season_file_epsg32634, mask=True)
+
+        # Convert all no data cells (no data value of the raster) into numpy nan values
+        original_array = np.ma.filled(original_array, np.nan)
+
+        # Get the gt (geotransform) information from the original raster file
+        gt_original, proj_original = rc.get_raster_data(season_file_epsg32634)  # Get gt information from the file
+
+    xyz_vrt_file = xyz_csv_file.replace(".csv", ".vrt")
+    if interpolation_engine == 'kdtree':
+        # Get the coordinates of the center of all the cells WITH VALUES
+        print(season_alias + ", Preparing points ...")
+        with timer("points", season=season_alias):
+            xyz_array = rs.get_raster_points(original_array, gt_original)
+
+        # Interpolate the points directly with the KD-tree engine
+        print(season_alias + ", Interpolating target area...")
+        with timer("interpolation", season=season_alias):
+            interpolated_array = rs.idw_interpolate(xyz_array, context["snap_data"], context["cell_resolution"])
+            rc.array_to_raster(interpolation_file, interpolated_array, context["snap_gt"], context["snap_proj"])
+    else:
+        # Stream the XYZ coordinates of the cells WITH VALUES in chunks to a .csv file
+        print(season_alias + ", Exporting CSV ...")
+        with timer("points", season=season_alias):
+            rs.save_csv_chunks(rs.iter_raster_points(original_array, gt_original), xyz_csv_file)
+
+        # Create a .vrt file from the .csv in order to be read by the gdal grid command
+        print(season_alias + ", Generating VRT ...")
+        with timer("csv/vrt", season=season_alias):
+            xyz_vrt_file = rs.generate_vrt_file(xyz_csv_file)
+
+        # Interpolate and resample points using GDAL_Grid - for interpolation a brush is used to merge the pixels
+        print(season_alias + ", Interpolating target area...")
+        with timer("interpolation", season=season_alias):
+            rs.interpolate_points(xyz_vrt_file, interpolation_file, context["snap_data"], context["cell_resolution"])
+
+    # Clip the resampled raster to the extent of the shape file
+    print(season_alias + ", Clipping target area...")
+    clipped_array, clipped_gt, statistics = None, None, None
+    with timer("clip", season=season_alias):
+        if USEMASKCLIP:
+            interpolated_array = rc.raster_to_array(interpolation_file, mask=False)
+            gt_interpolation, proj_interpolation = rc.get_raster_data(interpolation_file)
+            if gt_interpolation[5] > 0:  # gdal_grid writes the rows from south to north
+                interpolated_array = interpolated_array[::-1]
+            clipped_array, clipped_gt, statistics = export_clipped_array(interpolated_array, season_files["finalized"],
+                                                                         context)
+        else:
+            sh.check_task_lock(season_files["finalized"])
+            statistics = rc.clip(context["shape_file"], season_files["finalized"], interpolation_file,
+                                 statistics_histogram_bins, go.get_output_kwargs()["overview_levels"],
+                                 **go.get_warp_kwargs(output=True))
+
+    print(season_alias + ", Erasing tmp ...")
+    # Erase .csv file with points
+    if os.path.exists(xyz_csv_file):
+        os.remove(xyz_csv_file)
+
+    # Erase the vrt file
+    if os.path.exists(xyz_vrt_file):
+        os.remove(xyz_vrt_file)
+
+    if not (USELOG):
+        # Erase the interpolation file
+        if os.path.exists(interpolation_file):
+            os.remove(interpolation_file)
+
+        # Erase the epsg:4326 tif
+        if os.path.exists(season_file_epsg4326):
+            os.remove(season_file_epsg4326)
+
+        # Erase the epsg:32634 tif
+        if os.path.exists(season_file_epsg32634):
+            os.remove(season_file_epsg32634)
+
+    return clipped_array, clipped_gt, statistics
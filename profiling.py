@@ -0,0 +1,189 @@
+"""
+Module contains the stage instrumentation of the pipeline (PROFILE). Every named stage (nc import, C-factor application,
+reprojection, interpolation, clip, ...) is timed per nc file and season. For each stage the peak memory and the bytes
+read and written by the process are recorded. The records are written to a .json and .csv run report and can be
+summarized per stage on the console.
+
+The I/O counters and the traced peak memory are process-wide. If a stage overlaps with a stage of another thread (e.g.
+the reader thread of the prefetching pipeline, see pipeline.read_files), they include the other thread's work, so they
+are not recorded for the stage (None, marked as overlapped). The time and the peak resident memory of the process
+(max_rss_mb) are always recorded. Set prefetch_files=0 to get the I/O and peak memory of every stage.
+"""
+from config import *
+import contextlib
+import csv
+import resource
+import tracemalloc
+
+# Stages which are running (one state per stage), so that overlapping stages of different threads are recognized
+_active_stages = []
+_active_stages_lock = threading.Lock()
+
+
+def get_io_counters():
+    """
+    Returns the number of bytes read and written by the process so far (Linux /proc/self/io, including reads from the
+    page cache). On other systems the counters are 0.
+
+    :return: tuple, with the bytes read and the bytes written
+    """
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            counters = dict(line.split(':') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def get_max_rss():
+    """
+    Returns the peak resident memory of the process so far in MB.
+
+    :return: float, with the peak resident memory (MB)
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on macOS, KB on Linux
+        return max_rss / 1048576
+    return max_rss / 1024
+
+
+@contextlib.contextmanager
+def stage_timer(records, stage, **labels):
+    """
+    Context manager which times a stage and appends its record to a list. The I/O and peak memory of a stage which
+    overlaps with a stage of another thread are not recorded (see the module description).
+
+    :param records: list, to which the stage record is appended
+    :param stage: str, name of the stage
+    :param labels: additional fields of the record (e.g. nc_file, season)
+    """
+    state = {"thread": threading.get_ident(), "overlapped": False}
+    with _active_stages_lock:
+        other_stages = [active for active in _active_stages if active["thread"] != state["thread"]]
+        if other_stages:
+            state["overlapped"] = True
+            for active in other_stages:
+                active["overlapped"] = True
+        # The traced peak is only reset if no other stage is running (it would lose the other stage's peak)
+        if profile_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if not _active_stages:
+                tracemalloc.reset_peak()
+        _active_stages.append(state)
+    read_start, written_start = get_io_counters()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        read_stop, written_stop = get_io_counters()
+        with _active_stages_lock:
+            _active_stages.remove(state)
+            peak_memory = tracemalloc.get_traced_memory()[1] / 1048576 if profile_memory else None
+        overlapped = state["overlapped"]
+        record = {"stage": stage, "nc_file": None, "season": None}
+        record.update(labels)
+        record.update({
+            "seconds": seconds,
+            "peak_memory_mb": None if overlapped else peak_memory,
+            "max_rss_mb": get_max_rss(),
+            "bytes_read": None if overlapped else read_stop - read_start,
+            "bytes_written": None if overlapped else written_stop - written_start,
+            "overlapped": overlapped,
+        })
+        records.append(record)
+
+
+def null_timer(stage, **labels):
+    """
+    Stage timer which does not record anything (PROFILE=False).
+
+    :param stage: str, name of the stage
+    :param labels: additional fields of the record
+    """
+    return contextlib.nullcontext()
+
+
+def get_stage_timer(records, **labels):
+    """
+    Returns a stage timer which appends its records to the given list and adds the given labels to every record.
+
+    :param records: list, to which the stage records are appended (None to disable the timer)
+    :param labels: fields of every record (e.g. nc_file)
+    :return: function, which is called as timer(stage, **more_labels) and returns a context manager
+    """
+    if records is None:
+        return null_timer
+
+    def timer(stage, **more_labels):
+        return stage_timer(records, stage, **labels, **more_labels)
+
+    return timer
+
+
+def summarize_stages(records):
+    """
+    Sums up the stage records per stage.
+
+    :param records: list of dicts, with the stage records
+    :return: list of dicts, with the number of calls, total and maximum time, peak memory and bytes per stage (bytes
+    and peak memory of the calls which did not overlap with another thread, see overlapped_calls)
+    """
+    summary = {}
+    for record in records:
+        stage = summary.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "overlapped_calls": 0,
+                                                     "seconds": 0.0, "max_seconds": 0.0, "peak_memory_mb": None,
+                                                     "max_rss_mb": 0.0, "bytes_read": 0, "bytes_written": 0})
+        stage["calls"] += 1
+        if record.get("overlapped"):
+            stage["overlapped_calls"] += 1
+        stage["seconds"] += record["seconds"]
+        stage["max_seconds"] = max(stage["max_seconds"], record["seconds"])
+        if record["peak_memory_mb"] is not None:
+            stage["peak_memory_mb"] = max(stage["peak_memory_mb"] or 0.0, record["peak_memory_mb"])
+        stage["max_rss_mb"] = max(stage["max_rss_mb"], record["max_rss_mb"])
+        stage["bytes_read"] += record["bytes_read"] or 0
+        stage["bytes_written"] += record["bytes_written"] or 0
+    return sorted(summary.values(), key=lambda stage: stage["seconds"], reverse=True)
+
+
+def write_report(records, report_path, total_time=None):
+    """
+    Writes the stage records to a .json report (records and summary per stage) and a .csv file (records). The I/O and
+    peak memory of overlapped stages are empty (see the module description).
+
+    :param records: list of dicts, with the stage records
+    :param report_path: str, path of the report without extension
+    :param total_time: float, (optional) total run time in seconds
+    """
+    with open(report_path + '.json', 'w') as json_file:
+        json.dump({"total_seconds": total_time,
+                   "note": "bytes_read, bytes_written and peak_memory_mb are process-wide and therefore null for the "
+                           "stages which overlapped with a stage of another thread (overlapped, e.g. prefetching)",
+                   "summary": summarize_stages(records), "stages": records}, json_file, indent=1)
+
+    fields = ["nc_file", "season", "stage", "seconds", "peak_memory_mb", "max_rss_mb", "bytes_read", "bytes_written",
+              "overlapped"]
+    with open(report_path + '.csv', 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def print_summary(records):
+    """
+    Prints the time, peak memory and I/O per stage, sorted by the total time.
+
+    :param records: list of dicts, with the stage records
+    """
+    print("{:<22} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}".format("Stage", "Calls", "Total [s]", "Max [s]",
+                                                                  "Peak [MB]", "Read [MB]", "Write [MB]"))
+    for stage in summarize_stages(records):
+        peak_memory = stage["peak_memory_mb"] if stage["peak_memory_mb"] is not None else stage["max_rss_mb"]
+        print("{:<22} {:>6} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            stage["stage"], stage["calls"], stage["seconds"], stage["max_seconds"], peak_memory,
+            stage["bytes_read"] / 1048576, stage["bytes_written"] / 1048576))
+    if any(record.get("overlapped") for record in records):
+        print("Stages which overlapped with another thread (prefetching) are left out of Read, Write and the traced "
+              "peak memory")
@@ -1,6 +1,8 @@
 # import all needed modules from the python standard library
 try:
     import glob
+    import hashlib
+    import json
     import logging
     import math
     import os
@@ -9,25 +11,21 @@ try:
     import datetime
     import calendar
     import re
+    import uuid
 except ModuleNotFoundError as b:
-    print('ModuleNotFoundError: Missing basic libraries (required: glob, logging, math, os, sys, time, datetime, '
-          'calendar, re')
+    print('ModuleNotFoundError: Missing basic libraries (required: glob, hashlib, json, logging, math, os, sys, time, '
+          'datetime, calendar, re, uuid')
     print(b)
 
-# import additional python libraries
+# import additional python libraries (gdal and ogr are imported at their first use, see config.LazyImport)
 try:
-    from osgeo import gdal
-    from osgeo import ogr
-    import matplotlib.pyplot as plt
-    import numpy as np
-    import pandas as pd
-    import scipy
-    from tqdm import tqdm
-except ModuleNotFoundError as e:
-    print('ModuleNotFoundError: Missing fundamental packages (required: gdal, maptlotlib.pyplot, numpy, '
-          'pandas, rasterstats, scipy, tqdm')
+    from config import np, gdal, ogr
+except ImportError as e:
+    print('ImportError: Missing fundamental packages (required: gdal, numpy)')
     print(e)
 
+from manifest import get_file_signature
+
 """
 Author: María Fernanda Morales 
 
@@ -120,7 +118,298 @@ def raster_to_array(raster_path, mask):
         return array
 
 
-def clip(clip_path, save_path, original_raster):
+def get_cutline_mask(clip_path, gt, proj, x_size, y_size):
+    """
+    Function rasterizes the shape file onto a raster grid (e.g. the snap raster). As in gdalwarp -cutline, the cells
+    whose center lies inside the polygons are inside the mask. The window of the mask corresponds to -crop_to_cutline.
+
+    Args:
+    :param clip_path: string, path where the .shp file is located
+    :param gt: tuple, with the GEOTransform of the grid
+    :param proj: string, with the projection of the grid (WKT)
+    :param x_size: int, number of columns of the grid
+    :param y_size: int, number of rows of the grid
+
+    :return: np.array (bool) with the mask of the whole grid; tuple with the window of the mask (row offset, column
+    offset, rows, columns)
+    """
+    raster = gdal.GetDriverByName("MEM").Create('', x_size, y_size, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform(gt)
+    raster.SetProjection(proj)
+
+    shape = ogr.Open(clip_path)
+    gdal.RasterizeLayer(raster, [1], shape.GetLayer(), burn_values=[1])
+    mask = raster.GetRasterBand(1).ReadAsArray().astype(bool)
+    shape = None
+    raster = None
+
+    rows = np.nonzero(mask.any(axis=1))[0]
+    columns = np.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        raise ValueError("The shape file " + clip_path + " does not overlap the raster grid")
+    window = (int(rows[0]), int(columns[0]), int(rows[-1] - rows[0] + 1), int(columns[-1] - columns[0] + 1))
+
+    return mask, window
+
+
+def get_window_geotransform(gt, window):
+    """
+    Function returns the GEOTransform of a window of a raster grid
+
+    Args:
+    :param gt: tuple, with the GEOTransform of the raster grid
+    :param window: tuple, with the window (row offset, column offset, rows, columns)
+
+    :return: tuple with the GEOTransform of the window
+    """
+    row_off, col_off = window[0], window[1]
+    return (gt[0] + col_off * gt[1] + row_off * gt[2], gt[1], gt[2],
+            gt[3] + col_off * gt[4] + row_off * gt[5], gt[4], gt[5])
+
+
+def get_cached_cutline_mask(clip_path, gt, proj, x_size, y_size, cache_folder):
+    """
+    Function returns the cutline mask of the shape file on a raster grid, cropped to its window (see get_cutline_mask).
+    The mask is rasterized only once per shape file and grid and is then loaded from a .npz file in the cache folder
+
+    Args:
+    :param clip_path: string, path where the .shp file is located
+    :param gt: tuple, with the GEOTransform of the grid
+    :param proj: string, with the projection of the grid (WKT)
+    :param x_size: int, number of columns of the grid
+    :param y_size: int, number of rows of the grid
+    :param cache_folder: string, folder where the masks are cached
+
+    :return: np.array (bool) with the mask, cropped to the window; tuple with the window of the mask (row offset,
+    column offset, rows, columns)
+    """
+    key_data = [get_file_signature(clip_path), list(gt), proj, x_size, y_size]
+    key = hashlib.sha1(json.dumps(key_data).encode()).hexdigest()
+    cache_file = cache_folder + '/mask_' + key + '.npz'
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as npz_file:
+            return npz_file["mask"], tuple(int(value) for value in npz_file["window"])
+
+    mask, window = get_cutline_mask(clip_path, gt, proj, x_size, y_size)
+    clip_mask = mask[window[0]:window[0] + window[2], window[1]:window[1] + window[3]]
+
+    # Write under a temporary name, so that parallel processes never read an incomplete file
+    if not (os.path.exists(cache_folder)):
+        os.makedirs(cache_folder, exist_ok=True)
+    tmp_file = cache_file + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_file, 'wb') as npz_file:
+        np.savez_compressed(npz_file, mask=clip_mask, window=np.array(window))
+    os.replace(tmp_file, cache_file)
+
+    return clip_mask, window
+
+
+def get_feature_labels(clip_path, gt, proj, x_size, y_size, name_field=None):
+    """
+    Function rasterizes every feature (polygon) of the shape file onto a raster grid (e.g. the snap raster) with its
+    own label (1, 2, ... in the order of the features; 0 outside of all features). As in gdalwarp -cutline, the cells
+    whose center lies inside a polygon get its label. Where polygons overlap, the cell gets the label of the last one
+
+    Args:
+    :param clip_path: string, path where the .shp file is located
+    :param gt: tuple, with the GEOTransform of the grid
+    :param proj: string, with the projection of the grid (WKT)
+    :param x_size: int, number of columns of the grid
+    :param y_size: int, number of rows of the grid
+    :param name_field: string, (optional) attribute with the feature names. If None, the feature IDs are used
+
+    :return: np.array (int32) with the label raster; list with the feature names (name of label i at index i - 1)
+    """
+    shape = ogr.Open(clip_path)
+    layer = shape.GetLayer()
+
+    # Copy the polygons to an in-memory layer with the label as attribute
+    label_source = ogr.GetDriverByName("Memory").CreateDataSource('')
+    label_layer = label_source.CreateLayer("labels", layer.GetSpatialRef(), ogr.wkbMultiPolygon)
+    label_layer.CreateField(ogr.FieldDefn("label", ogr.OFTInteger))
+    feature_names = []
+    for feature in layer:
+        label_feature = ogr.Feature(label_layer.GetLayerDefn())
+        label_feature.SetGeometry(feature.GetGeometryRef())
+        label_feature.SetField("label", len(feature_names) + 1)
+        label_layer.CreateFeature(label_feature)
+        feature_names.append(str(feature.GetField(name_field) if name_field else feature.GetFID()))
+
+    raster = gdal.GetDriverByName("MEM").Create('', x_size, y_size, 1, gdal.GDT_Int32)
+    raster.SetGeoTransform(gt)
+    raster.SetProjection(proj)
+    gdal.RasterizeLayer(raster, [1], label_layer, options=["ATTRIBUTE=label"])
+    labels = raster.GetRasterBand(1).ReadAsArray().astype(np.int32)
+    raster = None
+    label_source = None
+    shape = None
+
+    return labels, feature_names
+
+
+def get_cached_feature_labels(clip_path, gt, proj, x_size, y_size, cache_folder, name_field=None):
+    """
+    Function returns the label raster of the shape file features on a raster grid (see get_feature_labels). The label
+    raster is rasterized only once per shape file and grid and is then loaded from a .npz file in the cache folder
+
+    Args:
+    :param clip_path: string, path where the .shp file is located
+    :param gt: tuple, with the GEOTransform of the grid
+    :param proj: string, with the projection of the grid (WKT)
+    :param x_size: int, number of columns of the grid
+    :param y_size: int, number of rows of the grid
+    :param cache_folder: string, folder where the label rasters are cached
+    :param name_field: string, (optional) attribute with the feature names
+
+    :return: np.array (int32) with the label raster; list with the feature names
+    """
+    key_data = [get_file_signature(clip_path), list(gt), proj, x_size, y_size, name_field]
+    key = hashlib.sha1(json.dumps(key_data).encode()).hexdigest()
+    cache_file = cache_folder + '/labels_' + key + '.npz'
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as npz_file:
+            return npz_file["labels"], [str(name) for name in npz_file["names"]]
+
+    labels, feature_names = get_feature_labels(clip_path, gt, proj, x_size, y_size, name_field)
+
+    if not (os.path.exists(cache_folder)):
+        os.makedirs(cache_folder, exist_ok=True)
+    tmp_file = cache_file + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_file, 'wb') as npz_file:
+        np.savez_compressed(npz_file, labels=labels, names=np.array(feature_names))
+    os.replace(tmp_file, cache_file)
+
+    return labels, feature_names
+
+
+def crop_to_grid(array, gt, target_gt, target_shape, fill_value=0):
+    """
+    Function crops (and pads) an array to a target grid with the same cell size and alignment, e.g. a label raster on
+    the snap raster grid to the grid of a clipped raster
+
+    Args:
+    :param array: np.array, with the raster data
+    :param gt: tuple, with the GEOTransform of the array
+    :param target_gt: tuple, with the GEOTransform of the target grid
+    :param target_shape: tuple, with the number of rows and columns of the target grid
+    :param fill_value: value of the target cells outside of the array
+
+    :return: np.array with the raster data on the target grid
+    """
+    row_off = int(round((gt[3] - target_gt[3]) / gt[1]))
+    col_off = int(round((target_gt[0] - gt[0]) / gt[1]))
+    cropped = np.full(target_shape, fill_value, dtype=array.dtype)
+
+    row_start, col_start = max(row_off, 0), max(col_off, 0)
+    row_stop = min(row_off + target_shape[0], array.shape[0])
+    col_stop = min(col_off + target_shape[1], array.shape[1])
+    if row_stop > row_start and col_stop > col_start:
+        cropped[row_start - row_off:row_stop - row_off, col_start - col_off:col_stop - col_off] = \
+            array[row_start:row_stop, col_start:col_stop]
+    return cropped
+
+
+def get_zonal_statistics(array, labels, feature_count, no_data=-9999):
+    """
+    Function calculates the statistics (count, mean, min, max) of the array values inside each feature of a label
+    raster in one pass
+
+    Args:
+    :param array: np.array, with the raster data
+    :param labels: np.array (int), with the label raster on the same grid (0 outside of all features)
+    :param feature_count: int, number of features (highest label)
+    :param no_data: float, no data value of the array (not included in the statistics)
+
+    :return: list of dicts, with the label, count, mean, min and max of each feature
+    """
+    valid = (labels > 0) & (array != no_data) & ~np.isnan(array)
+    values = array[valid].astype(np.float64)
+    value_labels = labels[valid]
+
+    count = np.bincount(value_labels, minlength=feature_count + 1)
+    total = np.bincount(value_labels, weights=values, minlength=feature_count + 1)
+    minimum = np.full(feature_count + 1, np.inf)
+    maximum = np.full(feature_count + 1, -np.inf)
+    np.minimum.at(minimum, value_labels, values)
+    np.maximum.at(maximum, value_labels, values)
+
+    statistics = []
+    for label in range(1, feature_count + 1):
+        has_values = count[label] > 0
+        statistics.append({
+            "label": label,
+            "count": int(count[label]),
+            "mean": total[label] / count[label] if has_values else None,
+            "min": minimum[label] if has_values else None,
+            "max": maximum[label] if has_values else None,
+        })
+    return statistics
+
+
+def clip_array(array, clip_mask, window, no_data=-9999):
+    """
+    Function clips an array on the grid of the mask (e.g. the interpolated raster on the snap raster grid) to the
+    window of the mask and sets all cells outside of the shape file to no_data (same result as clip)
+
+    Args:
+    :param array: np.array, with the raster data on the full grid (north up)
+    :param clip_mask: np.array (bool) with the mask, cropped to the window (see get_cached_cutline_mask)
+    :param window: tuple with the window of the mask (row offset, column offset, rows, columns)
+    :param no_data: float, value of the cells outside of the shape file
+
+    :return: np.array (float32) with the clipped raster
+    """
+    row_off, col_off, rows, columns = window
+    clipped = np.array(array[row_off:row_off + rows, col_off:col_off + columns], dtype=np.float32)
+    clipped[~clip_mask] = no_data
+    return clipped
+
+
+def get_array_statistics(array, no_data=-9999, histogram_bins=0):
+    """
+    Function calculates the statistics of the valid cells of a raster array in memory (replaces gdalinfo -stats, which
+    reads the written raster file again)
+
+    Args:
+    :param array: np.array, with the raster data
+    :param no_data: float, no data value of the raster (np.nan cells are not valid either)
+    :param histogram_bins: int, (optional) number of histogram bins between the minimum and maximum (0: no histogram)
+
+    :return: dict, with the number of valid cells and their minimum, maximum, mean and standard deviation (None if the
+    raster has no valid cells) and the histogram counts (if histogram_bins > 0)
+    """
+    valid = array[~np.isnan(array) & (array != no_data)]
+    statistics = {"valid_count": int(valid.size), "min": None, "max": None, "mean": None, "std": None}
+    if valid.size > 0:
+        valid = valid.astype(np.float64)
+        statistics.update({"min": float(valid.min()), "max": float(valid.max()), "mean": float(valid.mean()),
+                           "std": float(valid.std())})
+    if histogram_bins > 0:
+        counts = np.histogram(valid, bins=histogram_bins, range=(statistics["min"] or 0, statistics["max"] or 0))[0]
+        statistics["histogram"] = counts.tolist()
+    return statistics
+
+
+def set_band_statistics(band, statistics):
+    """
+    Function embeds the statistics of a raster band in its metadata (STATISTICS_* items, read by gdalinfo, QGIS,...)
+
+    Args:
+    :param band: gdal.Band, raster band
+    :param statistics: dict, with the statistics of the band (see get_array_statistics)
+
+    :return: ---
+    """
+    if statistics["valid_count"] > 0:
+        band.SetStatistics(statistics["min"], statistics["max"], statistics["mean"], statistics["std"])
+    band.SetMetadataItem("STATISTICS_VALID_COUNT", str(statistics["valid_count"]))
+    if "histogram" in statistics:
+        band.SetMetadataItem("STATISTICS_HISTOGRAM", json.dumps(statistics["histogram"]))
+
+
+def clip(clip_path, save_path, original_raster, histogram_bins=0, overview_levels=None, **warp_kwargs):
     """
     Function clips the raster to the same extents as the snap raster (same no-data cells) using gdal.warp
 
@@ -128,17 +417,161 @@ def clip(clip_path, save_path, original_raster):
     :param clip_path: string, path where the .shp file, with which to clip input raster
     :param save_path: string, file path (including extension and name) where to save the clipped raster
     :param original_raster: string, path of raster to clip to shape extent (interpolated raster)
+    :param histogram_bins: int, (optional) number of histogram bins of the statistics (0: no histogram)
+    :param overview_levels: list, (optional) levels of the internal overviews (e.g. [2, 4, 8]), GTiff format only
+    :param warp_kwargs: (optional) additional options of gdal.Warp (format, threads, warp memory, creation options,
+    ...)
 
-    :return: ---
+    :return: dict, with the statistics of the clipped raster (see get_array_statistics)
     """
     # Clip the interpolated (resampled) precipitation raster with the bounding raster shapefile from step 3
-    os.system(
-        "gdalwarp -cutline " + clip_path +
-        " -crop_to_cutline -dstnodata -9999 -overwrite --config GDALWARP_IGNORE_BAD_CUTLINE YES "
-        + original_raster + " " + save_path)
+    return clip_dataset(clip_path, save_path, original_raster, histogram_bins, overview_levels, **warp_kwargs)
+
+
+def clip_dataset(clip_path, save_path, dataset, histogram_bins=0, overview_levels=None, **warp_kwargs):
+    """
+    Function clips an (in-memory) gdal dataset or a raster file to the extent of the shape file using the gdal.Warp
+    API (same as gdalwarp -cutline -crop_to_cutline -dstnodata -9999 -overwrite).
+
+    Args:
+    :param clip_path: string, path where the .shp file, with which to clip input raster
+    :param save_path: string, file path (including extension and name) where to save the clipped raster
+    :param dataset: gdal.Dataset or string, raster to clip to shape extent (interpolated raster)
+    :param histogram_bins: int, (optional) number of histogram bins of the statistics (0: no histogram)
+    :param overview_levels: list, (optional) levels of the internal overviews (e.g. [2, 4, 8]), GTiff format only
+    :param warp_kwargs: (optional) additional options of gdal.Warp (format, threads, warp memory, creation options,
+    ...)
 
-    # Calculate the info for the clipped raster
-    os.system("gdalinfo -stats " + save_path)
+    :return: dict, with the statistics of the clipped raster (see get_array_statistics)
+    """
+    gdal.SetConfigOption('GDALWARP_IGNORE_BAD_CUTLINE', 'YES')
+    warp_kwargs.setdefault("format", "GTiff")
+    cog_options = None
+    if warp_kwargs["format"] == "COG":
+        # The COG driver only supports copies: clip in memory and copy after the statistics are set
+        cog_options = warp_kwargs.pop("creationOptions", [])
+        warp_kwargs["format"] = "MEM"
+    # The clipped raster is written under a temporary name (a new file, gdal.Warp does not warp into an existing
+    # raster) and then renamed, so that an interrupted write never leaves an incomplete raster under save_path
+    tmp_path = get_tmp_path(save_path)
+    try:
+        try:
+            clipped = gdal.Warp(tmp_path if cog_options is None else '', dataset, cutlineDSName=clip_path,
+                                cropToCutline=True, dstNodata=-9999, **warp_kwargs)
+        except RuntimeError as e:  # GDAL exceptions are enabled (see gdal_options.configure_gdal)
+            raise RuntimeError("gdal.Warp failed to clip the raster to " + clip_path + ": " + str(e)) from e
+
+        # Calculate the statistics from the still open clipped raster and embed them in its metadata
+        band = clipped.GetRasterBand(1)
+        statistics = get_array_statistics(band.ReadAsArray(), -9999, histogram_bins)
+        set_band_statistics(band, statistics)
+        if cog_options is not None:
+            gdal.GetDriverByName("COG").CreateCopy(tmp_path, clipped, options=cog_options)
+        elif overview_levels:
+            clipped.BuildOverviews("AVERAGE", overview_levels)
+        band = clipped = None  # Close (and write) the clipped raster before it is renamed
+        os.replace(tmp_path, save_path)
+    except Exception:
+        remove_tmp_file(tmp_path)
+        raise
+    return statistics
+
+
+def array_to_dataset(array, gt, proj, no_data=None, save_path='', driver_name="MEM", statistics=None, options=None):
+    """
+    Function creates a single band float32 gdal dataset (in memory by default) from an array
+
+    Args:
+    :param array: np.array, with the raster data
+    :param gt: tuple, with the GEOTransform of the raster
+    :param proj: string, with the projection of the raster (WKT)
+    :param no_data: float, (optional) no data value of the raster
+    :param save_path: string, file path of the raster (empty for the MEM driver)
+    :param driver_name: string, gdal driver name
+    :param statistics: dict, (optional) statistics of the array, which are embedded in the metadata (see
+    get_array_statistics)
+    :param options: list, (optional) creation options of the driver (e.g. ['COMPRESS=DEFLATE'])
+
+    :return: gdal.Dataset
+    """
+    driver = gdal.GetDriverByName(driver_name)
+    raster = driver.Create(save_path, array.shape[1], array.shape[0], 1, gdal.GDT_Float32, options=options or [])
+    raster.SetGeoTransform(gt)
+    raster.SetProjection(proj)
+    band = raster.GetRasterBand(1)
+    if no_data is not None:
+        band.SetNoDataValue(no_data)
+    band.WriteArray(array)
+    if statistics is not None:
+        set_band_statistics(band, statistics)
+    band.FlushCache()
+    return raster
+
+
+def array_to_raster(save_path, array, gt, proj, no_data=None, statistics=None, options=None, driver_name="GTiff",
+                    overview_levels=None):
+    """
+    Function saves an array as a single band float32 .tif raster file (GeoTIFF or Cloud-Optimized GeoTIFF)
+
+    Args:
+    :param save_path: string, file path (including extension and name) where to save the raster
+    :param array: np.array, with the raster data
+    :param gt: tuple, with the GEOTransform of the raster
+    :param proj: string, with the projection of the raster (WKT)
+    :param no_data: float, (optional) no data value of the raster
+    :param statistics: dict, (optional) statistics of the array, which are embedded in the metadata (see
+    get_array_statistics)
+    :param options: list, (optional) creation options of the GeoTIFF (e.g. ['COMPRESS=DEFLATE'])
+    :param driver_name: string, (optional) gdal driver name ("GTiff" or "COG")
+    :param overview_levels: list, (optional) levels of the internal overviews (e.g. [2, 4, 8]), GTiff driver only
+
+    :return: ---
+    """
+    # The raster is written under a temporary name and then renamed, so that an interrupted write never leaves an
+    # incomplete raster under save_path
+    tmp_path = get_tmp_path(save_path)
+    try:
+        if driver_name == "COG":
+            # The COG driver only supports copies: the raster is created in memory and copied with its overviews
+            raster = array_to_dataset(array, gt, proj, no_data, statistics=statistics)
+            gdal.GetDriverByName("COG").CreateCopy(tmp_path, raster, options=options or [])
+        else:
+            raster = array_to_dataset(array, gt, proj, no_data, tmp_path, driver_name, statistics, options)
+            if overview_levels:
+                raster.BuildOverviews("AVERAGE", overview_levels)
+        raster = None  # Close the raster file
+        os.replace(tmp_path, save_path)
+    except Exception:
+        remove_tmp_file(tmp_path)
+        raise
+
+
+def get_tmp_path(save_path):
+    """
+    Function returns a unique temporary path next to a file path (same folder and extension), under which the file is
+    written before it is renamed to the file path.
+
+    Args:
+    :param save_path: string, file path
+
+    :return: string, with the temporary file path
+    """
+    root, extension = os.path.splitext(save_path)
+    return root + "." + uuid.uuid4().hex + ".tmp" + extension
+
+
+def remove_tmp_file(tmp_path):
+    """
+    Function removes a temporary file (and its auxiliary file), if it exists.
+
+    Args:
+    :param tmp_path: string, temporary file path (see get_tmp_path)
+
+    :return: ---
+    """
+    for path in [tmp_path, tmp_path + ".aux.xml"]:
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def merge(raster_list, merge_name):
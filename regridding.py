@@ -0,0 +1,266 @@
+"""
+Module contains the regridding operator, which maps the cells of the lat/lon C-factor array directly to the cells of
+the clipped target raster. The operator folds the nearest neighbor reprojection to EPSG:32634, the inverse distance
+interpolation to the snap raster (same weights as resample_snap.idw_interpolate) and the clip to the shape file into
+flat arrays: for every clipped target cell, the interpolation points within the search radius (sorted by distance) with
+their lat/lon source cell, inverse distance weight (not normalized) and whether they coincide with the target cell. The
+operator only depends on the grids (with USETARGETGRID on the fixed target grid, as the in-memory path), so it is
+calculated once, cached on disk and applied to every season array: the nearest valid points of each target cell are
+selected, their weights normalized and the weighted sums formed with np.bincount (see apply_operator).
+"""
+from functions import *
+from config import *
+import raster_calculations as rc
+import resample_snap as rs
+from manifest import get_file_signature
+
+
+def get_valid_source_mask(season_array):
+    """
+    Returns the cells of a C-factor array which are used as interpolation points (no np.nan, the no data value of the
+    C-factor arrays)
+
+    :param season_array: np.array, with the C-factors of one season in lat/lon
+    :return: np.array (bool), True for the valid cells
+    """
+    return ~np.isnan(season_array)
+
+
+def get_operator_key(src_shape, src_transform, context, target_grid=None):
+    """
+    Returns the cache key of an operator. The key changes with the source grid, the target grid of the reprojection,
+    the snap raster, the shape file and the interpolation settings. The valid source cells are not part of the key,
+    they are selected when the operator is applied (see apply_operator).
+
+    :param src_shape: tuple, with the number of rows and columns of the source grid
+    :param src_transform: rasterio.transform.Affine, with the transform of the source grid
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param target_grid: tuple, (optional) with the transform of the fixed EPSG:32634 grid and the source cell index of
+    each of its cells (-1 if not covered), see pipeline.get_target_index. None: the source grid is reprojected
+    :return: str, with the key (hex digest)
+    """
+    key_data = {
+        "src_shape": list(src_shape),
+        "src_transform": list(src_transform)[:6],
+        "target_grid": list(target_grid[0])[:6] + list(target_grid[1].shape) if target_grid is not None else None,
+        "snap_gt": list(context["snap_gt"]),
+        "snap_proj": context["snap_proj"],
+        "shape_file": get_file_signature(context["shape_file"]),
+        "interpolation": [interpolation_power, interpolation_smoothing, interpolation_max_points, interpolation_radius],
+    }
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def get_candidates(tree, target_xy, radius=interpolation_radius, workers=interpolation_threads):
+    """
+    Searches all points within the radius of each target coordinate, sorted by distance. Unlike rs.get_idw_weights, the
+    number of points is not limited to interpolation_max_points, so that the nearest valid points can still be selected
+    when the operator is applied.
+
+    :param tree: scipy.spatial.cKDTree, spatial index with the X,Y point coordinates
+    :param target_xy: np.array with (X,Y) coordinates of the target cell centers
+    :param radius: float, search radius
+    :param workers: int, number of threads of the neighbor search (-1: all cores)
+    :return: np.array (float64) with the distances and np.array (int) with the point indices of each target (n targets x
+    max. number of points within the radius, np.inf and tree.n for missing points)
+    """
+    # As in gdal_grid, points at exactly the radius are used (the bound of tree.query is exclusive)
+    radius = np.nextafter(radius, np.inf)
+    counts = tree.query_ball_point(target_xy, r=radius, return_length=True, workers=workers)
+    k = max(int(np.max(counts)) if len(counts) else 0, 1)
+    distances, indices = tree.query(target_xy, k=k, distance_upper_bound=radius, workers=workers)
+    return distances.reshape(len(target_xy), k), indices.reshape(len(target_xy), k)  # k=1 returns 1D arrays
+
+
+def build_operator(src_shape, src_transform, context, target_grid=None):
+    """
+    Calculates the regridding operator of a source grid. For every clipped target cell, the operator holds all
+    interpolation points within interpolation_radius (sorted by distance) with their source cell and inverse distance
+    weight (not normalized, same weights as rs.get_idw_weights).
+
+    :param src_shape: tuple, with the number of rows and columns of the source grid
+    :param src_transform: rasterio.transform.Affine, with the transform of the source grid
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param target_grid: tuple, (optional) with the transform of the fixed EPSG:32634 grid and the source cell index of
+    each of its cells (-1 if not covered), see pipeline.get_target_index. None: the source grid is reprojected
+    :return: dict, with the points of each target cell (indptr: start of the points of each target cell, sources:
+    source cell index, weights: inverse distance weight, exact: True if the point coincides with the target cell), the
+    clip mask and the clip window (row offset, column offset, rows, columns) on the snap raster
+    """
+    # 1. Source cell index of the cells in EPSG:32634: from the pixel mapping of the fixed target grid (USETARGETGRID)
+    # or by reprojecting the source cell indices (nearest neighbor, as the C-factor arrays)
+    if target_grid is not None:
+        dst_transform, dst_index = target_grid
+    else:
+        src_index = np.arange(src_shape[0] * src_shape[1], dtype=np.float64).reshape(src_shape)
+        dst_transform, width, height = get_target_transform(src_shape, src_transform, '+proj=latlong', "EPSG:32634")
+        dst_index = np.full([height, width], -1, dtype=np.float64)
+        wrp.reproject(
+            source=src_index,
+            destination=dst_index,
+            src_transform=src_transform,
+            src_crs='+proj=latlong',
+            dst_transform=dst_transform,
+            dst_crs="EPSG:32634",
+            src_nodata=-1,
+            dst_nodata=-1,
+            resampling=Resampling.nearest,
+        )
+
+    # 2. Interpolation points: centers of all reprojected cells with a source cell (z = source cell index). Whether the
+    # source cell has a value is only known per season array (see apply_operator)
+    rows, columns = np.nonzero(dst_index >= 0)
+    points = rs.cells_to_points(dst_index, dst_transform.to_gdal(), rows, columns)
+    point_sources = points[:, 2].astype(np.int64)
+    tree = cKDTree(points[:, :2])
+
+    # 3. Target cells: snap raster cells inside the shape file, in the window of the cutline
+    snap_data = context["snap_data"]
+    cell_size = context["cell_resolution"]
+    x_size, y_size = rs.get_grid_size(snap_data, cell_size)
+    clip_mask, window = rc.get_cached_cutline_mask(context["shape_file"], context["snap_gt"], context["snap_proj"],
+                                                   x_size, y_size, context["mask_folder"])
+    row_off, col_off, window_rows, window_columns = window
+    target_rows, target_columns = np.nonzero(clip_mask)
+    target_xy = np.column_stack([snap_data[0] + (col_off + target_columns + 0.5) * cell_size,
+                                 snap_data[1] - (row_off + target_rows + 0.5) * cell_size])
+
+    # 4. Points within the radius of the target cells and their inverse distance weights (in blocks)
+    if len(points) == 0:
+        n_points, sources, weights, exact = [np.zeros(len(target_xy), dtype=np.int64)], [], [], []
+    else:
+        n_points, sources, weights, exact = [], [], [], []
+    block_size = max(1, interpolation_block_rows * window_columns)
+    for start in range(0, len(target_xy) if len(points) else 0, block_size):
+        distances, indices = get_candidates(tree, target_xy[start:start + block_size])
+        found = np.isfinite(distances)
+        r_square = distances[found] ** 2 + interpolation_smoothing ** 2
+        block_exact = r_square < 0.0000000000001
+        n_points.append(found.sum(axis=1))
+        sources.append(point_sources[indices[found]])  # row by row, sorted by distance
+        weights.append(1.0 / np.where(block_exact, 1.0, r_square) ** (interpolation_power / 2.0))
+        exact.append(block_exact)
+
+    n_points = np.concatenate(n_points) if n_points else np.zeros(0, dtype=np.int64)
+    return {
+        "indptr": np.concatenate([[0], np.cumsum(n_points)]).astype(np.int64),
+        "sources": np.concatenate(sources) if sources else np.zeros(0, dtype=np.int64),
+        "weights": np.concatenate(weights) if weights else np.zeros(0, dtype=np.float64),
+        "exact": np.concatenate(exact) if exact else np.zeros(0, dtype=bool),
+        "clip_mask": clip_mask,
+        "window": window,
+    }
+
+
+def save_operator(operator, operator_file):
+    """
+    Saves an operator to a .npz file. The file is written under a temporary name first, so that parallel processes
+    never read an incomplete file.
+
+    :param operator: dict, with the operator (see build_operator)
+    :param operator_file: str, with the path of the .npz file
+    """
+    tmp_file = operator_file + "." + uuid.uuid4().hex + ".tmp"
+    with open(tmp_file, 'wb') as npz_file:
+        np.savez(npz_file, indptr=operator["indptr"], sources=operator["sources"], weights=operator["weights"],
+                 exact=operator["exact"], clip_mask=operator["clip_mask"], window=np.array(operator["window"]))
+    os.replace(tmp_file, operator_file)
+
+
+def load_operator(operator_file):
+    """
+    Loads an operator from a .npz file.
+
+    :param operator_file: str, with the path of the .npz file
+    :return: dict, with the operator (see build_operator)
+    """
+    with np.load(operator_file) as npz_file:
+        return {
+            "indptr": npz_file["indptr"],
+            "sources": npz_file["sources"],
+            "weights": npz_file["weights"],
+            "exact": npz_file["exact"],
+            "clip_mask": npz_file["clip_mask"],
+            "window": tuple(int(value) for value in npz_file["window"]),
+        }
+
+
+def get_operator(src_shape, src_transform, context, target_grid=None):
+    """
+    Returns the regridding operator of a source grid. The operator is taken from the context, loaded from the operator
+    folder or, if it does not exist yet, calculated and saved.
+
+    :param src_shape: tuple, with the number of rows and columns of the source grid
+    :param src_transform: rasterio.transform.Affine, with the transform of the source grid
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param target_grid: tuple, (optional) with the transform of the fixed EPSG:32634 grid and the source cell index of
+    each of its cells (see build_operator)
+    :return: dict, with the operator (see build_operator)
+    """
+    key = get_operator_key(src_shape, src_transform, context, target_grid)
+    operators = context.setdefault("operators", {})
+    if key in operators:
+        return operators[key]
+
+    operator_file = context["operator_folder"] + '/' + key + ".npz"
+    if os.path.exists(operator_file):
+        operator = load_operator(operator_file)
+    else:
+        print("Calculating regridding operator ...")
+        operator = build_operator(src_shape, src_transform, context, target_grid)
+        if not (os.path.exists(context["operator_folder"])):
+            os.makedirs(context["operator_folder"], exist_ok=True)
+        save_operator(operator, operator_file)
+
+    # Target cell of every point (the points of a target cell are stored one after the other)
+    operator["targets"] = np.repeat(np.arange(len(operator["indptr"]) - 1), np.diff(operator["indptr"]))
+    operators[key] = operator
+    return operator
+
+
+def get_rank_in_target(flags, operator):
+    """
+    Counts the flagged points of each target cell in distance order (1 for the nearest flagged point of a target cell).
+
+    :param flags: np.array (bool), with a flag for every point of the operator
+    :param operator: dict, with the operator (see get_operator)
+    :return: np.array (int64), with the running count of the flagged points within their target cell
+    """
+    running = np.cumsum(flags)
+    before = np.concatenate([[0], running])[operator["indptr"][:-1]]
+    return running - before[operator["targets"]]
+
+
+def apply_operator(operator, season_array, valid_mask):
+    """
+    Applies a regridding operator to a C-factor array. Of the points of each target cell, the (max.
+    interpolation_max_points) nearest ones with a valid source cell are used and their weights are normalized, as in
+    rs.get_idw_weights. If a valid point coincides with the target cell, it gets the full weight.
+
+    :param operator: dict, with the operator (see get_operator)
+    :param season_array: np.array, with the C-factors of one season in lat/lon
+    :param valid_mask: np.array (bool), with the valid source cells (see get_valid_source_mask)
+    :return: np.array (float32) with the clipped raster (-9999 outside of the shape file)
+    """
+    n_targets = len(operator["indptr"]) - 1
+    targets = operator["targets"]
+    valid = valid_mask.ravel()[operator["sources"]]
+    used = valid & (get_rank_in_target(valid, operator) <= interpolation_max_points)
+    weights = np.where(used, operator["weights"], 0.0)
+
+    # Targets which coincide with a valid point get the value of the (first) coinciding point
+    exact = used & operator["exact"]
+    if exact.any():
+        exact_targets = np.bincount(targets[exact], minlength=n_targets) > 0
+        first_exact = exact & (get_rank_in_target(exact, operator) == 1)
+        weights = np.where(exact_targets[targets], first_exact.astype(np.float64), weights)
+
+    source = np.where(valid_mask, season_array, 0).astype(np.float64).ravel()
+    weight_sum = np.bincount(targets, weights, minlength=n_targets)
+    values = np.bincount(targets, weights * source[operator["sources"]], minlength=n_targets)
+    has_points = weight_sum > 0
+    values = np.where(has_points, values / np.where(has_points, weight_sum, 1.0), interpolation_nodata)
+
+    clipped = np.full(operator["clip_mask"].shape, -9999, dtype=np.float32)
+    clipped[operator["clip_mask"]] = values
+    return clipped
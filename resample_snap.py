@@ -1,6 +1,7 @@
 
 from config import *
 from functions import get_file_str
+import gdal_options as go
 
 # ----------------Save FUNCTIONS----------------------------------------------------------------------------- #
 
@@ -21,62 +22,127 @@ def save_csv(points, save_name):
     df.to_csv(save_name, index=False, sep=',', na_rep="", decimal='.')
 
 
+def save_csv_chunks(point_chunks, save_name):
+    """
+    Function saves chunks of X, Y, Z point coordinates (e.g. from iter_raster_points) one after the other to the same
+    .csv file, with the corresponding column names
+
+    :param point_chunks: iterable of np.arrays with (X,Y,Z) coordinates of cell centers
+    :param save_name: file path name with which to save the points to .csv format
+    :return:
+    """
+    columns = ["x", "y", "z"]  # Set column names
+    header = True
+    with open(save_name, 'w', newline='') as csv_file:
+        for points in point_chunks:
+            df = pd.DataFrame(data=points, index=None, columns=columns)
+            df.to_csv(csv_file, index=False, header=header, sep=',', na_rep="", decimal='.')
+            header = False
+        if header:  # No points: only write the column names
+            csv_file.write(",".join(columns) + "\n")
+
+
 # ----------------Calculation FUNCTIONS----------------------------------------------------------------------------- #
 
-def get_raster_points(array, gt):
+def get_point_dtype(dtype=np.float64):
     """
-    Function gets the coordinates (X, Y, Z) of the center of all cells that have values and returns an array with the
-    coordinate point data
+    Function returns the structured data type of the point arrays, with the fields x, y and z
 
-    :param array: npp.array with original raster data
-    :param gt: tuple with original raster geotransform data
-    :return: np.array where the coordinate and values of the value cell centers are saved
+    :param dtype: numpy data type of the fields (np.float64 or np.float32)
+    :return: np.dtype with the fields x, y, z
     """
+    return np.dtype([("x", dtype), ("y", dtype), ("z", dtype)])
 
-    # 1. Get [y,x] [rows, columns] coordinates of all cells where there are values (non np.nan)
-    coord = np.argwhere(~np.isnan(array))
-    # print(coord.shape)
 
-    # 2. Initialize an array with the same number of rows as non-zero cell values and 3 columns (X, Y, Z values)
-    points = np.zeros((int(coord.shape[0]) - 1, 3))
+def cells_to_points(array, gt, rows, columns, dtype=np.float64, structured=False):
+    """
+    Function converts the [row, column] indices of raster cells to the (X, Y, Z) coordinates of the cell centers
 
-    # 3. Get upper left corner coordinates from Geotransform (Top left corner X, cell size, 0, Top left corner Y, 0,
+    :param array: np.array with original raster data
+    :param gt: tuple with original raster geotransform data
+    :param rows: np.array with the row index of each cell
+    :param columns: np.array with the column index of each cell
+    :param dtype: numpy data type of the point coordinates and values (np.float64 or np.float32)
+    :param structured: boolean, if True a structured array with the fields x, y, z is returned, otherwise an array with
+    3 columns (X, Y, Z)
+    :return: np.array with the coordinates and values of the cell centers
+    """
+    # Get upper left corner coordinates from Geotransform (Top left corner X, cell size, 0, Top left corner Y, 0,
     # -cell size)
-    upper_left_x = gt[
-        0]  # X coordinate of upper left corner. From this point, all cells go towards the right (positive)
+    upper_left_x = gt[0]  # X coordinate of upper left corner. From this point, all cells go towards the right
     upper_left_y = gt[3]  # Y coordinate of upper left corner. From this point all points go south (negative)
     size = gt[1]  # Cell resolution
 
-    # print("gt: ", gt)
-    # print("Upper Left X: ", upper_left_x, "\nUpper Left Y: ", upper_left_y, "\nSize: ", size)
+    if structured:
+        points = np.empty(len(rows), dtype=get_point_dtype(dtype))
+        points["x"] = upper_left_x + columns * size + (size / 2)
+        points["y"] = upper_left_y - rows * size - (size / 2)
+        points["z"] = array[rows, columns]
+    else:
+        points = np.empty((len(rows), 3), dtype=dtype)
+        points[:, 0] = upper_left_x + columns * size + (size / 2)
+        points[:, 1] = upper_left_y - rows * size - (size / 2)
+        points[:, 2] = array[rows, columns]
+    return points
 
-    for i in range(0, int(coord.shape[0]) - 1):  # go through all cells in coord array
-        # 1.Fill in x coordinate in row 0
-        points[i][0] = upper_left_x + coord[i][1] * size + (size / 2)
 
-        # 2.Fill in x coordinate in row 1
-        points[i][1] = upper_left_y - coord[i][0] * size - (size / 2)
+def get_raster_points(array, gt, dtype=np.float64, structured=False):
+    """
+    Function gets the coordinates (X, Y, Z) of the center of all cells that have values and returns an array with the
+    coordinate point data
 
-        # 3. Fill in the precipitation value in row 2
-        points[i][2] = array[int(coord[i][0])][int(coord[i][1])]
+    :param array: np.array with original raster data
+    :param gt: tuple with original raster geotransform data
+    :param dtype: numpy data type of the point coordinates and values (np.float64 or np.float32)
+    :param structured: boolean, if True a structured array with the fields x, y, z is returned
+    :return: np.array where the coordinate and values of the value cell centers are saved
+    """
+    # Get [y,x] [rows, columns] coordinates of all cells where there are values (non np.nan)
+    rows, columns = np.nonzero(~np.isnan(array))
+    return cells_to_points(array, gt, rows, columns, dtype, structured)
 
-        # print("Index in coord: ", i, " - Row in Array: ", points[i][0], " - Column in array: ", points[i][1],
-        #       " - Value: ", points[i][2] )
 
-    # print("Points: ", points[0][2])
+def iter_raster_points(array, gt, chunk_size=1000000, dtype=np.float64, structured=False):
+    """
+    Function yields the coordinates (X, Y, Z) of the center of all cells that have values in chunks of chunk_size
+    points, so that the points do not have to be held in memory at once
 
-    # # The name of the .csv file must be "file" and it must be in the program working folder for it to be later read
-    # a .vrt file # In the VRT_File function. Does not work otherwise. FIle will be rewritten in each loop and erased
-    # at the end. points_path = "file.csv"  # Create the .csv file name as "file.csv" - SaveCSV(points, points_path)
-    # Save the XYZ coordinates array to a .csv file
+    :param array: np.array with original raster data
+    :param gt: tuple with original raster geotransform data
+    :param chunk_size: int, maximum number of points per chunk
+    :param dtype: numpy data type of the point coordinates and values (np.float64 or np.float32)
+    :param structured: boolean, if True structured arrays with the fields x, y, z are yielded
+    :return: generator of np.arrays with the coordinates and values of the value cell centers
+    """
+    rows, columns = np.nonzero(~np.isnan(array))
+    for start in range(0, len(rows), chunk_size):
+        yield cells_to_points(array, gt, rows[start:start + chunk_size], columns[start:start + chunk_size], dtype,
+                              structured)
 
-    return points  # Return XYZ.csv file path
+
+def get_vrt_xml(csv_file):
+    """
+    Function returns the content of a .vrt file, which reads the point coordinates (x,y,z) from the given .csv file as
+    a point layer in EPSG:32634
+
+    :param csv_file: .csv file path with point coordinates (x,y,z) (can also be a /vsimem/ path)
+    :return: string with the .vrt file content
+    """
+    layer_name = get_file_str(csv_file)
+    return "<OGRVRTDataSource>\n \
+        <OGRVRTLayer name=\"" + layer_name + "\">\n \
+        <SrcDataSource>" + csv_file + "</SrcDataSource>\n \
+        <SrcLayer>" + layer_name + "</SrcLayer> \n \
+        <GeometryType>wkbPoint25D</GeometryType>\n \
+        <LayerSRS>EPSG:32634</LayerSRS>\n \
+        <GeometryField encoding=\"PointFromColumns\" x=\"x\" y=\"y\" z=\"z\"/>\n \
+        </OGRVRTLayer>\n \
+        </OGRVRTDataSource>"
 
 
 def generate_vrt_file(csv_file):
     """
     Function receives a .csv file path, which was created in the "GetRasterPoints" and is then copied to a vrt file.
-    The .csv file MUST BE named "file", since that name is automatically called in the vrt file creation.
 
     :param csv_file: .csv file path with point coordinates (x,y,z) generated in "GetRasterPoints" function
     :return: .vrt file path
@@ -88,30 +154,47 @@ def generate_vrt_file(csv_file):
     if os.path.exists(vrt_file):
         os.remove(vrt_file)
 
-    # Create VRT file with coordinate information (located in file.csv file) :
+    # Create VRT file with coordinate information (located in the .csv file) :
     vrt = open(vrt_file, 'w')  # Open .vrt file
-    # Create the .vrt file with the following code, which remains constant always
-    vrt.write("<OGRVRTDataSource>\n \
-        <OGRVRTLayer name=\"file\">\n \
-        <SrcDataSource>file.csv</SrcDataSource>\n \
-        <SrcLayer>file</SrcLayer> \n \
-        <GeometryType>wkbPoint25D</GeometryType>\n \
-        <LayerSRS>EPSG:32634</LayerSRS>\n \
-        <GeometryField encoding=\"PointFromColumns\" x=\"x\" y=\"y\" z=\"z\"/>\n \
-        </OGRVRTLayer>\n \
-        </OGRVRTDataSource>")
+    vrt.write(get_vrt_xml(csv_file))
     vrt.close()
 
     return vrt_file
 
 
+def get_grid_size(snap_data, cell_size):
+    """
+    Function returns the number of columns and rows of the resampled raster. Same as the size of the snap raster
+
+    :param snap_data: np.array with snap raster extension [Xmin, Ymax, Xmax, Ymin] or [ulX ulY lrX lrY]
+    :param cell_size: float with cell size of the resulting raster (same as snap raster's)
+    :return: int with number of columns, int with number of rows
+    """
+    columns = int((snap_data[2] - snap_data[0]) / cell_size)  # Get No. of columns in snap raster
+    rows = int((snap_data[1] - snap_data[3]) / cell_size)  # Get No. of rows in snap raster
+    return columns, rows
+
+
+def get_grid_algorithm():
+    """
+    Function returns the gdal_grid algorithm: Inv distance with nearest neighbor, with the power, smoothing, max number
+    of points and search radius from the interpolation settings (default: power of 2, smoothing of 0, using a max
+    number of 12 points, searching in a 5000 m radius for those max. 12 points)
+
+    :return: string with the gdal_grid algorithm definition
+    """
+    return "invdistnn:power=" + str(interpolation_power) + ":smoothing=" + str(interpolation_smoothing) + \
+        ":max_points=" + str(interpolation_max_points) + ":radius=" + str(interpolation_radius) + \
+        ":nodata=" + str(interpolation_nodata)
+
+
 def interpolate_points(vrt_file, raster_name, snap_data, cell_size):
     """
     Function receives the path of the .vrt file, which contains the XYZ points and uses these points to interpolate
     values for a new raster resolution (cell size)
 
     :param vrt_file: .vrt virtual file path which contains the original raster cell center coordinates
-    :param folder: folder path in which to temporarily save the interpolated raster file
+    :param raster_name: path of the interpolated raster file (an existing file is replaced)
     :param snap_data: np.array with snap raster extension [Xmin, Ymax, Xmax, Ymin] or [ulX ulY lrX lrY]
     :param cell_size: float with cell size of the resulting raster (same as snap raster's)
     :return: path for the interpolated raster file
@@ -122,21 +205,141 @@ def interpolate_points(vrt_file, raster_name, snap_data, cell_size):
         os.remove(raster_name)
 
     # Get the number of columns and rows that the resampled raster must have. Same as the size of the snap raster
-    columns = str(int((snap_data[2] - snap_data[0]) / cell_size))  # Get No. of columns in snap raster (as as string)
-    rows = str(int((snap_data[1] - snap_data[3]) / cell_size))  # Get No. of rows in snap raster (as a string)
+    columns, rows = get_grid_size(snap_data, cell_size)
 
     # Use gdal grid to interpolate:
-    # ---- a:interpolation method (Inv distance with nearest neighbor, with smoothing of 0, using a max number of 12
-    # ----- points, searching in a 5000 m radius for those max. 12 points)
-    # ---- txe: Xmin Xmax,
-    # ---- tye: Ymin, Ymax,
-    # ---- outsize: columns rows, of: output file format
-    # ---- a_srs: coordinate system, ot: out type (float)
-    os.system(
-        "gdal_grid -a invdistnn:power=2.0:smoothing=0:max_points=12:radius=5000 -txe " + str(snap_data[0]) + " " + str(
-            snap_data[2]) +
-        " -tye " + str(snap_data[3]) + " " + str(
-            snap_data[1]) + " -outsize " + columns + " " + rows + " -of gtiff -a_srs EPSG:32634 " +
-        "-ot Float32 " + vrt_file + " " + raster_name)
+    # ---- algorithm: interpolation method (see get_grid_algorithm)
+    # ---- outputBounds: [ulX ulY lrX lrY] of the snap raster (north up)
+    # ---- width, height: columns rows, format: output file format
+    # ---- outputSRS: coordinate system, outputType: out type (float, see gdal_options.get_grid_kwargs)
+    try:
+        dataset = gdal.Grid(raster_name, vrt_file, algorithm=get_grid_algorithm(), outputBounds=list(snap_data),
+                            width=columns, height=rows, outputSRS='EPSG:32634', **go.get_grid_kwargs('GTiff'))
+    except RuntimeError as e:  # GDAL exceptions are enabled (see gdal_options.configure_gdal)
+        raise RuntimeError("gdal.Grid failed to interpolate the points of " + vrt_file + ": " + str(e)) from e
+    dataset = None  # Close (and write) the interpolated raster
     return raster_name
 
+
+def interpolate_points_in_memory(points, snap_data, cell_size):
+    """
+    Function interpolates the XYZ points to the snap raster grid (same as interpolate_points), but without any files
+    on disk. The points are passed to gdal.Grid through a .csv and .vrt file in GDAL's in-memory file system (/vsimem/)
+    and the result is returned as in-memory dataset.
+
+    :param points: np.array with (X,Y,Z) coordinates of cell centers
+    :param snap_data: np.array with snap raster extension [Xmin, Ymax, Xmax, Ymin] or [ulX ulY lrX lrY]
+    :param cell_size: float with cell size of the resulting raster (same as snap raster's)
+    :return: gdal.Dataset (MEM driver) with the interpolated raster
+    """
+    # Unique names, so that parallel calls do not interfere
+    csv_file = '/vsimem/' + uuid.uuid4().hex + '.csv'
+    vrt_file = csv_file.replace(".csv", ".vrt")
+
+    columns = ["x", "y", "z"]  # Set column names
+    csv_text = pd.DataFrame(data=points, index=None, columns=columns).to_csv(index=False, sep=',', na_rep="",
+                                                                           decimal='.')
+    gdal.FileFromMemBuffer(csv_file, csv_text.encode())
+    gdal.FileFromMemBuffer(vrt_file, get_vrt_xml(csv_file).encode())
+
+    try:
+        columns, rows = get_grid_size(snap_data, cell_size)
+        dataset = gdal.Grid('', vrt_file, algorithm=get_grid_algorithm(), outputBounds=list(snap_data),
+                            width=columns, height=rows, outputSRS='EPSG:32634', **go.get_grid_kwargs('MEM'))
+    except RuntimeError as e:  # GDAL exceptions are enabled (see gdal_options.configure_gdal)
+        raise RuntimeError("gdal.Grid failed to interpolate the points: " + str(e)) from e
+    finally:
+        gdal.Unlink(csv_file)
+        gdal.Unlink(vrt_file)
+    return dataset
+
+
+def get_idw_weights(tree, target_xy, power=interpolation_power, smoothing=interpolation_smoothing,
+                    max_points=interpolation_max_points, radius=interpolation_radius, workers=interpolation_threads):
+    """
+    Function searches the (max. max_points) nearest points within the radius of each target coordinate and calculates
+    their normalized inverse distance weights, in the same way as gdal_grid invdistnn: weight = 1 / r^power, with
+    r^2 = distance^2 + smoothing^2. If a point coincides with the target, it gets the full weight. As in gdal_grid,
+    points at exactly the radius are used (the KD-tree search bound is exclusive).
+
+    :param tree: scipy.spatial.cKDTree, spatial index with the X,Y point coordinates
+    :param target_xy: np.array with (X,Y) coordinates of the target cell centers
+    :param power: float, weighting power
+    :param smoothing: float, smoothing parameter
+    :param max_points: int, maximum number of points per target
+    :param radius: float, search radius
+    :param workers: int, number of threads of the neighbor search (-1: all cores)
+    :return: np.array (int) with the point indices of each target (n targets x max_points); np.array (float64) with the
+    normalized weights (0 for missing neighbors); np.array (bool) which is True for targets with at least one point
+    """
+    distances, indices = tree.query(target_xy, k=max_points, distance_upper_bound=np.nextafter(radius, np.inf),
+                                    workers=workers)
+    distances = distances.reshape(len(target_xy), max_points)  # k=1 returns 1D arrays
+    indices = indices.reshape(len(target_xy), max_points)
+
+    # Missing neighbors have an infinite distance and the index tree.n
+    found = np.isfinite(distances)
+    indices = np.where(found, indices, 0)
+
+    r_square = np.where(found, distances ** 2 + smoothing ** 2, 1.0)
+    exact = found & (r_square < 0.0000000000001)
+    weights = np.where(found, 1.0 / np.where(exact, 1.0, r_square) ** (power / 2.0), 0.0)
+
+    # Targets which coincide with a point get the value of the (first) coinciding point
+    exact_rows = exact.any(axis=1)
+    if exact_rows.any():
+        first_exact = exact[exact_rows] & (np.cumsum(exact[exact_rows], axis=1) == 1)
+        weights[exact_rows] = np.where(first_exact, 1.0, 0.0)
+
+    weight_sum = weights.sum(axis=1)
+    has_points = weight_sum > 0
+    weights[has_points] /= weight_sum[has_points, np.newaxis]
+
+    return indices, weights, has_points
+
+
+def idw_interpolate(points, snap_data, cell_size, power=interpolation_power, smoothing=interpolation_smoothing,
+                    max_points=interpolation_max_points, radius=interpolation_radius, nodata=interpolation_nodata,
+                    workers=interpolation_threads, block_rows=interpolation_block_rows):
+    """
+    Function interpolates the XYZ points to the snap raster grid with inverse distance to a power with nearest
+    neighbor search (same result as gdal_grid invdistnn). The points are stored in a KD-tree and the snap raster is
+    interpolated in blocks of block_rows rows.
+
+    :param points: np.array with (X,Y,Z) coordinates of cell centers (3 columns or structured with the fields x, y, z)
+    :param snap_data: np.array with snap raster extension [Xmin, Ymax, Xmax, Ymin] or [ulX ulY lrX lrY]
+    :param cell_size: float with cell size of the resulting raster (same as snap raster's)
+    :param power: float, weighting power
+    :param smoothing: float, smoothing parameter
+    :param max_points: int, maximum number of points per cell
+    :param radius: float, search radius
+    :param nodata: float, value of cells without points in the search radius
+    :param workers: int, number of threads of the neighbor search (-1: all cores)
+    :param block_rows: int, number of rows which are interpolated at once
+    :return: np.array (float32) with the interpolated raster (north up, same grid as the snap raster)
+    """
+    columns, rows = get_grid_size(snap_data, cell_size)
+    interpolated = np.full([rows, columns], nodata, dtype=np.float32)
+    if len(points) == 0:
+        return interpolated
+
+    if points.dtype.names:  # structured array with the fields x, y, z
+        tree = cKDTree(np.column_stack([points["x"], points["y"]]))
+        values = np.asarray(points["z"], dtype=np.float64)
+    else:
+        tree = cKDTree(points[:, :2])
+        values = np.asarray(points[:, 2], dtype=np.float64)
+
+    # X coordinates of the cell centers are the same for every row
+    x_centers = snap_data[0] + (np.arange(columns) + 0.5) * cell_size
+
+    for row_start in range(0, rows, block_rows):
+        row_stop = min(row_start + block_rows, rows)
+        y_centers = snap_data[1] - (np.arange(row_start, row_stop) + 0.5) * cell_size
+        target_xy = np.column_stack([np.tile(x_centers, row_stop - row_start), np.repeat(y_centers, columns)])
+
+        indices, weights, has_points = get_idw_weights(tree, target_xy, power, smoothing, max_points, radius, workers)
+        block = np.einsum('ij,ij->i', weights, values[indices])
+        interpolated[row_start:row_stop] = np.where(has_points, block, nodata).reshape(row_stop - row_start, columns)
+
+    return interpolated
@@ -0,0 +1,467 @@
+"""
+Module contains the sharding of the nc file and season tasks of a scenario folder between several nodes (or processes
+on one machine), which share lu_path and export_folder (shard_mode):
+- 'static': every node processes the tasks whose hash modulo shard_count is its shard_index
+- 'dynamic': the nodes claim the tasks one after the other with lock files in export_folder/.locks. A lock is created
+  exclusively (O_CREAT | O_EXCL), so only one node gets it. The locks of a node are refreshed (heartbeat) every
+  lock_heartbeat seconds; a lock which was not refreshed for lock_timeout seconds belongs to a dead node and is
+  reclaimed. A node whose lock was reclaimed does not write, record or release the output of the task (see
+  check_task_lock and get_release_callback). Tasks which another node finished in the meantime (up to date in the
+  manifest) are skipped, so the dynamic mode needs INCREMENTAL=True.
+
+The shared manifest is merged under a lock (see save_manifest) and the reports get the name of the shard or node (see
+get_report_path). The clipped rasters are written under a temporary name and renamed (see
+raster_calculations.array_to_raster), so that a node which dies never leaves an incomplete output.
+
+Example (two processes on one machine):
+  python main.py --set shard_mode=dynamic & python main.py --set shard_mode=dynamic
+"""
+from config import *
+from functions import get_file_str
+import manifest as mf
+import socket
+
+# Lock files held by this process (lock path: token), the lock of each claimed output (output path: (lock path,
+# token)) and the heartbeat thread which refreshes them
+_held_locks = {}
+_lost_locks = set()
+_task_locks = {}
+_held_locks_lock = threading.Lock()
+_heartbeat = None
+# Pause before a missing lock file is read again (a stale lock check moves the lock away for a moment)
+_lock_reread_pause = 0.2
+_lock_rereads = 3
+_config_hash = None
+
+
+class LockLostError(RuntimeError):
+    """
+    Error of a task whose lock was reclaimed by another node (dynamic mode): its output is not written, recorded or
+    released, since the other node processes the task.
+    """
+
+
+def check_settings():
+    """
+    Checks the sharding settings.
+    """
+    if shard_mode not in (None, 'static', 'dynamic'):
+        raise ValueError("Unknown shard_mode '" + str(shard_mode) + "' (None, static or dynamic)")
+    if shard_mode == 'static' and not 0 <= shard_index < shard_count:
+        raise ValueError("shard_index must be in [0, shard_count), not " + str(shard_index))
+    if shard_mode == 'dynamic' and not INCREMENTAL:
+        raise ValueError("shard_mode='dynamic' needs INCREMENTAL=True (the manifest records the finished tasks)")
+
+
+def get_node_name():
+    """
+    Returns the name of this node (shard_node or host name and process id).
+
+    :return: str, with the node name
+    """
+    return shard_node or socket.gethostname() + "_" + str(os.getpid())
+
+
+def get_report_path(report_path, extension=''):
+    """
+    Returns the path of a report of this shard or node (run statistics, zonal statistics, stage report), so that the
+    nodes do not overwrite each other's reports.
+
+    :param report_path: str, path of the report without extension
+    :param extension: str, (optional) extension of the report (e.g. '.csv')
+    :return: str, with the path of the report
+    """
+    if shard_mode == 'static':
+        return report_path + "_shard" + str(shard_index) + extension
+    if shard_mode == 'dynamic':
+        return report_path + "_" + get_node_name() + extension
+    return report_path + extension
+
+
+def is_own_task(nc_file, season_alias):
+    """
+    Checks whether a task belongs to this shard (static mode). The assignment only depends on the nc file name and the
+    season, so it is the same on all nodes and does not change when nc files are added.
+
+    :param nc_file: str, path of the nc file
+    :param season_alias: str, name of the season
+    :return: boolean, True if the task belongs to this shard
+    """
+    digest = hashlib.sha1((get_file_str(nc_file) + "_" + season_alias).encode()).hexdigest()
+    return int(digest, 16) % shard_count == shard_index
+
+
+def filter_static_tasks(seasons):
+    """
+    Returns the tasks of this shard (static mode).
+
+    :param seasons: dict, with the names of the seasons to process for each nc file
+    :return: dict, with the names of the seasons of this shard for each nc file
+    """
+    return {nc_file: [season_alias for season_alias in file_seasons if is_own_task(nc_file, season_alias)]
+            for nc_file, file_seasons in seasons.items()}
+
+
+def get_lock_path(export_folder, nc_file, season_alias):
+    """
+    Returns the path of the lock file of a task.
+
+    :param export_folder: str, folder where the clipped files are stored
+    :param nc_file: str, path of the nc file
+    :param season_alias: str, name of the season
+    :return: str, with the path of the lock file
+    """
+    return export_folder + '/.locks/' + get_file_str(nc_file) + "_" + season_alias + ".lock"
+
+
+def read_lock(lock_path):
+    """
+    Returns the token of a lock file.
+
+    :param lock_path: str, path of the lock file
+    :return: str, with the token or None if the lock file does not exist or is incomplete
+    """
+    try:
+        with open(lock_path, 'r') as lock_file:
+            return json.load(lock_file)["token"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def owns_lock(lock_path, token):
+    """
+    Checks whether a lock file has the token of this process. A missing lock is read again a few times after a short
+    pause, since a node which checks whether the lock is stale moves it to a tombstone for a moment (see
+    reclaim_stale_lock).
+
+    :param lock_path: str, path of the lock file
+    :param token: str, token of the lock of this process
+    :return: boolean, True if the lock file has the token
+    """
+    lock_token = read_lock(lock_path)
+    for reread in range(_lock_rereads):
+        if lock_token is not None:
+            break
+        time.sleep(_lock_reread_pause)
+        lock_token = read_lock(lock_path)
+    return lock_token == token
+
+
+def refresh_lock(lock_path):
+    """
+    Refreshes the modification time of a lock file.
+
+    :param lock_path: str, path of the lock file
+    :return: boolean, True if the lock file was refreshed
+    """
+    try:
+        os.utime(lock_path)
+    except OSError:
+        return False
+    return True
+
+
+def refresh_locks():
+    """
+    Heartbeat thread: refreshes the modification time of the locks held by this process every lock_heartbeat seconds.
+    A lock which does not exist anymore or has another token was reclaimed by another node (this node missed its
+    heartbeats): it is marked as lost (see is_lock_lost) and not refreshed anymore. A lock which is only missing while
+    another node checks it (see owns_lock) is refreshed again.
+    """
+    while True:
+        time.sleep(lock_heartbeat)
+        with _held_locks_lock:
+            held_locks = list(_held_locks.items())
+        for lock_path, token in held_locks:
+            refreshed = refresh_lock(lock_path)
+            if not owns_lock(lock_path, token):
+                print("Lost the lock " + lock_path + " (reclaimed by another node), the task may be processed twice")
+                with _held_locks_lock:
+                    if _held_locks.get(lock_path) == token:
+                        del _held_locks[lock_path]
+                        _lost_locks.add(lock_path)
+            elif not refreshed:  # the lock was moved away for a moment
+                refresh_lock(lock_path)
+
+
+def is_lock_lost(lock_path):
+    """
+    Checks whether a lock of this process was reclaimed by another node (see refresh_locks).
+
+    :param lock_path: str, path of the lock file
+    :return: boolean, True if the lock was lost
+    """
+    with _held_locks_lock:
+        return lock_path in _lost_locks
+
+
+def start_heartbeat():
+    """
+    Starts the heartbeat thread of this process (once).
+    """
+    global _heartbeat
+    with _held_locks_lock:
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=refresh_locks, daemon=True)
+            _heartbeat.start()
+
+
+def reclaim_stale_lock(lock_path, timeout=lock_timeout):
+    """
+    Removes a lock which was not refreshed for timeout seconds (dead node). The reclaim is guarded by a second lock file
+    (lock_path + '.reclaim', created exclusively), so that only one node reclaims a lock at a time. Under the guard, the
+    lock is renamed to a unique tombstone first, so that a heartbeat of its owner cannot refresh it anymore, and the
+    token and age are checked again on the tombstone: only a lock which is still the stale one is removed, otherwise
+    it is restored (linked back, which fails if another node locked the task in between: the owner then notices the
+    lost lock in its heartbeat, see refresh_locks). The heartbeat of the owner reads a missing lock again before it
+    declares it lost (see owns_lock), so the short time on the tombstone does not cost the owner its lock. A guard
+    which was left by a dead node is removed after timeout seconds.
+
+    :param lock_path: str, path of the lock file
+    :param timeout: float, (optional) seconds after which a lock which was not refreshed is stale
+    :return: boolean, True if the lock does not exist anymore
+    """
+    try:
+        age = time.time() - os.stat(lock_path).st_mtime
+    except FileNotFoundError:  # released in the meantime
+        return True
+    if age < timeout:
+        return False
+
+    token = read_lock(lock_path)
+    guard_path = lock_path + ".reclaim"
+    try:
+        os.close(os.open(guard_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+    except FileExistsError:  # another node reclaims the lock
+        try:
+            if time.time() - os.stat(guard_path).st_mtime >= timeout:
+                os.remove(guard_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    tombstone_path = lock_path + "." + uuid.uuid4().hex + ".stale"
+    try:
+        try:
+            os.rename(lock_path, tombstone_path)
+        except FileNotFoundError:
+            return True
+        if time.time() - os.stat(tombstone_path).st_mtime < timeout or read_lock(tombstone_path) != token:
+            # Refreshed or locked again in the meantime: restore the lock
+            try:
+                os.link(tombstone_path, lock_path)
+            except FileExistsError:
+                print("Could not restore the lock " + lock_path + " (locked again by another node)")
+            os.remove(tombstone_path)
+            return False
+        os.remove(tombstone_path)
+    finally:
+        os.remove(guard_path)
+    print("Reclaimed the stale lock " + lock_path)
+    return True
+
+
+def acquire_lock(lock_path, timeout=lock_timeout):
+    """
+    Creates a lock file exclusively. A stale lock is reclaimed (see reclaim_stale_lock).
+
+    :param lock_path: str, path of the lock file
+    :param timeout: float, (optional) seconds after which a lock which was not refreshed is stale
+    :return: boolean, True if this process holds the lock
+    """
+    token = get_node_name() + "_" + uuid.uuid4().hex
+    for attempt in range(2):
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if attempt == 0 and reclaim_stale_lock(lock_path, timeout):
+                continue
+            return False
+        with os.fdopen(lock_fd, 'w') as lock_file:
+            json.dump({"token": token, "node": get_node_name(),
+                       "time": datetime.datetime.now().isoformat(timespec='seconds')}, lock_file)
+        with _held_locks_lock:
+            _held_locks[lock_path] = token
+        start_heartbeat()
+        return True
+    return False
+
+
+def release_lock(lock_path):
+    """
+    Removes a lock file of this process. A lock which was reclaimed by another node in the meantime is kept.
+
+    :param lock_path: str, path of the lock file
+    """
+    with _held_locks_lock:
+        token = _held_locks.pop(lock_path, None)
+        lost = lock_path in _lost_locks
+        _lost_locks.discard(lock_path)
+    if token is not None and not lost and read_lock(lock_path) == token:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def get_config_hash():
+    """
+    Returns the hash of the shared inputs and settings (see manifest.get_config_hash), calculated once per process.
+
+    :return: str, with the hash (hex digest)
+    """
+    global _config_hash
+    if _config_hash is None:
+        _config_hash = mf.get_config_hash(c_fac_file, shape_file, snapraster_file)
+    return _config_hash
+
+
+def claim_tasks(nc_file, season_outputs, export_folder):
+    """
+    Claims the tasks of an nc file (dynamic mode). A task is claimed if its lock is acquired and its output is not up to
+    date in the shared manifest (finished by another node).
+
+    :param nc_file: str, path of the nc file
+    :param season_outputs: dict, with the clipped file of each season to process
+    :param export_folder: str, folder where the clipped files are stored
+    :return: list, with the names of the claimed seasons
+    """
+    os.makedirs(export_folder + '/.locks', exist_ok=True)
+    manifest_path = mf.get_manifest_path(export_folder)
+    claimed = []
+    for season_alias, output_file in season_outputs.items():
+        lock_path = get_lock_path(export_folder, nc_file, season_alias)
+        if not acquire_lock(lock_path):
+            continue
+        if mf.is_up_to_date(mf.load_manifest(manifest_path), output_file, nc_file, get_config_hash()):
+            release_lock(lock_path)
+            continue
+        with _held_locks_lock:
+            _task_locks[os.path.abspath(output_file)] = (lock_path, _held_locks[lock_path])
+        claimed.append(season_alias)
+    return claimed
+
+
+def get_task_locks():
+    """
+    Returns the locks of the outputs claimed by this process, which are passed to the worker processes (see
+    set_task_locks).
+
+    :return: dict, with the lock path and token of each claimed output
+    """
+    with _held_locks_lock:
+        return dict(_task_locks)
+
+
+def set_task_locks(task_locks):
+    """
+    Sets the locks of the claimed outputs in a worker process, which checks them before it writes an output (see
+    check_task_lock).
+
+    :param task_locks: dict, with the lock path and token of each claimed output (see get_task_locks)
+    """
+    with _held_locks_lock:
+        _task_locks.clear()
+        _task_locks.update(task_locks)
+
+
+def is_task_lost(output_file):
+    """
+    Checks whether the lock of a claimed output was reclaimed by another node: the heartbeat marked it as lost (see
+    refresh_locks) or the lock file has another token. Outputs which were not claimed (no dynamic sharding) are never
+    lost.
+
+    :param output_file: str, path of the clipped file
+    :return: boolean, True if the lock of the output was lost
+    """
+    with _held_locks_lock:
+        task_lock = _task_locks.get(os.path.abspath(output_file))
+    if task_lock is None:
+        return False
+    lock_path, token = task_lock
+    return is_lock_lost(lock_path) or not owns_lock(lock_path, token)
+
+
+def check_task_lock(output_file):
+    """
+    Raises a LockLostError if the lock of a claimed output was lost, so that the output is not written.
+
+    :param output_file: str, path of the clipped file
+    """
+    if is_task_lost(output_file):
+        raise LockLostError("Lost the lock of " + output_file + " (reclaimed by another node)")
+
+
+def mark_lost_tasks(results):
+    """
+    Marks the finished tasks of a list of results whose lock was lost as failed, so that they are not recorded in the
+    manifest.
+
+    :param results: list of dicts, with the task results (see pipeline.get_task_result), updated
+    """
+    for result in results:
+        if result["status"] == "done" and is_task_lost(result["output"]):
+            error = LockLostError("Lost the lock of " + result["output"] + " (reclaimed by another node)")
+            print("Error in file " + result["nc_file"] + ", " + result["season"] + ": " + str(error))
+            result["status"] = "failed"
+            result["error"] = type(error).__name__ + ": " + str(error)
+
+
+def release_tasks(results, export_folder):
+    """
+    Releases the locks of the tasks of a list of results (dynamic mode). Lost locks are only forgotten, the lock file
+    of the other node is kept (see release_lock).
+
+    :param results: list of dicts, with the task results (see pipeline.get_task_result)
+    :param export_folder: str, folder where the clipped files are stored
+    """
+    for result in results:
+        with _held_locks_lock:
+            _task_locks.pop(os.path.abspath(result["output"]), None)
+        release_lock(get_lock_path(export_folder, result["nc_file"], result["season"]))
+
+
+def get_release_callback(on_results, export_folder):
+    """
+    Returns a results callback, which marks the tasks whose lock was lost as failed (see mark_lost_tasks), calls
+    on_results (e.g. records the manifest) and then releases the locks of the tasks (dynamic mode). The manifest is
+    saved before the locks are released, so that no other node claims a finished task.
+
+    :param on_results: function, (optional) which is called with the results of each nc file
+    :param export_folder: str, folder where the clipped files are stored
+    :return: function, which is called with the results of each nc file
+    """
+    def on_results_released(file_results):
+        try:
+            mark_lost_tasks(file_results)
+            if on_results is not None:
+                on_results(file_results)
+        finally:
+            release_tasks(file_results, export_folder)
+    return on_results_released
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Saves the manifest shared by several nodes: under a lock, the manifest on disk is read and merged with the entries
+    of this node (the newest entry of an output wins). The merged entries are also kept in manifest. The manifest lock
+    is only held for the merge, so it is waited for with a growing pause (max. 1 s) and it is stale once it missed
+    three heartbeats (instead of lock_timeout).
+
+    :param manifest: dict, with the manifest of this node
+    :param manifest_path: str, with the manifest path
+    """
+    lock_path = manifest_path + ".lock"
+    pause = 0.01
+    while not acquire_lock(lock_path, min(lock_timeout, 3 * lock_heartbeat)):
+        time.sleep(pause * (1 + random.random()))
+        pause = min(2 * pause, 1.0)
+    try:
+        merged = mf.load_manifest(manifest_path)
+        for output_file, entry in manifest["outputs"].items():
+            if output_file not in merged["outputs"] or merged["outputs"][output_file]["time"] <= entry["time"]:
+                merged["outputs"][output_file] = entry
+        mf.save_manifest(merged, manifest_path)
+        manifest["outputs"] = merged["outputs"]
+    finally:
+        release_lock(lock_path)
@@ -0,0 +1,168 @@
+"""
+Module contains the scenario stacks (STACKOUTPUT). The clipped rasters of all nc files of a scenario folder (lu_path)
+are stacked per season into one file with one band (time step) per nc file, so that a time series is read with one
+open:
+- 'GTiff': multi-band GeoTIFF with the output profile of the clipped rasters, band descriptions are the years
+- 'netCDF': chunked cube (time, y, x) with compression, one chunk per time step and block of cells
+"""
+from config import *
+from functions import get_file_str
+import gdal_options as go
+import pipeline as pl
+import raster_calculations as rc
+
+
+def get_year(nc_alias):
+    """
+    Returns the year of an nc file (last four digit number in the file name).
+
+    :param nc_alias: str, name of the nc file (without extension)
+    :return: int, with the year or None if the name contains no year
+    """
+    years = re.findall(r'(?<!\d)(\d{4})(?!\d)', nc_alias)
+    return int(years[-1]) if years else None
+
+
+def get_stack_file(scenario_alias, season_alias, export_folder):
+    """
+    Returns the path of the stack of a scenario and season.
+
+    :param scenario_alias: str, name of the scenario (name of the lu_path folder)
+    :param season_alias: str, name of the season
+    :param export_folder: str, folder where the clipped files are stored
+    :return: str, with the path of the stack
+    """
+    extension = ".nc" if stack_format == 'netCDF' else ".tif"
+    return export_folder + '/' + scenario_alias + "_" + season_alias + "_stack" + extension
+
+
+def stack_to_geotiff(raster_files, years, save_path):
+    """
+    Stacks single band rasters of the same grid into a multi-band GeoTIFF (one band per raster). The rasters are read
+    one at a time. The stack is written under a temporary name and then renamed, so that an interrupted stack never
+    leaves an incomplete file under save_path.
+
+    :param raster_files: list, with the paths of the rasters (time steps)
+    :param years: list, with the year of each raster (band description)
+    :param save_path: str, path of the stack
+    """
+    first = gdal.Open(raster_files[0])
+    driver_name, options = go.get_output_options()
+    tmp_path = rc.get_tmp_path(save_path)
+    # The COG driver only supports copies: the stack is built as tiled GeoTIFF in a second temporary file first
+    build_path = rc.get_tmp_path(save_path) if driver_name == "COG" else tmp_path
+    try:
+        stack = gdal.GetDriverByName("GTiff").Create(
+            build_path, first.RasterXSize, first.RasterYSize, len(raster_files), gdal.GDT_Float32,
+            options=go.get_creation_options() + ['TILED=YES', 'INTERLEAVE=BAND'] if driver_name == "COG" else options)
+        stack.SetGeoTransform(first.GetGeoTransform())
+        stack.SetProjection(first.GetProjection())
+        first = None
+
+        for band_nr, (raster_file, year) in enumerate(zip(raster_files, years), start=1):
+            raster = gdal.Open(raster_file)
+            band = stack.GetRasterBand(band_nr)
+            band.SetNoDataValue(-9999)
+            band.SetDescription(str(year))
+            band.WriteArray(raster.GetRasterBand(1).ReadAsArray())
+            raster = None
+        stack.SetMetadataItem("TIME_STEPS", ",".join(str(year) for year in years))
+
+        if driver_name == "COG":
+            gdal.GetDriverByName("COG").CreateCopy(tmp_path, stack, options=options)
+        else:
+            overview_levels = go.get_output_kwargs()["overview_levels"]
+            if overview_levels:
+                stack.BuildOverviews("AVERAGE", overview_levels)
+        band = stack = None  # Close (and write) the stack before it is renamed
+        os.replace(tmp_path, save_path)
+    except Exception:
+        band = stack = None
+        rc.remove_tmp_file(tmp_path)
+        raise
+    finally:
+        if build_path != tmp_path:
+            rc.remove_tmp_file(build_path)
+
+
+def stack_to_netcdf(raster_files, years, save_path):
+    """
+    Stacks single band rasters of the same grid into a netCDF cube (time, y, x), chunked per time step and in blocks of
+    output_block_size cells and compressed (zlib). The rasters are read one at a time. The stack is written under a
+    temporary name and then renamed (see stack_to_geotiff).
+
+    :param raster_files: list, with the paths of the rasters (time steps)
+    :param years: list, with the year of each raster (time coordinate)
+    :param save_path: str, path of the stack
+    """
+    first = gdal.Open(raster_files[0])
+    gt = first.GetGeoTransform()
+    proj = first.GetProjection()
+    x_size, y_size = first.RasterXSize, first.RasterYSize
+    first = None
+
+    tmp_path = rc.get_tmp_path(save_path)
+    try:
+        with nc.Dataset(tmp_path, 'w', format='NETCDF4') as stack:
+            stack.createDimension('time', len(raster_files))
+            stack.createDimension('y', y_size)
+            stack.createDimension('x', x_size)
+
+            time_var = stack.createVariable('time', 'i4', ('time',))
+            time_var.units = 'year'
+            time_var[:] = years
+            x = stack.createVariable('x', 'f8', ('x',))
+            x[:] = gt[0] + (np.arange(x_size) + 0.5) * gt[1]
+            y = stack.createVariable('y', 'f8', ('y',))
+            y[:] = gt[3] + (np.arange(y_size) + 0.5) * gt[5]
+
+            crs = stack.createVariable('crs', 'i4')
+            crs.spatial_ref = proj
+            crs.GeoTransform = " ".join(str(value) for value in gt)
+
+            chunks = (1, min(output_block_size, y_size), min(output_block_size, x_size))
+            c_factor = stack.createVariable('c_factor', 'f4', ('time', 'y', 'x'), zlib=True, complevel=4, shuffle=True,
+                                            chunksizes=chunks, fill_value=np.float32(-9999))
+            c_factor.grid_mapping = 'crs'
+            for time_nr, raster_file in enumerate(raster_files):
+                raster = gdal.Open(raster_file)
+                c_factor[time_nr, :, :] = raster.GetRasterBand(1).ReadAsArray()
+                raster = None
+        os.replace(tmp_path, save_path)
+    except Exception:
+        rc.remove_tmp_file(tmp_path)
+        raise
+
+
+def stack_scenario(filenames, context):
+    """
+    Stacks the clipped rasters of the nc files of a scenario folder per season (see stack_format). The nc files are
+    sorted by year; nc files without clipped raster (e.g. failed tasks) are left out.
+
+    :param filenames: list, with the paths of all nc files of the scenario folder
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :return: list, with the paths of the stacks
+    """
+    scenario_alias = os.path.basename(os.path.normpath(os.path.dirname(filenames[0]))) if filenames else ''
+    nc_aliases = sorted((get_file_str(nc_file) for nc_file in filenames),
+                        key=lambda nc_alias: (get_year(nc_alias) is None, get_year(nc_alias) or 0, nc_alias))
+
+    stack_files = []
+    for season_alias in season_aliases:
+        raster_files, years = [], []
+        for time_nr, nc_alias in enumerate(nc_aliases):
+            finalized = pl.get_season_files(nc_alias, season_alias, context)["finalized"]
+            if os.path.exists(finalized):
+                raster_files.append(finalized)
+                years.append(get_year(nc_alias) if get_year(nc_alias) is not None else time_nr)
+        if not raster_files:
+            continue
+
+        stack_file = get_stack_file(scenario_alias, season_alias, context["export_folder"])
+        print("Stacking " + str(len(raster_files)) + " rasters to " + stack_file + " ...")
+        if stack_format == 'netCDF':
+            stack_to_netcdf(raster_files, years, stack_file)
+        else:
+            stack_to_geotiff(raster_files, years, stack_file)
+        stack_files.append(stack_file)
+    return stack_files
@@ -0,0 +1,216 @@
+"""
+Module contains the temporal interpolation (TEMPORAL): the land use projections come in coarse time steps (e.g. every
+10 years), so the clipped C-factor rasters of the years in between are interpolated linearly from the clipped rasters
+of the two bracketing projection years. The interpolation runs on the target grid (clipped rasters), so an extra year
+only costs one array operation and one raster write instead of a pipeline run.
+
+The projection years are processed in one streaming pass per season: every clipped raster is read once, the difference
+of a bracket is computed once and the rasters of the years in between are written by the writer thread of the pipeline
+(see pipeline.write_outputs) while the next years are computed. Cells without value (-9999) in one of the bracketing
+rasters have no value in the interpolated rasters. The signatures of the bracketing rasters are kept in a state file
+(see get_state_path), so that a later run only writes the years of brackets whose clipped rasters changed.
+"""
+from config import *
+import raster_calculations as rc
+import gdal_options as go
+import pipeline as pl
+import manifest as mf
+from functions import get_file_str
+from stacking import get_year
+
+
+def get_year_alias(nc_alias, year):
+    """
+    Returns the name of an interpolated year: the name of the nc file of the lower bracketing year with its year
+    replaced (e.g. 'LU_SSP1_2030' -> 'LU_SSP1_2034').
+
+    :param nc_alias: str, name of the nc file of the lower bracketing year
+    :param year: int, interpolated year
+    :return: str, with the name of the interpolated year
+    """
+    position = [match.start() for match in re.finditer(r'(?<!\d)\d{4}(?!\d)', nc_alias)][-1]
+    return nc_alias[:position] + str(year) + nc_alias[position + 4:]
+
+
+def get_projection_years(filenames):
+    """
+    Returns the projection years of the nc files (sorted). Nc files without a year in their name are left out.
+
+    :param filenames: list, with the paths of the nc files
+    :return: list of tuples, with the year and the name of the nc file
+    """
+    years = {}
+    for nc_file in filenames:
+        nc_alias = get_file_str(nc_file)
+        if get_year(nc_alias) is not None:
+            years.setdefault(get_year(nc_alias), nc_alias)
+    return sorted(years.items())
+
+
+def read_clipped_raster(raster_path):
+    """
+    Reads a clipped raster.
+
+    :param raster_path: str, path of the clipped raster
+    :return: np.array (float32), with the raster; tuple, with the GEOTransform; str, with the projection (WKT)
+    """
+    gt, proj = rc.get_raster_data(raster_path)
+    return rc.raster_to_array(raster_path, False), gt, proj
+
+
+def interpolate_years(lower_array, upper_array, lower_year, upper_year, years):
+    """
+    Interpolates the rasters of the years between two projection years linearly (generator, one array per year).
+
+    :param lower_array: np.array (float32), with the clipped raster of the lower projection year (-9999 no data)
+    :param upper_array: np.array (float32), with the clipped raster of the upper projection year (-9999 no data)
+    :param lower_year: int, lower projection year
+    :param upper_year: int, upper projection year
+    :param years: list, with the interpolated years (lower_year < year < upper_year)
+    :return: generator of tuples, with the year and the interpolated np.array (float32)
+    """
+    no_data = (lower_array == -9999) | (upper_array == -9999)
+    difference = upper_array - lower_array
+    for year in years:
+        weight = np.float32((year - lower_year) / (upper_year - lower_year))
+        year_array = lower_array + weight * difference
+        year_array[no_data] = -9999
+        yield year, year_array
+
+
+def get_state_path(export_folder):
+    """
+    Returns the path of the state file of the interpolated rasters in the export folder. The state file holds the
+    signatures of the bracketing clipped rasters and the output settings of every interpolated raster (same layout as
+    the manifest, see manifest.load_manifest).
+
+    :param export_folder: str, folder where the clipped files are stored
+    :return: str, with the path of the state file
+    """
+    return export_folder + '/temporal_manifest.json'
+
+
+def get_bracket_inputs(lower, upper):
+    """
+    Returns the state of the inputs of a bracket: the signatures of the two clipped rasters and the output settings.
+    The interpolated rasters of a bracket are only written again if its inputs changed.
+
+    :param lower: dict, with the lower projection year of the bracket (see interpolate_scenario)
+    :param upper: dict, with the upper projection year of the bracket
+    :return: list, with the signatures and settings
+    """
+    return [mf.get_file_signature(lower["path"]), mf.get_file_signature(upper["path"]),
+            [output_profile, output_compression, output_compression_level, output_block_size, output_overviews,
+             statistics_histogram_bins]]
+
+
+def read_bracket_raster(bracket_year):
+    """
+    Returns the clipped raster of a projection year. The raster is read when it is needed first (brackets which are up
+    to date are not read) and is then kept for the next bracket.
+
+    :param bracket_year: dict, with the projection year (see interpolate_scenario)
+    :return: tuple, with the clipped raster, GEOTransform and projection (see read_clipped_raster)
+    """
+    if bracket_year["raster"] is None:
+        bracket_year["raster"] = read_clipped_raster(bracket_year["path"])
+    return bracket_year["raster"]
+
+
+def interpolate_scenario(filenames, context, step=1):
+    """
+    Writes the clipped rasters of the years between the projection years of a scenario folder for every season (see
+    the module description). Brackets with a missing clipped raster (e.g. failed tasks) or whose clipped rasters are not
+    on the same grid or projection are reported and left out. Brackets whose clipped rasters and output settings did
+    not change since their years were written are skipped (see get_state_path).
+
+    :param filenames: list, with the paths of the nc files of the scenario folder
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param step: int, (optional) number of years between two interpolated rasters
+    :return: list, with the paths of the interpolated rasters which were written (without the failed writes)
+    """
+    projection_years = get_projection_years(filenames)
+    state_path = get_state_path(context["export_folder"])
+    state = mf.load_manifest(state_path)
+
+    interpolated_files = []
+
+    def record_years(results):
+        # Called by the writer thread after the rasters of a bracket are written (write errors mark them as failed)
+        for result in results:
+            if result["status"] == "done":
+                state["outputs"][os.path.abspath(result["output"])] = {
+                    "inputs": result["inputs"], "time": datetime.datetime.now().isoformat(timespec='seconds')}
+                interpolated_files.append(result["output"])
+
+    writer_queue = queue.Queue(maxsize=writer_queue_size)
+    writer = threading.Thread(target=pl.write_outputs, args=(writer_queue, record_years), daemon=True)
+    writer.start()
+
+    try:
+        for season_alias in season_aliases:
+            lower = None
+            for year, nc_alias in projection_years:
+                raster_path = pl.get_season_files(nc_alias, season_alias, context)["finalized"]
+                if not (os.path.exists(raster_path)):
+                    print("Missing clipped raster " + raster_path + ", the years around " + str(year) +
+                          " are not interpolated")
+                    lower = None
+                    continue
+                upper = {"year": year, "alias": nc_alias, "path": raster_path, "raster": None}
+                if lower is not None:
+                    write_bracket(lower, upper, season_alias, step, context, writer_queue, state)
+                lower = upper
+    finally:
+        writer_queue.put(None)
+        writer.join()
+        mf.save_manifest(state, state_path)
+    return interpolated_files
+
+
+def write_bracket(lower, upper, season_alias, step, context, writer_queue, state):
+    """
+    Interpolates and writes the rasters of the years between two projection years. Nothing is written if all rasters
+    of the bracket are up to date or if the two clipped rasters are not on the same grid or projection (reported).
+
+    :param lower: dict, with the year, nc file name, clipped raster path and raster (see read_bracket_raster) of the
+    lower projection year
+    :param upper: dict, with the year, nc file name, clipped raster path and raster of the upper projection year
+    :param season_alias: str, name of the season
+    :param step: int, number of years between two interpolated rasters
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param writer_queue: queue.Queue, of the writer thread (see pipeline.write_outputs)
+    :param state: dict, with the state of the interpolated rasters (see get_state_path)
+    :return: list, with the paths of the interpolated rasters which were passed to the writer thread
+    """
+    years = list(range(lower["year"] + step, upper["year"], step))
+    save_paths = [pl.get_season_files(get_year_alias(lower["alias"], year), season_alias, context)["finalized"]
+                  for year in years]
+    inputs = get_bracket_inputs(lower, upper)
+    if all(os.path.exists(save_path) and
+           state["outputs"].get(os.path.abspath(save_path), {}).get("inputs") == inputs for save_path in save_paths):
+        print("Interpolated years between " + str(lower["year"]) + " and " + str(upper["year"]) + " (" +
+              season_alias + ") are up to date")
+        return []
+
+    lower_array, gt, proj = read_bracket_raster(lower)
+    upper_array, upper_gt, upper_proj = read_bracket_raster(upper)
+    if lower_array.shape != upper_array.shape or tuple(gt) != tuple(upper_gt) or proj != upper_proj:
+        print("The clipped rasters of " + lower["alias"] + " and " + upper["alias"] + " (" + season_alias +
+              ") are not on the same grid, the years in between are not interpolated")
+        return []
+
+    print("Interpolating " + str(len(years)) + " years between " + str(lower["year"]) + " and " + str(upper["year"]) +
+          " (" + season_alias + ") ...")
+    results = []
+    for (year, year_array), save_path in zip(interpolate_years(lower_array, upper_array, lower["year"], upper["year"],
+                                                               years), save_paths):
+        statistics = rc.get_array_statistics(year_array, -9999, statistics_histogram_bins)
+        writer_queue.put(("raster", dict(save_path=save_path, array=year_array, gt=gt, proj=proj, no_data=-9999,
+                                         statistics=statistics, **go.get_output_kwargs())))
+        result = pl.get_task_result(lower["path"], season_alias, save_path)
+        result["inputs"] = inputs
+        results.append(result)
+    # The results are passed to record_years after the rasters are written (write errors mark them as failed)
+    writer_queue.put(("results", results))
+    return save_paths
@@ -0,0 +1,131 @@
+"""
+The module tests the on-disk cache of the C-factor arrays (see cfac_cache.py) in a temporary folder: the content key,
+the memory-mapped slices of a contained window and the eviction of the least recently used arrays with a tiny size
+limit.
+
+Run with: python test_cfac_cache.py (or python -m pytest test_cfac_cache.py)
+"""
+# Import files
+from config import *
+import tempfile
+import cfac_cache as cc
+
+
+def get_test_table(winter=0.3):
+    """
+    Returns a C-factor table of two PFT bands (summer, winter).
+
+    :param winter: float, (optional) winter C-factor of the first PFT band
+    :return: pd.DataFrame, with the C-factor table
+    """
+    return pd.DataFrame({"Name": ["PFT0", "PFT1"], "Summer": [0.1, 0.2], "Winter": [winter, 0.4]})
+
+
+def create_nc_file(folder, name, text="1"):
+    """
+    Creates an (empty) nc file.
+
+    :param folder: str, folder of the nc file
+    :param name: str, name of the nc file
+    :param text: str, (optional) content of the nc file
+    :return: str, with the path of the nc file
+    """
+    nc_file = folder + "/" + name
+    with open(nc_file, 'w') as nc_data:
+        nc_data.write(text)
+    return nc_file
+
+
+def get_season_arrays(shape, offset=0.0):
+    """
+    Returns one distinct array per season.
+
+    :param shape: tuple, with the rows and columns of the arrays
+    :param offset: float, (optional) added to the values
+    :return: tuple of np.arrays (float32)
+    """
+    return tuple(np.arange(shape[0] * shape[1], dtype=np.float32).reshape(shape) + season_nr * 1000 + offset
+                 for season_nr in range(len(cc.season_aliases)))
+
+
+def test_cache_key():
+    """
+    The key changes with the C-factor table, the seasons and the nc file, not with the path of a copied nc file
+    (manifest_hash_content).
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        nc_file = create_nc_file(folder, "LU_2020.nc")
+        key = cc.get_cache_key(nc_file, get_test_table())
+        assert cc.get_cache_key(nc_file, get_test_table()) == key
+        assert cc.get_cache_key(nc_file, get_test_table(winter=0.35)) != key
+
+        current = cc.season_aliases
+        cc.season_aliases = list(current) + ["Spring"]
+        try:
+            assert cc.get_cache_key(nc_file, get_test_table()) != key
+        finally:
+            cc.season_aliases = current
+
+        create_nc_file(folder, "LU_2020.nc", "changed")
+        assert cc.get_cache_key(nc_file, get_test_table()) != key
+
+
+def test_contained_window():
+    """
+    A window inside a cached window is a cache hit: its memory-mapped slice matches the slice of the full arrays.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        nc_file = create_nc_file(folder, "LU_2020.nc")
+        cache_folder = folder + "/cache"
+        season_arrays = get_season_arrays((6, 8))
+        cc.save_cfac_arrays(season_arrays, nc_file, get_test_table(), wnd.Window(10, 20, 8, 6), cache_folder)
+
+        cached = cc.load_cfac_arrays(nc_file, get_test_table(), wnd.Window(12, 21, 4, 3), cache_folder)
+        assert cached is not None and len(cached) == len(season_arrays)
+        for cached_array, season_array in zip(cached, season_arrays):
+            assert isinstance(cached_array, np.memmap)
+            assert np.array_equal(cached_array, season_array[1:4, 2:6])
+
+        # Not contained (larger) windows and other C-factor tables are misses
+        assert cc.load_cfac_arrays(nc_file, get_test_table(), wnd.Window(9, 20, 8, 6), cache_folder) is None
+        assert cc.load_cfac_arrays(nc_file, get_test_table(winter=0.35), wnd.Window(10, 20, 8, 6),
+                                   cache_folder) is None
+
+
+def test_evict():
+    """
+    With a tiny size limit, the oldest arrays are removed and the arrays just saved are kept, even if an older array
+    was used more recently. Arrays larger than the limit are not cached.
+    """
+    current = cc.cfac_cache_size
+    with tempfile.TemporaryDirectory() as folder:
+        cache_folder = folder + "/cache"
+        window = wnd.Window(0, 0, 50, 50)
+        season_arrays = get_season_arrays((50, 50))
+        # Room for the arrays of one nc file (10 kB per array)
+        cc.cfac_cache_size = (len(cc.season_aliases) * 10500) / 1048576
+        try:
+            old_file = create_nc_file(folder, "LU_2020.nc")
+            new_file = create_nc_file(folder, "LU_2030.nc")
+            cc.save_cfac_arrays(season_arrays, old_file, get_test_table(), window, cache_folder)
+            # The old arrays were used last (newer modification time than the arrays which are saved next)
+            for array_file in glob.glob(cache_folder + '/*/*.npy'):
+                os.utime(array_file, (time.time() + 60, time.time() + 60))
+
+            cc.save_cfac_arrays(season_arrays, new_file, get_test_table(), window, cache_folder)
+            assert cc.load_cfac_arrays(new_file, get_test_table(), window, cache_folder) is not None
+            assert cc.load_cfac_arrays(old_file, get_test_table(), window, cache_folder) is None
+
+            cc.save_cfac_arrays(get_season_arrays((100, 100)), old_file, get_test_table(),
+                                wnd.Window(0, 0, 100, 100), cache_folder)
+            assert cc.load_cfac_arrays(old_file, get_test_table(), wnd.Window(0, 0, 100, 100), cache_folder) is None
+            assert cc.load_cfac_arrays(new_file, get_test_table(), window, cache_folder) is not None
+        finally:
+            cc.cfac_cache_size = current
+
+
+if __name__ == "__main__":
+    test_cache_key()
+    test_contained_window()
+    test_evict()
+    print("C-factor cache tests passed")
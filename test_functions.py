@@ -0,0 +1,126 @@
+"""
+The module tests the C-factor engine (see functions.apply_cfac_to_array) against the original loop over the PFT bands
+on a small masked dataset: masked values have no share, cells which are masked in all PFT bands are np.nan. The
+reprojection onto the fixed target grid with the cached pixel mapping (USETARGETGRID) is tested against the nearest
+neighbor reprojection of rasterio.
+
+Run with: python test_functions.py (or python -m pytest test_functions.py)
+"""
+# Import files
+from config import *
+from functions import *
+
+DS_LON = 5
+DS_LAT = 4
+PFT_COUNT = 3
+
+
+class PftDataset:
+    """
+    Stands in for an nc.Dataset: the variables lat, lon and the masked PFT bands ([lon, lat]).
+    """
+    def __init__(self, pft_bands):
+        self.variables = {"lat": np.arange(DS_LAT), "lon": np.arange(DS_LON)}
+        for pft_nr, pft_band in enumerate(pft_bands):
+            self.variables["PFT" + str(pft_nr)] = pft_band
+
+
+def get_test_data():
+    """
+    Returns the masked PFT bands and the C-factor table of the test. Cell [lon 1, lat 2] is masked in one band only,
+    cell [lon 3, lat 0] in all bands.
+
+    :return: PftDataset, with the PFT bands; pd.DataFrame, with the C-factor table (summer, winter)
+    """
+    rng = np.random.default_rng(0)
+    pft_bands = []
+    for pft_nr in range(PFT_COUNT):
+        mask = np.zeros([DS_LON, DS_LAT], dtype=bool)
+        mask[3, 0] = True
+        if pft_nr == 1:
+            mask[1, 2] = True
+        # Masked cells hold a fill value, which must not be used
+        data = np.where(mask, 1e20, rng.uniform(0, 100, [DS_LON, DS_LAT]))
+        pft_bands.append(np.ma.masked_array(data, mask=mask))
+    c_fac_arr = pd.DataFrame({"Name": ["PFT" + str(pft_nr) for pft_nr in range(PFT_COUNT)],
+                              "Summer": [0.1, 0.25, 0.5], "Winter": [0.3, 0.05, 0.75]})
+    return PftDataset(pft_bands), c_fac_arr
+
+
+def apply_cfac_loop(ds, ds_lon, ds_lat, c_fac_arr):
+    """
+    Original loop over the PFT bands (one pass per band and C-factor set), with masked values as no share and np.nan
+    for cells without a value in all PFT bands.
+
+    :return: list of np.arrays (float64), with the C-factors (lat/lon) of each C-factor set
+    """
+    merged_rasters = [np.zeros([ds_lat, ds_lon], dtype=float) for set_nr in range(c_fac_arr.shape[1] - 1)]
+    valid = np.zeros([ds_lat, ds_lon], dtype=bool)
+    for pft_nr in range(len(ds.variables) - 2):
+        pft_band = ds.variables["PFT" + str(pft_nr)][:]
+        for set_nr, merged_raster in enumerate(merged_rasters):
+            merged_raster += np.transpose(np.ma.filled(pft_band, 0) / 100 * c_fac_arr.iloc[pft_nr, set_nr + 1])
+        valid |= ~np.transpose(np.ma.getmaskarray(pft_band))
+    for merged_raster in merged_rasters:
+        merged_raster[~valid] = np.nan
+    return merged_rasters
+
+
+def test_cfac_engine():
+    """
+    The batched engine and the valid cell engine give the same C-factors as the loop over the PFT bands, also for a
+    window of the grid.
+    """
+    ds, c_fac_arr = get_test_data()
+    expected = apply_cfac_loop(ds, DS_LON, DS_LAT, c_fac_arr)
+    assert np.isnan(expected[0][0, 3]) and not np.isnan(expected[0][2, 1])
+
+    for batch_size in [1, 2, PFT_COUNT]:
+        season_arrays = apply_cfac_to_array(ds, DS_LON, DS_LAT, c_fac_arr, batch_size=batch_size)
+        cell_arrays = apply_cfac_to_array(ds, DS_LON, DS_LAT, c_fac_arr, batch_size=batch_size,
+                                          cells=get_valid_cells(ds, DS_LON, DS_LAT))
+        for season_array, cell_array, expected_array in zip(season_arrays, cell_arrays, expected):
+            assert season_array.dtype == np.float32 and season_array.shape == (DS_LAT, DS_LON)
+            assert np.allclose(season_array, expected_array, equal_nan=True)
+            assert np.allclose(cell_array, expected_array, equal_nan=True)
+
+    window = wnd.Window(1, 0, 3, 2)  # longitude 1 - 3, latitude 0 - 1
+    window_arrays = apply_cfac_to_array(ds, DS_LON, DS_LAT, c_fac_arr, window=window, batch_size=2)
+    for window_array, expected_array in zip(window_arrays, expected):
+        assert np.allclose(window_array, expected_array[0:2, 1:4], equal_nan=True)
+
+
+def test_pixel_mapping():
+    """
+    The fixed target grid covers the snap raster plus the buffer and the reprojection with the pixel mapping gives the
+    same raster as wrp.reproject (nearest): target cells which are not covered by the lat/lon window are np.nan.
+    """
+    snap_data = [490000.0, 4610000.0, 510000.0, 4590000.0]
+    dst_grid = calculate_target_grid(snap_data, "EPSG:32634", None, 5000.0, "EPSG:32634")
+    dst_transform, width, height = dst_grid
+    assert dst_transform.c <= snap_data[0] - 5000.0 and dst_transform.f >= snap_data[1] + 5000.0
+    assert dst_transform.c + width * dst_transform.a >= snap_data[2] + 5000.0
+    assert dst_transform.f + height * dst_transform.e <= snap_data[3] - 5000.0
+
+    nc_rows, nc_columns = calculate_pixel_mapping(dst_grid, "EPSG:32634", block_rows=3)
+    # Window without the first two nc columns of the target area, so that some target cells are not covered
+    window = wnd.Window(int(nc_columns.min()) + 2, int(nc_rows.min()), int(nc_columns.max() - nc_columns.min()) - 1,
+                        int(nc_rows.max() - nc_rows.min()) + 1)
+    src_array = np.random.default_rng(0).uniform(0, 1, (window.height, window.width)).astype(np.float32)
+    src_array[1, 1] = np.nan
+
+    flat_index, covered = get_window_index(nc_rows, nc_columns, window, src_array.shape)
+    mapped = reproject_to_grid(src_array, flat_index, covered, num_threads=2, block_size=10)
+
+    expected = np.full([height, width], np.nan, dtype=np.float32)
+    wrp.reproject(source=src_array, destination=expected, src_transform=get_nc_transform(window),
+                  src_crs='+proj=latlong', dst_transform=dst_transform, dst_crs="EPSG:32634", src_nodata=np.nan,
+                  dst_nodata=np.nan, resampling=Resampling.nearest)
+    assert (~covered).any() and np.isnan(mapped[~covered]).all()
+    assert np.array_equal(mapped, expected, equal_nan=True)
+
+
+if __name__ == "__main__":
+    test_cfac_engine()
+    test_pixel_mapping()
+    print("C-factor tests passed")
@@ -0,0 +1,90 @@
+"""
+The module tests the manifest of the incremental mode (see manifest.py): the recorded outputs are up to date until their
+nc file, a feature output or the config hash changes, and the config hash changes with the inputs and settings.
+
+Run with: python test_manifest.py (or python -m pytest test_manifest.py)
+"""
+# Import files
+from config import *
+import tempfile
+import manifest as mf
+
+
+def write_file(file_path, text):
+    """
+    Writes a small test file.
+
+    :param file_path: str, path of the file
+    :param text: str, content of the file
+    """
+    with open(file_path, 'w') as file:
+        file.write(text)
+
+
+def test_record_outputs():
+    """
+    A recorded output is up to date; it is stale when its nc file, the config hash or a feature output changes. Failed
+    tasks are not recorded.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        nc_file = folder + "/LU_2020.nc"
+        output_file = folder + "/LU_2020_Summer_clip.tif"
+        feature_file = folder + "/LU_2020_Summer_A_clip.tif"
+        for file_path in [nc_file, output_file, feature_file]:
+            write_file(file_path, "1")
+
+        manifest = {"outputs": {}}
+        results = [{"nc_file": nc_file, "season": "Summer", "status": "done", "output": output_file,
+                    "zonal_statistics": [{"output": feature_file}, {"output": None}]},
+                   {"nc_file": nc_file, "season": "Winter", "status": "failed",
+                    "output": folder + "/LU_2020_Winter_clip.tif"}]
+        mf.record_outputs(manifest, results, "hash")
+        assert list(manifest["outputs"]) == [os.path.abspath(output_file)]
+        assert manifest["outputs"][os.path.abspath(output_file)]["feature_outputs"] == [os.path.abspath(feature_file)]
+
+        manifest_path = mf.get_manifest_path(folder)
+        mf.save_manifest(manifest, manifest_path)
+        manifest = mf.load_manifest(manifest_path)
+        assert mf.is_up_to_date(manifest, output_file, nc_file, "hash")
+        assert not mf.is_up_to_date(manifest, output_file, nc_file, "other hash")
+        assert not mf.is_up_to_date(manifest, folder + "/LU_2020_Winter_clip.tif", nc_file, "hash")
+
+        os.remove(feature_file)
+        assert not mf.is_up_to_date(manifest, output_file, nc_file, "hash")
+        write_file(feature_file, "1")
+
+        write_file(nc_file, "changed")
+        assert not mf.is_up_to_date(manifest, output_file, nc_file, "hash")
+
+
+def test_config_hash():
+    """
+    The config hash changes with the content of the inputs and with the settings which change the outputs.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        c_fac_file, shape_file, snapraster_file = folder + "/cfac.csv", folder + "/shape.shp", folder + "/snap.tif"
+        for file_path in [c_fac_file, shape_file, folder + "/shape.dbf", snapraster_file]:
+            write_file(file_path, "1")
+        config_hash = mf.get_config_hash(c_fac_file, shape_file, snapraster_file)
+        assert mf.get_config_hash(c_fac_file, shape_file, snapraster_file) == config_hash
+
+        write_file(folder + "/shape.dbf", "changed")
+        changed_hash = mf.get_config_hash(c_fac_file, shape_file, snapraster_file)
+        assert changed_hash != config_hash
+
+        for name, value in [("gdal_creation_options", ['BIGTIFF=IF_SAFER', 'COMPRESS=LZW']),
+                            ("interpolation_radius", 2500.0), ("season_aliases", ["Summer"]), ("USEFEATURES", True),
+                            ("output_profile", "cog")]:
+            current = getattr(mf, name)
+            setattr(mf, name, value)
+            try:
+                assert mf.get_config_hash(c_fac_file, shape_file, snapraster_file) != changed_hash, name
+            finally:
+                setattr(mf, name, current)
+        assert mf.get_config_hash(c_fac_file, shape_file, snapraster_file) == changed_hash
+
+
+if __name__ == "__main__":
+    test_record_outputs()
+    test_config_hash()
+    print("Manifest tests passed")
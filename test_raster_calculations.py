@@ -0,0 +1,140 @@
+"""
+The module tests the array functions of raster_calculations.py which replace GDAL calls on the written rasters: the
+zonal statistics of the features (see get_zonal_statistics) and the statistics of a raster (see get_array_statistics)
+are compared with the nan statistics of numpy (np.nanmean, np.nanstd, ...) on a small labelled array with no data
+(-9999) and np.nan cells. The clip of the interpolated raster with the cached cutline mask (see get_cached_cutline_mask,
+clip_array and get_window_geotransform) is tested against the expected result of gdalwarp -cutline -crop_to_cutline
+-dstnodata -9999 (see clip_dataset) on a rasterized polygon. The rasterization of GDAL is replaced by the burned cells,
+so that the window of the cells inside the polygon is derived by get_cutline_mask.
+
+Run with: python test_raster_calculations.py (or python -m pytest test_raster_calculations.py)
+"""
+# Import files
+from config import *
+import tempfile
+import types
+import raster_calculations as rc
+
+
+def get_test_array():
+    """
+    Returns a small raster with -9999 and np.nan cells and its label raster with 4 features: feature 3 only covers
+    -9999 and np.nan cells, feature 4 does not cover any cell.
+
+    :return: np.array (float32), with the raster; np.array (int32), with the label raster
+    """
+    array = np.random.default_rng(0).uniform(0.0, 0.5, (6, 8)).astype(np.float32)
+    labels = np.zeros(array.shape, dtype=np.int32)
+    labels[0:3, 0:4] = 1
+    labels[3:6, 0:5] = 2
+    labels[1:3, 5:8] = 3
+    array[0, 0] = array[4, 1] = -9999
+    array[2, 3] = array[5, 4] = np.nan
+    array[1:3, 5:8] = np.where(np.arange(6).reshape(2, 3) % 2 == 0, -9999, np.nan)
+    array[labels == 0] = -9999
+    return array, labels
+
+
+def test_zonal_statistics():
+    """
+    The statistics of every feature are those of its valid cells (no -9999 and no np.nan cells), features without
+    valid cells have a count of 0 and no mean, minimum or maximum.
+    """
+    array, labels = get_test_array()
+    statistics = rc.get_zonal_statistics(array, labels, 4, no_data=-9999)
+    assert [feature["label"] for feature in statistics] == [1, 2, 3, 4]
+
+    values = np.where(array == -9999, np.nan, array).astype(np.float64)
+    for feature in statistics[:2]:
+        zone = values[labels == feature["label"]]
+        assert feature["count"] == np.count_nonzero(~np.isnan(zone))
+        assert np.isclose(feature["mean"], np.nanmean(zone))
+        assert feature["min"] == np.nanmin(zone) and feature["max"] == np.nanmax(zone)
+    for feature in statistics[2:]:
+        assert feature == {"label": feature["label"], "count": 0, "mean": None, "min": None, "max": None}
+
+
+def test_array_statistics():
+    """
+    The statistics of a raster are those of its valid cells (no -9999 and no np.nan cells), the histogram spans the
+    minimum and maximum. A raster without valid cells has a count of 0 and no statistics.
+    """
+    array, labels = get_test_array()
+    statistics = rc.get_array_statistics(array, -9999, histogram_bins=5)
+
+    values = np.where(array == -9999, np.nan, array).astype(np.float64)
+    assert statistics["valid_count"] == np.count_nonzero(~np.isnan(values))
+    assert statistics["min"] == np.nanmin(values) and statistics["max"] == np.nanmax(values)
+    assert np.isclose(statistics["mean"], np.nanmean(values)) and np.isclose(statistics["std"], np.nanstd(values))
+    expected_histogram = np.histogram(values[~np.isnan(values)], bins=5, range=(np.nanmin(values), np.nanmax(values)))
+    assert statistics["histogram"] == expected_histogram[0].tolist()
+    assert isinstance(statistics["mean"], float) and isinstance(statistics["valid_count"], int)
+
+    # Cells of feature 3 (only -9999 and np.nan)
+    empty = rc.get_array_statistics(array[1:3, 5:8], -9999, histogram_bins=5)
+    assert empty == {"valid_count": 0, "min": None, "max": None, "mean": None, "std": None, "histogram": [0] * 5}
+
+
+def get_fake_gdal(burned):
+    """
+    Returns the replacements of the gdal and ogr modules for get_cutline_mask: the rasterization of the shape file
+    burns the given cells (cells whose center lies inside the polygons).
+
+    :param burned: np.array (bool), with the burned cells of the grid
+    :return: tuple, with the replacements of gdal and ogr
+    """
+    band = types.SimpleNamespace(ReadAsArray=lambda: burned.astype(np.uint8))
+    raster = types.SimpleNamespace(SetGeoTransform=lambda gt: None, SetProjection=lambda proj: None,
+                                   GetRasterBand=lambda index: band)
+    driver = types.SimpleNamespace(Create=lambda *args: raster)
+    fake_gdal = types.SimpleNamespace(GetDriverByName=lambda name: driver, GDT_Byte=1,
+                                      RasterizeLayer=lambda *args, **kwargs: None)
+    fake_ogr = types.SimpleNamespace(Open=lambda path: types.SimpleNamespace(GetLayer=lambda: None))
+    return fake_gdal, fake_ogr
+
+
+def test_clip_array():
+    """
+    The clipped raster has the extent of the cells inside the polygon (-crop_to_cutline), the GEOTransform of its top
+    left cell and -9999 in the cells outside of the polygon; the cells inside keep the values of the interpolated
+    raster. The mask is rasterized once per shape file and grid (cached).
+    """
+    gt = (400000.0, 500.0, 0.0, 4600000.0, 0.0, -500.0)
+    interpolated = np.random.default_rng(0).uniform(0.0, 0.5, (10, 12)).astype(np.float32)
+    burned = np.zeros(interpolated.shape, dtype=bool)
+    for row in range(2, 7):  # triangle: rows 2 - 6, columns 3 - 11
+        burned[row, 3:3 + 2 * (row - 1) - 1] = True
+
+    with tempfile.TemporaryDirectory() as folder:
+        shape_file = folder + "/catchment.shp"
+        with open(shape_file, 'w'):
+            pass
+        gdal_module, ogr_module = rc.gdal, rc.ogr
+        rc.gdal, rc.ogr = get_fake_gdal(burned)
+        try:
+            clip_mask, window = rc.get_cached_cutline_mask(shape_file, gt, "EPSG:32634", 12, 10, folder + "/masks")
+            rc.gdal, rc.ogr = None, None  # the second call must not rasterize
+            assert rc.get_cached_cutline_mask(shape_file, gt, "EPSG:32634", 12, 10, folder + "/masks")[1] == window
+        finally:
+            rc.gdal, rc.ogr = gdal_module, ogr_module
+
+    assert window == (2, 3, 5, 9)
+    clipped = rc.clip_array(interpolated, clip_mask, window, no_data=-9999)
+    clipped_gt = rc.get_window_geotransform(gt, window)
+    assert clipped.dtype == np.float32 and clipped.shape == (5, 9)
+    assert clipped_gt == (400000.0 + 3 * 500.0, 500.0, 0.0, 4600000.0 - 2 * 500.0, 0.0, -500.0)
+
+    # Expected clip: the cells of the window, -9999 outside of the polygon
+    expected = np.where(burned, interpolated, np.float32(-9999))[2:7, 3:12]
+    assert np.array_equal(clipped, expected)
+    assert (clipped[~clip_mask] == -9999).all() and clipped[0, 0] == interpolated[2, 3]
+
+    # Feature windows inside the clipped raster (see pipeline.export_features)
+    assert rc.get_window_geotransform(clipped_gt, (1, 2, 2, 2)) == rc.get_window_geotransform(gt, (3, 5, 2, 2))
+
+
+if __name__ == "__main__":
+    test_zonal_statistics()
+    test_array_statistics()
+    test_clip_array()
+    print("Raster calculation tests passed")
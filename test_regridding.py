@@ -0,0 +1,87 @@
+"""
+The module tests the regridding operator (see regridding.py) against the per-season interpolation of the KD-tree engine
+(see resample_snap.idw_interpolate), which gives the same result as gdal_grid invdistnn: on a small grid, the operator
+is built once and applied to two seasons whose invalid (np.nan) cells differ.
+
+Run with: python test_regridding.py (or python -m pytest test_regridding.py)
+"""
+# Import files
+from config import *
+import tempfile
+import raster_calculations as rc
+import resample_snap as rs
+import regridding as rg
+
+SOURCE_SHAPE = (6, 6)
+CELL_SIZE = 1000.0
+SNAP_CELL_SIZE = 500.0
+
+
+def get_test_context(folder):
+    """
+    Returns the processing context of the test: a 6 x 6 km snap raster with 500 m cells, whose cells are all inside
+    the (empty) shape file.
+
+    :param folder: str, folder of the shape file and the caches
+    :return: dict, with the processing context (see pipeline.load_context)
+    """
+    shape_file = folder + "/catchment.shp"
+    with open(shape_file, 'w'):
+        pass
+    extent = SOURCE_SHAPE[1] * CELL_SIZE
+    return {
+        "snap_gt": (0.0, SNAP_CELL_SIZE, 0.0, extent, 0.0, -SNAP_CELL_SIZE),
+        "snap_proj": "EPSG:32634",
+        "snap_data": np.array([0.0, extent, extent, 0.0]),
+        "cell_resolution": SNAP_CELL_SIZE,
+        "shape_file": shape_file,
+        "operator_folder": folder + "/operators",
+        "mask_folder": folder + "/masks",
+    }
+
+
+def test_operator_equivalence():
+    """
+    The operator gives the same clipped raster as the reprojection and the KD-tree interpolation of each season,
+    also for cells which are only invalid in one season (the nearest valid points are selected per season).
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        context = get_test_context(folder)
+        # The EPSG:32634 grid maps its cells one to one to the source cells (fixed target grid, see
+        # pipeline.get_target_index), the last row is not covered by the source grid. The grid is shifted against the
+        # snap raster, so that no two points have the same distance to a target cell (the choice between equally near
+        # points is arbitrary, also in gdal_grid)
+        dst_transform = rio.transform.Affine(CELL_SIZE, 0.0, 137.0, 0.0, -CELL_SIZE, SOURCE_SHAPE[0] * CELL_SIZE - 61.0)
+        dst_index = np.arange(SOURCE_SHAPE[0] * SOURCE_SHAPE[1], dtype=np.float64).reshape(SOURCE_SHAPE)
+        dst_index[-1] = -1
+
+        rng = np.random.default_rng(0)
+        summer = rng.uniform(0.0, 1.0, SOURCE_SHAPE)
+        winter = rng.uniform(0.0, 1.0, SOURCE_SHAPE)
+        summer[0:2, 0:3] = np.nan  # invalid in summer only
+        winter[3:5, 2:6] = np.nan  # invalid in winter only
+        summer[2, 2] = winter[2, 2] = np.nan  # invalid in both seasons
+
+        x_size, y_size = rs.get_grid_size(context["snap_data"], SNAP_CELL_SIZE)
+        full_mask = np.ones([y_size, x_size], dtype=bool)
+        get_cutline_mask = rc.get_cutline_mask
+        rc.get_cutline_mask = lambda *args: (full_mask, (0, 0, y_size, x_size))
+        try:
+            src_transform = rio.transform.Affine(0.01, 0.0, 20.0, 0.0, -0.01, 45.0)  # only part of the cache key
+            operator = rg.get_operator(SOURCE_SHAPE, src_transform, context, (dst_transform, dst_index))
+        finally:
+            rc.get_cutline_mask = get_cutline_mask
+
+        for season_array in [summer, winter]:
+            clipped = rg.apply_operator(operator, season_array, rg.get_valid_source_mask(season_array))
+
+            target_array = np.where(dst_index >= 0, season_array.ravel()[dst_index.astype(np.int64)], np.nan)
+            points = rs.get_raster_points(target_array, dst_transform.to_gdal())
+            expected = rs.idw_interpolate(points, context["snap_data"], SNAP_CELL_SIZE)
+            assert np.allclose(clipped, expected, atol=1e-6), "Largest difference: " + \
+                str(np.max(np.abs(clipped - expected)))
+
+
+if __name__ == "__main__":
+    test_operator_equivalence()
+    print("Regridding tests passed")
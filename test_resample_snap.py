@@ -0,0 +1,56 @@
+"""
+The module tests the points of the cells with values (see resample_snap.get_raster_points) on a tiny raster and the
+KD-tree interpolation engine against inverse distance to a power with nearest neighbor search (gdal_grid invdistnn),
+calculated by hand on a small grid.
+
+Run with: python test_resample_snap.py (or python -m pytest test_resample_snap.py)
+"""
+# Import files
+from config import *
+import resample_snap as rs
+
+
+def test_raster_points():
+    """
+    Every cell with a value is a point, including the last cell of the raster (lower right corner), also when the
+    points are yielded in chunks.
+    """
+    array = np.array([[1.0, np.nan, 2.0],
+                      [np.nan, 3.0, 4.0]])
+    gt = (100.0, 10.0, 0.0, 500.0, 0.0, -10.0)
+
+    points = rs.get_raster_points(array, gt)
+    assert points.shape == (4, 3)
+    assert np.array_equal(points[-1], [125.0, 485.0, 4.0])
+
+    structured = rs.get_raster_points(array, gt, dtype=np.float32, structured=True)
+    assert len(structured) == 4 and tuple(structured[-1]) == (125.0, 485.0, 4.0)
+
+    chunks = list(rs.iter_raster_points(array, gt, chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    assert np.array_equal(np.concatenate(chunks), points)
+
+
+def test_idw_interpolate_radius():
+    """
+    Points at exactly the search radius are used, as in gdal_grid invdistnn: on a 3 x 3 grid with 1000 m cells and a
+    radius of 1000 m, the center cell gets the mean of the two points on its left and right cell (equal weights), the
+    corner cells the value of the point 1000 m away and the middle cells of the upper and lower row no value.
+    """
+    snap_data = np.array([0.0, 3000.0, 3000.0, 0.0])
+    points = np.array([[500.0, 1500.0, 2.0],
+                       [2500.0, 1500.0, 6.0]])
+
+    interpolated = rs.idw_interpolate(points, snap_data, 1000.0, power=2.0, smoothing=0.0, max_points=12,
+                                      radius=1000.0, nodata=-9999.0, workers=1, block_rows=2)
+
+    expected = np.array([[2.0, -9999.0, 6.0],
+                         [2.0, (2.0 / 1000.0 ** 2 + 6.0 / 1000.0 ** 2) / (2.0 / 1000.0 ** 2), 6.0],
+                         [2.0, -9999.0, 6.0]], dtype=np.float32)
+    assert np.allclose(interpolated, expected), "Interpolated raster: " + str(interpolated)
+
+
+if __name__ == "__main__":
+    test_raster_points()
+    test_idw_interpolate_radius()
+    print("Interpolation tests passed")
@@ -0,0 +1,81 @@
+"""
+The module tests the setting overrides of the command line (see main.get_overrides and config.apply_overrides): the
+text of --set NAME=VALUE is converted to the type of the setting, the text settings which are None by default keep the
+text as it is, and unknown settings, malformed assignments and values which cannot be parsed are rejected.
+
+Run with: python test_settings.py (or python -m pytest test_settings.py)
+"""
+# Import files
+import config
+import main
+
+
+def test_setting_values():
+    """
+    The overrides take the type of the setting (booleans, numbers, literals) and the text settings stay text.
+    """
+    assert config.get_setting_value("USELOG", "false") is False
+    assert config.get_setting_value("USELOG", " ON ") is True
+    assert config.get_setting_value("n_workers", "4") == 4 and isinstance(config.get_setting_value("n_workers", "4"),
+                                                                          int)
+    assert config.get_setting_value("interpolation_radius", "2500.5") == 2500.5
+    assert config.get_setting_value("lock_timeout", "60") == 60.0
+    assert isinstance(config.get_setting_value("lock_timeout", "60"), float)
+    assert config.get_setting_value("season_aliases", "['summer']") == ["summer"]
+    # Text settings which are None by default: numbers stay text, 'None' resets the setting
+    assert config.get_setting_value("shard_node", "7") == "7"
+    assert config.get_setting_value("feature_name_field", "None") is None
+    assert config.get_setting_value("job_folder", "/data/jobs") == "/data/jobs"
+
+
+def test_invalid_settings():
+    """
+    Unknown settings, values of the wrong type and assignments without '=' raise a ValueError.
+    """
+    for name, text in [("NOSUCHSETTING", "1"), ("_unused", "1"), ("os", "1"), ("get_setting_value", "1"),
+                       ("USELOG", "maybe"), ("n_workers", "four"), ("n_workers", "true"), ("lock_timeout", "[60]"),
+                       ("interpolation_radius", "5000 m")]:
+        try:
+            config.get_setting_value(name, text)
+        except ValueError:
+            continue
+        raise AssertionError("No ValueError for " + name + "=" + text)
+
+    try:
+        main.get_overrides(main.parse_args(["--set", "USELOG"]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("No ValueError for --set USELOG")
+
+
+def test_apply_overrides():
+    """
+    The overrides of the command line change the settings of config.py and are passed on to the worker processes in
+    the environment (see config.OVERRIDES_ENV).
+    """
+    overrides = main.get_overrides(main.parse_args(["--set", "USELOG=false", "--set", "shard_node=7", "--workers",
+                                                    "3", "--lu-path", "/data/lu"]))
+    assert overrides == {"USELOG": "false", "shard_node": "7", "n_workers": "3", "lu_path": "/data/lu"}
+
+    previous = {name: getattr(config, name) for name in overrides}
+    previous_env = config.os.environ.get(config.OVERRIDES_ENV)
+    try:
+        config.apply_overrides(overrides)
+        assert config.USELOG is False and config.n_workers == 3 and config.lu_path == "/data/lu"
+        assert config.shard_node == "7"
+        assert config.json.loads(config.os.environ[config.OVERRIDES_ENV])["USELOG"] == "false"
+    finally:
+        for name, value in previous.items():
+            setattr(config, name, value)
+        if previous_env is None:
+            config.os.environ.pop(config.OVERRIDES_ENV, None)
+        else:
+            config.os.environ[config.OVERRIDES_ENV] = previous_env
+
+
+if __name__ == "__main__":
+    test_setting_values()
+    test_invalid_settings()
+    test_apply_overrides()
+    print("Setting tests passed")
@@ -0,0 +1,234 @@
+"""
+The module tests the dynamic sharding (see sharding.py) with several processes on one machine: the processes claim the
+tasks of a set of (empty) nc files with the lock files, write their outputs and merge the shared manifest. Every task
+must be claimed by exactly one process, the merged manifest must contain all outputs and no lock may be left. The
+stale lock reclaim is tested with lock files whose modification time is set back, a lost lock with a lock file which
+is overwritten by another node.
+
+Run with: python test_sharding.py (or python -m pytest test_sharding.py)
+"""
+# Import files
+from config import *
+import multiprocessing
+import tempfile
+import manifest as mf
+import sharding as sh
+
+N_PROCESSES = 4
+N_FILES = 12
+SEASONS = ["Summer", "Winter"]
+
+
+def set_up_process(node):
+    """
+    Sets the sharding settings of a test process (dynamic mode, own node name, fixed config hash).
+
+    :param node: str, name of the node
+    """
+    sh.shard_mode = 'dynamic'
+    sh.shard_node = node
+    sh._config_hash = "test"
+    sh._held_locks.clear()
+    sh._lost_locks.clear()
+    sh._task_locks.clear()
+
+
+def run_node(args):
+    """
+    Processes the tasks of the test folder as one node: claims the tasks of every nc file, writes their outputs, saves
+    the shared manifest and releases the locks (as pipeline.run_files with sharding.get_release_callback).
+
+    :param args: tuple, with the node name, the nc files and the export folder
+    :return: list of tuples, with the nc file and season of the claimed tasks
+    """
+    node, filenames, export_folder = args
+    set_up_process(node)
+    manifest = {"outputs": {}}
+    manifest_path = mf.get_manifest_path(export_folder)
+    claimed = []
+    for nc_file in filenames:
+        season_outputs = {season_alias: export_folder + '/' + os.path.basename(nc_file) + "_" + season_alias + ".tif"
+                          for season_alias in SEASONS}
+        file_seasons = sh.claim_tasks(nc_file, season_outputs, export_folder)
+        results = []
+        for season_alias in file_seasons:
+            with open(season_outputs[season_alias], 'w') as output:
+                output.write(node)
+            time.sleep(0.01)
+            results.append({"nc_file": nc_file, "season": season_alias, "status": "done",
+                            "output": season_outputs[season_alias]})
+            claimed.append((nc_file, season_alias))
+
+        def on_results(file_results):
+            mf.record_outputs(manifest, file_results, "test")
+            sh.save_manifest(manifest, manifest_path)
+        sh.get_release_callback(on_results, export_folder)(results)
+    return claimed
+
+
+def create_nc_files(folder):
+    """
+    Creates the (empty) nc files of a test.
+
+    :param folder: str, folder of the nc files
+    :return: list, with the paths of the nc files
+    """
+    filenames = []
+    for file_nr in range(N_FILES):
+        nc_file = folder + "/LU_test_" + str(2000 + 10 * file_nr) + ".nc"
+        with open(nc_file, 'w') as nc:
+            nc.write(str(file_nr))
+        filenames.append(nc_file)
+    return filenames
+
+
+def test_dynamic_claims():
+    """
+    Several processes share the tasks: every task is claimed once, the manifest holds all outputs and no lock is left.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        filenames = create_nc_files(folder)
+        export_folder = folder + "/export"
+        os.makedirs(export_folder)
+
+        with multiprocessing.Pool(N_PROCESSES) as pool:
+            node_claims = pool.map(run_node, [("node" + str(nr), filenames, export_folder)
+                                              for nr in range(N_PROCESSES)])
+
+        claims = [claim for claimed in node_claims for claim in claimed]
+        expected = [(nc_file, season_alias) for nc_file in filenames for season_alias in SEASONS]
+        assert sorted(claims) == sorted(expected), "Tasks claimed twice or not at all: " + str(claims)
+
+        manifest = mf.load_manifest(mf.get_manifest_path(export_folder))
+        assert len(manifest["outputs"]) == len(expected), "Manifest entries missing after the merge"
+        assert all(mf.is_up_to_date(manifest, output_file, entry["nc_file"], "test")
+                   for output_file, entry in manifest["outputs"].items())
+        assert os.listdir(export_folder + "/.locks") == [], "Locks left: " + str(os.listdir(export_folder + "/.locks"))
+        assert not glob.glob(export_folder + "/*.lock*") and not glob.glob(export_folder + "/*.tmp")
+
+        # A second run finds all tasks up to date
+        assert run_node(("node_rerun", filenames, export_folder)) == []
+
+
+def write_lock(lock_path, token, age):
+    """
+    Writes a lock file of another node with a modification time age seconds ago.
+
+    :param lock_path: str, path of the lock file
+    :param token: str, token of the lock
+    :param age: float, age of the lock in seconds
+    """
+    with open(lock_path, 'w') as lock_file:
+        json.dump({"token": token, "node": "other", "time": ""}, lock_file)
+    os.utime(lock_path, (time.time() - age, time.time() - age))
+
+
+def test_stale_locks():
+    """
+    A stale lock is reclaimed, a fresh one is kept, a lock which is reclaimed by another node (guard) is not touched
+    and a lock which is refreshed during the reclaim is restored.
+    """
+    set_up_process("node_stale")
+    with tempfile.TemporaryDirectory() as folder:
+        lock_path = folder + "/task.lock"
+
+        write_lock(lock_path, "fresh", 0)
+        assert not sh.acquire_lock(lock_path, timeout=60)
+        assert sh.read_lock(lock_path) == "fresh"
+
+        write_lock(lock_path, "stale", 120)
+        assert sh.acquire_lock(lock_path, timeout=60)
+        assert sh.read_lock(lock_path) not in (None, "stale")
+        sh.release_lock(lock_path)
+        assert not os.path.exists(lock_path)
+
+        write_lock(lock_path, "stale", 120)
+        with open(lock_path + ".reclaim", 'w'):
+            pass
+        assert not sh.reclaim_stale_lock(lock_path, timeout=60)
+        assert sh.read_lock(lock_path) == "stale"
+        os.remove(lock_path + ".reclaim")
+
+        # The owner refreshes the lock between the first check and the rename: the lock is restored
+        write_lock(lock_path, "stale", 120)
+        original_stat = os.stat
+        checks = []
+
+        def refreshed_stat(path, *args, **kwargs):
+            if path.endswith(".stale"):
+                checks.append(path)
+                os.utime(path)
+            return original_stat(path, *args, **kwargs)
+        sh.os.stat = refreshed_stat
+        try:
+            assert not sh.reclaim_stale_lock(lock_path, timeout=60)
+        finally:
+            sh.os.stat = original_stat
+        assert checks and sh.read_lock(lock_path) == "stale"
+        assert not glob.glob(lock_path + ".*")
+
+
+def test_lock_moved_during_reclaim():
+    """
+    A lock which another node moves to a tombstone and restores (see sharding.reclaim_stale_lock) still belongs to its
+    owner, a lock which stays missing is lost.
+    """
+    set_up_process("node_moved")
+    with tempfile.TemporaryDirectory() as folder:
+        lock_path = folder + "/task.lock"
+        assert sh.acquire_lock(lock_path, timeout=60)
+        token = sh._held_locks[lock_path]
+
+        tombstone_path = lock_path + ".tombstone.stale"
+        os.rename(lock_path, tombstone_path)
+        restore = threading.Timer(sh._lock_reread_pause / 2, os.rename, (tombstone_path, lock_path))
+        restore.start()
+        try:
+            assert sh.owns_lock(lock_path, token)
+        finally:
+            restore.join()
+
+        os.remove(lock_path)
+        assert not sh.owns_lock(lock_path, token)
+        sh.release_lock(lock_path)
+
+
+def test_lost_lock():
+    """
+    A node whose lock was reclaimed by another node does not write its output, marks the task as failed, does not
+    record it in the manifest and keeps the lock of the other node.
+    """
+    set_up_process("node_lost")
+    with tempfile.TemporaryDirectory() as folder:
+        nc_file = create_nc_files(folder)[0]
+        export_folder = folder + "/export"
+        os.makedirs(export_folder)
+        output_file = export_folder + "/output_Summer.tif"
+        assert sh.claim_tasks(nc_file, {"Summer": output_file}, export_folder) == ["Summer"]
+        sh.check_task_lock(output_file)
+
+        # Another node reclaims the lock
+        lock_path = sh.get_lock_path(export_folder, nc_file, "Summer")
+        write_lock(lock_path, "other", 0)
+        try:
+            sh.check_task_lock(output_file)
+            assert False, "The output of a lost task is written"
+        except sh.LockLostError:
+            pass
+
+        manifest = {"outputs": {}}
+        results = [{"nc_file": nc_file, "season": "Summer", "status": "done", "error": None, "output": output_file}]
+        sh.get_release_callback(lambda file_results: mf.record_outputs(manifest, file_results, "test"),
+                                export_folder)(results)
+        assert results[0]["status"] == "failed" and results[0]["error"].startswith("LockLostError")
+        assert manifest["outputs"] == {}
+        assert sh.read_lock(lock_path) == "other"
+        assert not sh.is_task_lost(output_file) and sh._held_locks == {}
+
+
+if __name__ == "__main__":
+    test_dynamic_claims()
+    test_stale_locks()
+    test_lock_moved_during_reclaim()
+    test_lost_lock()
+    print("Sharding tests passed")
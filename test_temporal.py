@@ -0,0 +1,43 @@
+"""
+The module tests the temporal interpolation (see temporal.py): the linear weights of the years between two projection
+years, the no data cells and the names of the interpolated years.
+
+Run with: python test_temporal.py (or python -m pytest test_temporal.py)
+"""
+# Import files
+from config import *
+import temporal as tp
+
+
+def test_interpolate_years():
+    """
+    The years between two projection years are weighted linearly (float32); a cell without value (-9999) in one of the
+    bracketing rasters has no value in every interpolated year.
+    """
+    lower_array = np.array([[0.1, 0.2], [-9999.0, 0.4]], dtype=np.float32)
+    upper_array = np.array([[0.3, 0.2], [0.5, -9999.0]], dtype=np.float32)
+
+    years = dict(tp.interpolate_years(lower_array, upper_array, 2020, 2030, [2021, 2025, 2029]))
+    assert list(years) == [2021, 2025, 2029]
+    for year, year_array in years.items():
+        weight = (year - 2020) / 10.0
+        assert year_array.dtype == np.float32
+        assert np.isclose(year_array[0, 0], 0.1 + weight * (0.3 - 0.1))
+        assert np.isclose(year_array[0, 1], 0.2)
+        assert year_array[1, 0] == -9999 and year_array[1, 1] == -9999
+    assert np.array_equal(lower_array[1], np.float32([-9999.0, 0.4])), "The bracketing raster was changed"
+
+
+def test_get_year_alias():
+    """
+    The last four digit number of the nc file name is replaced by the interpolated year.
+    """
+    assert tp.get_year_alias('LU_SSP1_2030', 2034) == 'LU_SSP1_2034'
+    assert tp.get_year_alias('LU_2015_SSP1_2030_v2', 2031) == 'LU_2015_SSP1_2031_v2'
+    assert tp.get_year_alias('LU_12345_2030', 2032) == 'LU_12345_2032'
+
+
+if __name__ == "__main__":
+    test_interpolate_years()
+    test_get_year_alias()
+    print("Temporal tests passed")
@@ -0,0 +1,252 @@
+"""
+The module runs a long-running worker, which loads the shared inputs once and then processes the nc files as they
+arrive. The start up of main.py (imports of GDAL, rasterio, pandas, netCDF4, reading c_fac_file and the snap raster) is
+paid once; the processing context stays resident with everything that is cached in it (cutline mask, feature labels,
+valid cell indices, regridding operators), so that the latency of a job is the computation only.
+
+Modes (see worker_mode in config.py):
+- 'watch': lu_path is scanned every worker_poll_interval seconds; new or changed nc files are processed as soon as
+  they are completely copied (size and modification time unchanged between two scans)
+- 'queue': job files (.job, one nc file path per line) are taken from job_folder. A job is claimed by renaming it to
+  .running (several workers can share one job folder) and is renamed to .done or .failed afterwards
+
+The files run through the prefetching pipeline of one process (n_workers is not used: worker processes would not keep
+the resident context). With INCREMENTAL=True, outputs which are up to date are skipped and the manifest is updated after
+every nc file. After every batch, the statistics of its outputs are merged into the run_statistics and zonal_statistics
+.csv files of export_folder and the interpolated years (TEMPORAL) and stacks (STACKOUTPUT) of its scenario folders are
+updated, as after a run of main.py. Several workers can share lu_path and export_folder with sharding (see sharding.py).
+In the 'watch' mode, an nc file whose processing failed is processed again on the next scans (max. worker_retries
+times). The worker is stopped with Ctrl+C.
+
+Needed information:
+- See config.py file
+"""
+# Import files
+from config import *
+import pipeline as pl
+import manifest as mf
+import sharding as sh
+import profiling as prof
+import main
+
+
+def warm_up(context):
+    """
+    Loads the cached rasters of the shape file (cutline mask, feature labels) and the fixed target grid with its pixel
+    mapping (USETARGETGRID) into the context, so that the first job does not pay for them.
+
+    :param context: dict, with the processing context (see pipeline.load_context)
+    """
+    if USEMASKCLIP:
+        pl.get_clip_mask(context)
+    if USEFEATURES:
+        pl.get_feature_labels(context)
+    if USETARGETGRID:
+        pl.get_target_grid(context)
+        pl.get_pixel_mapping(context)
+
+
+def get_file_state(file_path):
+    """
+    Returns the size and modification time of a file.
+
+    :param file_path: str, with the file path
+    :return: tuple, with the size and the modification time or None if the file does not exist (anymore)
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def get_arrived_files(watch_folder, seen_states, processed_states):
+    """
+    Returns the nc files of the watched folder which are new or changed and completely copied: their size and
+    modification time are the same as in the previous scan.
+
+    :param watch_folder: str, folder which is watched
+    :param seen_states: dict, with the file states of the previous scan (updated)
+    :param processed_states: dict, with the file states of the processed nc files
+    :return: list, with the paths of the nc files to process
+    """
+    arrived = []
+    current_states = {}
+    for nc_file in sorted(glob.glob(watch_folder + "/*.nc")):
+        state = get_file_state(nc_file)
+        if state is None:
+            continue
+        current_states[nc_file] = state
+        if state == seen_states.get(nc_file) and state != processed_states.get(nc_file):
+            arrived.append(nc_file)
+    seen_states.clear()
+    seen_states.update(current_states)
+    return arrived
+
+
+def claim_job(job_folder):
+    """
+    Claims the oldest job file of the job folder by renaming it to .running. The rename is atomic, so that a job is
+    only claimed by one of several workers.
+
+    :param job_folder: str, folder of the job files
+    :return: str, path of the claimed job file (.running) and list with its nc files or None, None if there is no job
+    """
+    job_files = sorted(glob.glob(job_folder + "/*.job"), key=lambda job_file: get_file_state(job_file) or (0, 0))
+    for job_file in job_files:
+        running_file = os.path.splitext(job_file)[0] + ".running"
+        try:
+            os.rename(job_file, running_file)
+        except OSError:  # claimed by another worker
+            continue
+        with open(running_file) as job:
+            filenames = [line.strip() for line in job if line.strip()]
+        return running_file, filenames
+    return None, None
+
+
+def process_files(filenames, context, incremental_state=None):
+    """
+    Processes a list of nc files with the resident context. With incremental_state, only the outputs which are not up
+    to date are processed and the manifest is saved after every nc file (merged with the manifest of the other nodes if
+    sharded). With static sharding, only the tasks of this shard are processed. After the batch, the statistics .csv
+    files, the interpolated years (TEMPORAL) and the stacks (STACKOUTPUT) of the scenario folders of the nc files are
+    written as after a run of main.py (see main.write_run_outputs). With PROFILE=True, a run report of the batch is
+    written to export_folder (worker_report_<start time>.json/.csv).
+
+    :param filenames: list, with the paths of the nc files
+    :param context: dict, with the processing context (see pipeline.load_context)
+    :param incremental_state: dict, (optional) with the manifest, its path and the config hash (INCREMENTAL)
+    :return: list of dicts, with the result of each nc file and season task (see pipeline.get_task_result)
+    """
+    seasons = None
+    on_results = None
+    if incremental_state is not None:
+        seasons = pl.get_stale_seasons(filenames, incremental_state["manifest"], incremental_state["config_hash"],
+                                       context)
+        filenames = [nc_file for nc_file in filenames if seasons[nc_file]]
+        on_results = pl.get_manifest_callback(incremental_state["manifest"], incremental_state["manifest_path"],
+                                              incremental_state["config_hash"])
+
+    if shard_mode == 'static':
+        seasons = sh.filter_static_tasks(seasons or {nc_file: list(season_aliases) for nc_file in filenames})
+        filenames = [nc_file for nc_file in filenames if seasons[nc_file]]
+
+    if not filenames:
+        print("All outputs are up to date")
+        return []
+
+    start_time = time.time()
+    results, stage_records = pl.run_files(filenames, context, 1, seasons, on_results)
+    pl.print_task_summary(results)
+    # Statistics, interpolated years and stacks of the scenario folders of the batch (as after a run of main.py)
+    scenario_folders = sorted({os.path.dirname(os.path.abspath(nc_file)) for nc_file in filenames})
+    main.write_run_outputs(results, [sorted(glob.glob(folder + "/*.nc")) for folder in scenario_folders], context)
+    job_time = time.time() - start_time
+    if PROFILE:
+        # One run report per batch (see profiling.write_report), named after the start of the batch
+        report_name = '/worker_report_' + datetime.datetime.fromtimestamp(start_time).strftime('%Y%m%d_%H%M%S')
+        prof.write_report(stage_records, sh.get_report_path(export_folder + report_name), job_time)
+        if profile_console:
+            prof.print_summary(stage_records)
+    print("Job time: ", job_time)
+    return results
+
+
+def get_retry(failures, nc_file, state):
+    """
+    Counts a failed processing of an nc file (watch mode) and decides whether it is processed again on the next scan.
+    The count starts again when the nc file changes (new copy).
+
+    :param failures: dict, with the file state and the number of failures of each nc file (updated)
+    :param nc_file: str, path of the nc file
+    :param state: tuple, with the size and modification time of the nc file (see get_file_state)
+    :return: boolean, True if the nc file is processed again
+    """
+    failed_state, count = failures.get(nc_file, (None, 0))
+    count = count + 1 if failed_state == state else 1
+    failures[nc_file] = (state, count)
+    if count > worker_retries:
+        print("Processing of " + nc_file + " failed " + str(count) + " times, it is processed again when it changes")
+        return False
+    print("Processing of " + nc_file + " failed, it is processed again on the next scan")
+    return True
+
+
+def run_worker(context):
+    """
+    Runs the worker loop (see worker_mode) until it is interrupted.
+
+    :param context: dict, with the processing context (see pipeline.load_context)
+    """
+    if worker_mode not in ('watch', 'queue'):
+        raise ValueError("Unknown worker_mode '" + str(worker_mode) + "' (watch or queue)")
+    sh.check_settings()
+
+    incremental_state = None
+    if INCREMENTAL:
+        manifest_path = mf.get_manifest_path(export_folder)
+        incremental_state = {
+            "manifest": mf.load_manifest(manifest_path),
+            "manifest_path": manifest_path,
+            "config_hash": mf.get_config_hash(c_fac_file, shape_file, snapraster_file),
+        }
+
+    seen_states = {}
+    processed_states = {}
+    failures = {}
+    job_folder_path = job_folder or tmp_folder + '/jobs'
+    if worker_mode == 'queue':
+        os.makedirs(job_folder_path, exist_ok=True)
+    print("Worker ready (" + worker_mode + ": " + (lu_path if worker_mode == 'watch' else job_folder_path) + ")")
+
+    while True:
+        if worker_mode == 'watch':
+            filenames = get_arrived_files(lu_path, seen_states, processed_states)
+            if filenames:
+                try:
+                    results = process_files(filenames, context, incremental_state)
+                    failed_files = {result["nc_file"] for result in results if result["status"] == "failed"}
+                except Exception:
+                    traceback.print_exc()
+                    failed_files = set(filenames)
+                for nc_file in filenames:
+                    if nc_file in failed_files and get_retry(failures, nc_file, seen_states[nc_file]):
+                        continue  # processed again on the next scan
+                    processed_states[nc_file] = seen_states[nc_file]
+                if not failed_files:
+                    continue
+        else:
+            running_file, filenames = claim_job(job_folder_path)
+            if running_file is not None:
+                print("Job: " + running_file)
+                try:
+                    results = process_files(filenames, context, incremental_state)
+                    failed = any(result["status"] == "failed" for result in results)
+                except Exception:
+                    traceback.print_exc()
+                    failed = True
+                os.replace(running_file, os.path.splitext(running_file)[0] + (".failed" if failed else ".done"))
+                continue
+        time.sleep(worker_poll_interval)
+
+
+if __name__ == "__main__":
+    if not (os.path.exists(lu_path)):
+        raise Exception("The folder '" + lu_path + "' does not exist")
+
+    if not (os.path.exists(export_folder)):
+        os.makedirs(export_folder)
+    if not (os.path.exists(tmp_folder)):
+        os.makedirs(tmp_folder)
+
+    # Load the shared inputs once: C-factors, snap raster, shape file rasters
+    start_time = time.time()
+    context = pl.load_context(c_fac_file, snapraster_file, shape_file, export_folder, tmp_folder)
+    warm_up(context)
+    print('Start up time: ', time.time() - start_time)
+
+    try:
+        run_worker(context)
+    except KeyboardInterrupt:
+        print("Worker stopped")